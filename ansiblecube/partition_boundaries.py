@@ -60,16 +60,6 @@ def main(root_size, disk_size):
 
 def get_partitions_boundaries(lines, root_size, disk_size):
 
-    sector_size = 512
-    round_bound = 128
-    end_margin = 4194304  # 4MiB
-
-    def roundup(sector):
-        return rounddown(sector) + round_bound if sector % round_bound != 0 else sector
-
-    def rounddown(sector):
-        return sector - (sector % round_bound) if sector % round_bound != 0 else sector
-
     # parse all lines
     number_of_sector_match = []
     second_partition_match = []
@@ -102,11 +92,28 @@ def get_partitions_boundaries(lines, root_size, disk_size):
     if is_full:
         pass  # whether root part was already expanded
 
+    return compute_boundaries(second_partition_start, root_size, disk_size)
+
+
+def compute_boundaries(root_start, root_size, disk_size):
+    """ root_start, root_end, data_start, data_end sectors for root_start
+
+        also used on host to rewrite an image's partition table """
+
+    sector_size = 512
+    round_bound = 128
+    end_margin = 4194304  # 4MiB
+
+    def roundup(sector):
+        return rounddown(sector) + round_bound if sector % round_bound != 0 else sector
+
+    def rounddown(sector):
+        return sector - (sector % round_bound) if sector % round_bound != 0 else sector
+
     size_up_to_root_b = root_size
     nb_clusters_endofroot = size_up_to_root_b // sector_size
 
     # align partitions (otherwise exfat-fuse gets often corrupt)
-    root_start = second_partition_start
     root_end = roundup(nb_clusters_endofroot)
 
     data_start = root_end + 1
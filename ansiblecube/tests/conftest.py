@@ -1,4 +1,8 @@
 import os
+import sys
+
+# partition_boundaries.py lives at ansiblecube's root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 
 def get_files(extension):
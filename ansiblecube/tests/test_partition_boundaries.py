@@ -0,0 +1,39 @@
+import pytest
+
+from partition_boundaries import compute_boundaries, get_partitions_boundaries
+
+FDISK_OUTPUT = [
+    "Disk /dev/mmcblk0: 7.2 GiB, 7760000000 bytes, 15156250 sectors",
+    "Units: sectors of 1 * 512 = 512 bytes",
+    "Sector size (logical/physical): 512 bytes / 512 bytes",
+    "I/O size (minimum/optimal): 512 bytes / 512 bytes",
+    "Disklabel type: dos",
+    "Disk identifier: 0x5a7089a1",
+    "",
+    "Device         Boot    Start      End  Sectors  Size Id Type",
+    "/dev/mmcblk0p1          8192    98045    89854 43.9M  c W95 FAT32 (LBA)",
+    "/dev/mmcblk0p2         98304 13672447 13574144  6.5G 83 Linux",
+]
+ROOT_SIZE = 7000000000
+DISK_SIZE = 7760000000
+
+
+def test_boundaries():
+    assert get_partitions_boundaries(FDISK_OUTPUT, ROOT_SIZE, DISK_SIZE) == (
+        98304,
+        13671936,
+        13671937,
+        15148120,
+    )
+
+
+def test_host_and_guest_boundaries_match():
+    # host (kiwix-hotspot) computes from the MBR's root start, guest from fdisk
+    assert compute_boundaries(98304, ROOT_SIZE, DISK_SIZE) == (
+        get_partitions_boundaries(FDISK_OUTPUT, ROOT_SIZE, DISK_SIZE)
+    )
+
+
+def test_missing_root_partition():
+    with pytest.raises(ValueError):
+        get_partitions_boundaries(FDISK_OUTPUT[:-1], ROOT_SIZE, DISK_SIZE)
@@ -7,6 +7,7 @@ import tempfile
 import posixpath
 
 import yaml
+
 try:
     from yaml import CSafeDumper as Dumper
 except ImportError:
@@ -190,11 +191,23 @@ def build_extra_vars(
 
 
 def run_phase_one(
-    machine, extra_vars, secret_keys, homepage, logo=None, favicon=None, css=None
+    machine,
+    extra_vars,
+    secret_keys,
+    homepage,
+    logo=None,
+    favicon=None,
+    css=None,
+    mount_data=False,
 ):
-    """ run ansiblecube in machine to configure requested softwares """
+    """ run ansiblecube in machine to configure requested softwares
+
+        mount_data: partitions were resized on host, guest still needs
+        its fstab, data_path placeholder and mount (`resize` role) """
 
     tags = ["rename", "reconfigure"]
+    if mount_data:
+        tags.append("mount-data")
 
     # copy homepage
     machine.put_file(homepage, "/tmp/home.html")
@@ -2,58 +2,114 @@
 # vim: ai ts=4 sts=4 et sw=4 nu
 
 import os
+import time
 import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+import humanfriendly
 
 from util import human_readable_size
+from backend import qemu
 from backend.content import CONTENTS
 from backend.content import get_content
-from backend.catalog import get_catalogs
-from util import get_cache, get_folder_size, get_free_space_in_dir, get_checksum
-
-
-def package_is_latest_version(fpath, fname, logger):
-    """ whether a package (ZIM or ZIP) is in the current catalog """
-
-    for catalog in get_catalogs(logger):
-        for (package_id, package) in catalog["all"].items():
-            package.update({"ext": "zip" if package["type"] != "zim" else "zim"})
-            package.update({"langid": package.get("langid") or package_id})
-            rfname = "package_{langid}-{version}.{ext}".format(**package)
-            if rfname == fname and get_checksum(fpath) == package["sha256sum"]:
-                return "{ext}: {fname}".format(
-                    fname=package["langid"], ext=package["ext"].upper()
-                )
-    return False
-
-
-def is_latest_version(fpath, fname, logger):
-    """ whether the filename is a usable content """
-
-    if fname.startswith("package_"):
-        return package_is_latest_version(fpath, fname, logger)
-
+from backend.catalog import get_catalog_indexes, get_package_ext
+from backend.download import get_extracted_master_fname
+from backend.partition import get_partition_table_signature
+from util import get_cache, get_folder_size, get_free_space_in_dir
+from util import get_trusted_checksum, record_checksum, CHECKSUMS_FNAME
+from util import read_recorded_checksum, read_checksums_index, write_checksums_index
+from util import get_prefs, read_last_used_index, get_last_used, LAST_USED_FNAME
+
+# number of cache files read (hashed) simultaneously
+max_hash_jobs = int(os.getenv("CACHE_HASH_JOBS", 2))
+
+
+def get_expected_cache_files(logger, cache_folder=None):
+    """ {cache filename: (label, expected checksum)} of all usable contents
+
+        built once from CONTENTS and the catalogs' filename index.
+        extracted master has no expected checksum: its recorded one is trusted.
+        so are the boot snapshot overlays of it found in cache_folder """
+    expected = {}
+    for index in get_catalog_indexes(logger):
+        for fname, package_id in index.by_filename.items():
+            package = index.packages[package_id]
+            expected[fname] = (
+                "{ext}: {fname}".format(
+                    fname=package.get("langid") or package_id,
+                    ext=get_package_ext(package).upper(),
+                ),
+                package["sha256sum"],
+            )
     for key, content in CONTENTS.items():
-        if not content["name"] == fname:
-            continue
-
-        if get_checksum(fpath) == content["checksum"]:
-            return key
+        expected[content["name"]] = (key, content["checksum"])
+    master_fname = get_extracted_master_fname(get_content("hotspot_master_image"))
+    expected[master_fname] = ("hotspot_master_image (extracted)", None)
+    if cache_folder is not None:
+        for fname in get_boot_snapshot_fnames(cache_folder, master_fname):
+            expected[fname] = ("hotspot_master_image (VM boot snapshot)", None)
+    return expected
+
+
+def get_boot_snapshot_fnames(cache_folder, master_fname):
+    """ usable boot snapshot overlays of extracted master found in cache_folder """
+    master_fpath = os.path.join(cache_folder, master_fname)
+    try:
+        partitions = get_partition_table_signature(master_fpath)
+        fnames = os.listdir(cache_folder)
+    except OSError:
+        return []  # no master: its snapshots are useless
+    return [
+        fname
+        for fname in fnames
+        if qemu.is_boot_snapshot_of(fname, master_fname, partitions)
+        and qemu.is_overlay_of(os.path.join(cache_folder, fname), master_fpath)
+    ]
+
+
+def is_latest_version(fpath, fname, logger, expected=None, quick=False, checksums=None):
+    """ whether the filename is a usable content (its label)
+
+        quick: trust recorded checksum if file size didn't change
+        checksums: loaded checksums index of the cache folder (see util) """
+
+    if expected is None:
+        expected = get_expected_cache_files(logger, os.path.dirname(fpath))
+
+    if fname not in expected:
+        return False
+
+    label, checksum = expected[fname]
+    if checksum is None:
+        # recorded on extraction: valid as long as file didn't change since
+        recorded = read_recorded_checksum(fpath, quick=quick, index=checksums)
+        return label if recorded else False
+    if get_trusted_checksum(fpath, quick=quick, index=checksums) == checksum:
+        return label
 
     return False
 
 
-def get_cache_file_details(logger, cache_folder, fname):
+def get_cache_file_details(
+    logger, cache_folder, fname, expected=None, quick=False, checksums=None
+):
     """ analyzed cache file details (dict) """
+    if expected is None:
+        expected = get_expected_cache_files(logger, cache_folder)
     fpath = os.path.join(cache_folder, fname)
     isdir = os.path.isdir(fpath)
     size = get_folder_size(fpath) if isdir else os.path.getsize(fpath)
     alien = False
 
-    if fname.endswith(".zim") and not fname.startswith("package_"):  # alien ZIM
+    if fname.endswith(".zim") and fname not in expected:  # alien ZIM
         alien = True
     if isdir:
         alien = True  # our cache contains only files
-    latest = is_latest_version(fpath, fname, logger)
+    latest = (
+        False
+        if isdir
+        else is_latest_version(fpath, fname, logger, expected, quick, checksums)
+    )
 
     return {
         "fname": fname,
@@ -65,17 +121,157 @@ def get_cache_file_details(logger, cache_folder, fname):
     }
 
 
-def get_analyzed_cache_files(logger, cache_folder):
-    """ generator for the detailed file dict of cache files """
-    for fname in os.listdir(cache_folder):
-        yield get_cache_file_details(logger, cache_folder, fname)
+def get_cache_fnames(cache_folder):
+    """ names of cache files (excluding our own metadata files and their tmp) """
+
+    def is_metadata(fname):
+        return any(
+            fname == metadata_fname
+            or (fname.startswith(metadata_fname + ".") and fname.endswith(".tmp"))
+            for metadata_fname in (CHECKSUMS_FNAME, LAST_USED_FNAME)
+        )
+
+    return [fname for fname in os.listdir(cache_folder) if not is_metadata(fname)]
+
+
+def read_cache_quota(load_env=True):
+    """ maximum size (bytes) of the cache folder from pref file or ENV. or None
+
+        - CACHE_QUOTA: human size (`80GB`, `120GiB`). unset or 0 for no limit """
+
+    quota = get_prefs().get("CACHE_QUOTA")
+
+    if load_env:
+        # environment variables overwrites preferences
+        if os.getenv("CACHE_QUOTA", None):
+            quota = os.getenv("CACHE_QUOTA")
+
+    if not quota:
+        return None
+    return humanfriendly.parse_size(str(quota)) or None
+
+
+def evict_cache(logger, cache_folder, required, protected_fnames, quota=None):
+    """ remove least recently used files so that `required` bytes fit in quota
+
+        protected_fnames (contents of the current build) are never removed.
+        returns whether the cache fits in quota once done """
+    if quota is None:
+        quota = read_cache_quota()
+    if not quota:
+        return True
+
+    cache_size = get_folder_size(cache_folder)
+    if cache_size + required <= quota:
+        return True
+
+    logger.step(
+        "Cache over quota ({size} + {req} > {quota}), evicting least recently used".format(
+            size=human_readable_size(cache_size),
+            req=human_readable_size(required),
+            quota=human_readable_size(quota),
+        )
+    )
+
+    last_used = read_last_used_index(cache_folder)
+    candidates = sorted(
+        [
+            os.path.join(cache_folder, fname)
+            for fname in get_cache_fnames(cache_folder)
+            if fname not in protected_fnames
+            and os.path.isfile(os.path.join(cache_folder, fname))
+        ],
+        key=lambda fpath: get_last_used(fpath, last_used),
+    )
+    for fpath in candidates:
+        if cache_size + required <= quota:
+            break
+        fsize = os.path.getsize(fpath)
+        logger.std("REMOVING `{}`... ".format(os.path.basename(fpath)), end="")
+        try:
+            os.unlink(fpath)
+        except Exception as exp:
+            logger.err("FAILED ({}).".format(exp))
+        else:
+            logger.succ("OK.")
+            cache_size -= fsize
+
+    if cache_size + required > quota:
+        logger.err(
+            "Unable to fit cache in quota: {} of contents are needed by this build".format(
+                human_readable_size(cache_size + required)
+            )
+        )
+        return False
+    return True
+
+
+def get_analyzed_cache_files(
+    logger, cache_folder, jobs=None, quick=False, report_progress=False
+):
+    """ generator for the detailed file dict of cache files
+
+        files are analyzed (hashed) by a pool of `jobs` workers
+        but yielded in cache folder order.
+        checksums index is read once and written back once all are analyzed """
+    expected = get_expected_cache_files(logger, cache_folder)
+    fnames = get_cache_fnames(cache_folder)
+    checksums = read_checksums_index(cache_folder)
+    recorded = dict(checksums)
+    started_on = time.time()
+    analyzed = 0
+
+    try:
+        with ThreadPoolExecutor(max_workers=jobs or max_hash_jobs) as executor:
+            futures = [
+                executor.submit(
+                    get_cache_file_details,
+                    logger,
+                    cache_folder,
+                    fname,
+                    expected,
+                    quick,
+                    checksums,
+                )
+                for fname in fnames
+            ]
+            try:
+                for index, future in enumerate(futures):
+                    cfile = future.result()
+                    analyzed += cfile["size"]
+                    if report_progress:
+                        duration = max(time.time() - started_on, 0.001)
+                        logger.std(
+                            "[{num}/{total}] analyzed {fname} ({rate}/s)".format(
+                                num=index + 1,
+                                total=len(futures),
+                                fname=cfile["fname"],
+                                rate=human_readable_size(analyzed / duration),
+                            )
+                        )
+                    yield cfile
+            finally:
+                # generator closed early: don't hash remaining files
+                for future in futures:
+                    future.cancel()
+    finally:
+        if checksums != recorded:
+            save_checksums_index(cache_folder, checksums)
+
+
+def save_checksums_index(cache_folder, checksums):
+    """ write back a loaded checksums index, ignoring read-only cache """
+    try:
+        write_checksums_index(cache_folder, checksums)
+    except OSError:
+        pass
 
 
 def get_cache_size_and_free_space(build_folder, cache_folder):
     """ shortcut to query both cache folder size and build-dir free space """
     return (
         get_folder_size(cache_folder),
-        len(os.listdir(cache_folder)),
+        len(get_cache_fnames(cache_folder)),
         get_free_space_in_dir(cache_folder),
     )
 
@@ -131,7 +327,7 @@ def reset_cache(logger, build_folder, cache_folder, **kwargs):
         master_fpath = os.path.join(cache_folder, master["name"])
         if (
             os.path.exists(master_fpath)
-            and get_checksum(master_fpath) == master["checksum"]
+            and get_trusted_checksum(master_fpath) == master["checksum"]
         ):
             # latest master to be moved temporarly to build-dir
             tmp_master_fpath = os.path.join(
@@ -164,6 +360,8 @@ def reset_cache(logger, build_folder, cache_folder, **kwargs):
             if tmp_master_fpath is not None:
                 logger.err("Please find your master at: {}".format(tmp_master_fpath))
             return 1
+        # checksums index was wiped with the cache
+        record_checksum(master_fpath, master["checksum"])
 
     logger.std("-------------")
     display_cache_and_free_space(
@@ -177,7 +375,13 @@ def clean_cache(logger, build_folder, cache_folder, **kwargs):
     """ remove all obsolete files (keep=False in analyzed detail) from cache """
     logger.step("Starting cache cleaner for: {}".format(cache_folder))
 
-    cfiles = get_analyzed_cache_files(logger, cache_folder)
+    cfiles = get_analyzed_cache_files(
+        logger,
+        cache_folder,
+        jobs=kwargs.get("jobs"),
+        quick=kwargs.get("quick", False),
+        report_progress=True,
+    )
     cache_size, free_space = display_cache_and_free_space(
         logger, build_folder, cache_folder
     )
@@ -202,12 +406,41 @@ def clean_cache(logger, build_folder, cache_folder, **kwargs):
     return 0
 
 
+def rehash_cache(logger, build_folder, cache_folder, **kwargs):
+    """ recompute and record checksum of all files in cache """
+    logger.step("Recomputing checksums for: {}".format(cache_folder))
+
+    checksums = read_checksums_index(cache_folder)
+    try:
+        for fname in get_cache_fnames(cache_folder):
+            fpath = os.path.join(cache_folder, fname)
+            if not os.path.isfile(fpath):
+                continue
+            logger.std("{}... ".format(fname), end="")
+            try:
+                checksum = get_trusted_checksum(fpath, force=True, index=checksums)
+            except Exception as exp:
+                logger.err("FAILED ({}).".format(exp))
+            else:
+                logger.succ(checksum)
+    finally:
+        save_checksums_index(cache_folder, checksums)
+
+    return 0
+
+
 def list_cache_files(logger, build_folder, cache_folder, **kwargs):
     """ colored list of all files in cache with legend (to Keep or to Remove) """
 
     logger.step("Listing cache content for: {}".format(cache_folder))
 
-    cfiles = get_analyzed_cache_files(logger, cache_folder)
+    cfiles = get_analyzed_cache_files(
+        logger,
+        cache_folder,
+        jobs=kwargs.get("jobs"),
+        quick=kwargs.get("quick", False),
+        report_progress=True,
+    )
     cache_size, nb_files, free_space = get_cache_size_and_free_space(
         build_folder, cache_folder
     )
@@ -2,17 +2,21 @@
 # vim: ai ts=4 sts=4 et sw=4 nu
 
 import os
+import json
+import time
+import pickle
 import random
-import shutil
-import tempfile
 
+import requests
 import yaml
+
 try:
     from yaml import CSafeLoader as Loader
 except ImportError:
     from yaml import SafeLoader as Loader
 
-from backend.download import download_file
+from util import get_prefs, get_prefs_path, get_file_signature, get_tmp_fpath
+from backend.download import get_proxies
 
 CATALOGS = [
     {
@@ -22,60 +26,295 @@ CATALOGS = [
     }
 ]
 
-YAML_CATALOGS = None
+CATALOG_INDEXES = None
+INDEX_FORMAT = 1  # bump to invalidate compiled indexes on disk
+CATALOG_TTL = 3600  # seconds during which a snapshot is used without revalidation
+
+
+def read_catalog_settings(load_env=True):
+    """ catalog snapshot configuration from pref file or ENV
+
+        - CATALOG_TTL: seconds a snapshot is trusted without revalidation
+        - CATALOG_OFFLINE: only use existing snapshot, never reach network """
+
+    settings = {
+        "ttl": get_prefs().get("CATALOG_TTL", CATALOG_TTL),
+        "offline": get_prefs().get("CATALOG_OFFLINE", False),
+    }
+
+    if load_env:
+        # environment variables overwrites preferences
+        if os.getenv("CATALOG_TTL", None):
+            settings.update({"ttl": os.getenv("CATALOG_TTL")})
+        if os.getenv("CATALOG_OFFLINE", None):
+            offline = os.getenv("CATALOG_OFFLINE").lower() in ("1", "yes", "true")
+            settings.update({"offline": offline})
+
+    settings["ttl"] = int(settings["ttl"])
+    return settings
+
+
+def get_catalogs_folder():
+    """ folder holding catalog snapshots (shared by GUI, CLI and cache tool) """
+    folder = os.path.join(os.path.dirname(get_prefs_path()), "kiwix-hotspot.catalogs")
+    os.makedirs(folder, exist_ok=True)
+    return folder
+
+
+def get_snapshot_paths(catalog):
+    """ (YAML snapshot path, metadata JSON path) for a catalog """
+    folder = get_catalogs_folder()
+    return (
+        os.path.join(folder, "{}.yml".format(catalog["name"])),
+        os.path.join(folder, "{}.json".format(catalog["name"])),
+    )
+
+
+def read_snapshot_meta(meta_fpath):
+    try:
+        with open(meta_fpath, "r") as fd:
+            return json.load(fd)
+    except Exception:
+        return {}
+
+
+def write_snapshot_meta(meta_fpath, meta):
+    with open(meta_fpath, "w") as fd:
+        json.dump(meta, fd, indent=4)
+
+
+def update_catalog_snapshot(catalog, logger, settings, force=False):
+    """ path to an up-to-date YAML snapshot of the catalog
+
+        snapshot is reused as-is within TTL (or offline) and revalidated
+        using If-None-Match/If-Modified-Since otherwise.
+        A stale snapshot is used should the server be unreachable
+
+        force: ignore existing snapshot (unusable) and download catalog """
+
+    snapshot_fpath, meta_fpath = get_snapshot_paths(catalog)
+    meta = read_snapshot_meta(meta_fpath)
+    has_snapshot = (
+        not force
+        and os.path.exists(snapshot_fpath)
+        and meta.get("url") == catalog["url"]
+    )
+
+    if settings["offline"]:
+        if not has_snapshot:
+            raise IOError("No offline snapshot for {}".format(catalog["url"]))
+        logger.std("using offline catalog snapshot {}".format(snapshot_fpath))
+        return snapshot_fpath
+
+    if has_snapshot and time.time() - meta.get("fetched_on", 0) < settings["ttl"]:
+        logger.std("using recent catalog snapshot {}".format(snapshot_fpath))
+        return snapshot_fpath
+
+    headers = {}
+    if has_snapshot and meta.get("etag"):
+        headers.update({"If-None-Match": meta["etag"]})
+    if has_snapshot and meta.get("last_modified"):
+        headers.update({"If-Modified-Since": meta["last_modified"]})
+
+    try:
+        resp = requests.get(
+            catalog["url"],
+            headers=headers,
+            proxies=get_proxies(),
+            timeout=60,
+            stream=True,
+        )
+        resp.raise_for_status()
+
+        if resp.status_code == 304:
+            logger.std("catalog not modified: {}".format(catalog["url"]))
+        else:
+            logger.std("downloading catalog {}...".format(catalog["url"]))
+            tmp_fpath = get_tmp_fpath(snapshot_fpath)
+            try:
+                with open(tmp_fpath, "wb") as fd:
+                    for chunk in resp.iter_content(chunk_size=2 ** 20):
+                        fd.write(chunk)
+                os.replace(tmp_fpath, snapshot_fpath)
+            finally:
+                if os.path.exists(tmp_fpath):
+                    os.unlink(tmp_fpath)
+            meta = {
+                "url": catalog["url"],
+                "etag": resp.headers.get("ETag"),
+                "last_modified": resp.headers.get("Last-Modified"),
+            }
+    except Exception as exp:
+        if not has_snapshot:
+            raise
+        logger.err("Unable to refresh catalog ({}), using snapshot".format(exp))
+        return snapshot_fpath
+
+    meta.update({"fetched_on": time.time()})
+    write_snapshot_meta(meta_fpath, meta)
+    return snapshot_fpath
+
+
+def get_package_fname(package_id, package):
+    """ cache filename of a catalog package """
+    return "{langid}.{ext}".format(
+        langid=package.get("langid") or package_id, ext=get_package_ext(package)
+    )
+
+
+def get_package_ext(package):
+    return "zip" if package["type"] != "zim" else "zim"
+
+
+class CatalogIndex(object):
+    """ a loaded catalog along with its lookup tables
+
+        - packages: {package_id: package} (the catalog's `all`)
+        - by_filename: {cache filename: package_id}
+        - by_language: {language: [package_id, ]}
+        - by_type: {type: [package_id, ]} """
+
+    def __init__(self, catalog):
+        self.catalog = catalog
+        self.by_filename = {}
+        self.by_language = {}
+        self.by_type = {}
+
+        for package_id, package in self.packages.items():
+            self.by_filename[get_package_fname(package_id, package)] = package_id
+            for language in (package.get("language") or "").split(","):
+                self.by_language.setdefault(language, []).append(package_id)
+            self.by_type.setdefault(package["type"], []).append(package_id)
+
+    @property
+    def packages(self):
+        return self.catalog["all"]
+
+    def is_valid(self, logger):
+        """ ensure the content is readable (prevent incorrect encoding) """
+        entry = self.packages[random.choice(list(self.packages.keys()))]
+        for key in (
+            "name",
+            "description",
+            "version",
+            "language",
+            "id",
+            "url",
+            "sha256sum",
+            "type",
+            "langid",
+        ):
+            if not entry.get(key) or not isinstance(entry[key], str):
+                logger.err("Catalog format is not valid")
+                return False
+        return True
+
+
+def load_catalog_index(snapshot_fpath, logger):
+    """ CatalogIndex for a YAML snapshot. compiled once per snapshot version
+
+        compiled index is pickled next to the snapshot and reused
+        as long as the snapshot file is unchanged """
+
+    index_fpath = "{}.index.pickle".format(os.path.splitext(snapshot_fpath)[0])
+    signature = [INDEX_FORMAT] + get_file_signature(snapshot_fpath)
+
+    try:
+        with open(index_fpath, "rb") as fp:
+            compiled = pickle.load(fp)
+        if compiled["signature"] == signature:
+            return compiled["index"]
+    except Exception:
+        pass
+
+    logger.std("compiling catalog index for {}".format(snapshot_fpath))
+    with open(snapshot_fpath, "r") as fp:
+        index = CatalogIndex(yaml.load(fp.read(), Loader=Loader))
+    if not index.is_valid(logger):
+        return None
+
+    try:
+        with open(index_fpath, "wb") as fp:
+            pickle.dump(
+                {"signature": signature, "index": index},
+                fp,
+                protocol=pickle.HIGHEST_PROTOCOL,
+            )
+    except Exception as exp:
+        logger.err("Unable to save catalog index: {}".format(exp))
+    return index
 
 
 def fetch_catalogs(logger):
-    """ build a dict of loaded (yaml) catalogs from CATALOGS """
-    catalogs = []
-    logger.std("downloading catalogs...")
+    """ build a list of CatalogIndex from CATALOGS """
+    indexes = []
+    logger.std("retrieving catalogs...")
     try:
-        tmp_dir = tempfile.mkdtemp()
+        settings = read_catalog_settings()
 
         for catalog in CATALOGS:
-            tmp_fpath = os.path.join(tmp_dir, "{}.catalog".format(catalog["name"]))
-            dlf = download_file(catalog.get("url"), tmp_fpath, logger, debug=False)
-            if dlf.successful:
-                with open(tmp_fpath, "r") as fp:
-                    catalogs.append(yaml.load(fp.read(), Loader=Loader))
-                os.unlink(tmp_fpath)
-            else:
-                raise ValueError("Unable to download {}".format(catalog.get("url")))
-
-            # ensure the content is readable (prevent incorrect encoding)
-            entry = catalogs[-1]["all"][random.choice(list(catalogs[-1]["all"].keys()))]
-            for key in (
-                "name",
-                "description",
-                "version",
-                "language",
-                "id",
-                "url",
-                "sha256sum",
-                "type",
-                "langid",
-            ):
-                if not entry.get(key) or not isinstance(entry[key], str):
-                    logger.err("Catalog format is not valid")
-                    catalogs.pop()  # remove catalog from list
-                    break
-
-        shutil.rmtree(tmp_dir, ignore_errors=True)
+            snapshot_fpath = update_catalog_snapshot(catalog, logger, settings)
+            try:
+                index = load_catalog_index(snapshot_fpath, logger)
+            except Exception as exp:
+                logger.err("Unable to parse catalog snapshot: {}".format(exp))
+                index = None
+            if index is None and not settings["offline"]:
+                # unusable snapshot is a cache miss
+                snapshot_fpath = update_catalog_snapshot(
+                    catalog, logger, settings, force=True
+                )
+                index = load_catalog_index(snapshot_fpath, logger)
+            if index is not None:
+                indexes.append(index)
     except Exception as exp:
         logger.err("Exception while downloading/parsing catalogs: {}".format(exp))
         return None
-    return catalogs if len(catalogs) else None
+    return indexes if len(indexes) else None
+
+
+def get_catalog_indexes(logger):
+    """ cached-shortcut to CATALOG_INDEXES """
+    global CATALOG_INDEXES
+    if CATALOG_INDEXES is None:
+        CATALOG_INDEXES = fetch_catalogs(logger)
+    return CATALOG_INDEXES
 
 
 def get_catalogs(logger):
-    """ cached-shortcut to YAML_CATALOGS """
-    global YAML_CATALOGS
-    if YAML_CATALOGS is None:
-        YAML_CATALOGS = fetch_catalogs(logger)
-    return YAML_CATALOGS
+    """ list of loaded (yaml) catalogs """
+    indexes = get_catalog_indexes(logger)
+    return [index.catalog for index in indexes] if indexes is not None else None
 
 
 def get_package(logger, package_id):
-    for catalog in get_catalogs(logger):
-        if package_id in catalog["all"].keys():
-            return catalog["all"][package_id]
+    for index in get_catalog_indexes(logger):
+        if package_id in index.packages:
+            return index.packages[package_id]
+
+
+def get_package_for_fname(logger, fname):
+    """ (package_id, package) matching a package cache filename or None """
+    for index in get_catalog_indexes(logger):
+        if fname in index.by_filename:
+            package_id = index.by_filename[fname]
+            return package_id, index.packages[package_id]
+    return None
+
+
+def get_packages_for_language(logger, language):
+    """ IDs of packages in a language (ISO-639-3) """
+    return [
+        package_id
+        for index in get_catalog_indexes(logger)
+        for package_id in index.by_language.get(language, [])
+    ]
+
+
+def get_packages_for_type(logger, package_type):
+    """ IDs of packages of a type (zim, static-site, …) """
+    return [
+        package_id
+        for index in get_catalog_indexes(logger)
+        for package_id in index.by_type.get(package_type, [])
+    ]
@@ -2,22 +2,44 @@
 # vim: ai ts=4 sts=4 et sw=4 nu
 
 import os
+import sys
+import errno
 import json
+import hashlib
 import shutil
+import functools
 import itertools
-
-import requests
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 from data import content_file
-from backend.catalog import get_catalogs
-from backend.download import get_content_cache, unarchive
+from backend.catalog import get_package, get_package_fname
+from backend.download import get_content_cache, unarchive, get_archive_expanded_size
+from backend.download import get_remote_metadata, probe_remote_files
+from backend.util import CheckCallException, copy_file, drop_from_page_cache
+from backend.util import get_file_extents
+from backend.exfat import get_allocated_size
 from util import (
-    get_temp_folder, get_checksum, ONE_GiB, ONE_MB, CLILogger, get_hardware_margin)
+    get_temp_folder,
+    get_trusted_checksum,
+    ONE_GiB,
+    ONE_MB,
+    CLILogger,
+    get_hardware_margin,
+    BytesProgress,
+    read_expanded_sizes,
+    record_expanded_size,
+    get_checksum,
+    read_recorded_checksum,
+)
 
 # prepare CONTENTS from JSON file
 with open(content_file, "r") as fp:
     CONTENTS = json.load(fp)
 
+# number of contents copied or extracted simultaneously onto the data partition
+max_concurrent_actions = int(os.getenv("COPY_CONCURRENCY", 2))
+
 
 def get_content(key):
     if key not in CONTENTS:
@@ -30,8 +52,9 @@ def isremote(path_or_url):
 
 
 def isarchive(fpath):
-    path, ext = os.path.splitext(fpath)
-    return ext in (".zip", ".tar", ".tar.bz2", ".tar.gz", ".tar.xz")
+    return fpath.endswith(
+        (".zip", ".tar", ".tar.bz2", ".tar.gz", ".tar.xz", ".tar.zst")
+    )
 
 
 def get_alien_content(path_or_url):
@@ -56,13 +79,14 @@ def get_local_content(fpath):
         "checksum": None,
         "copied_on_destination": False,
         "archive_size": fsize,
-        "expanded_size": fsize * 1.2 if isarchive(fpath) else fsize,
+        "expanded_size": get_archive_expanded_size(fpath)
+        or (fsize * 1.2 if isarchive(fpath) else fsize),
     }
 
 
 def get_remote_content(url):
     fname = os.path.basename(url)
-    fsize = int(requests.head(url).headers["Content-Length"])
+    fsize = get_remote_metadata(url)["size"]
     assert fsize > 0
     return {
         "url": url,
@@ -88,7 +112,7 @@ def get_collection(
 ):
     """ builds complete list of callbacks and options for selected contents
 
-        returns a list of tuples:
+        returns a BuildPlan iterating over tuples:
             (project_name, get_content_callback, run_actions_callback, kwargs)
 
         - project_name: a string describing the project (for progress/UI)
@@ -102,9 +126,13 @@ def get_collection(
         - run_action_callback:
             expects cache_folder, mount_point, logger and kwargs
             runs the action for the project (copy content into mount_point)
+            optional pool (ActionsPool) to submit actions into instead
             no return value
         """
 
+    # probe all remote contents at once (cached for later size computations)
+    probe_remote_files([path for path in (edupi_resources,) if path and isremote(path)])
+
     collection = []
 
     if edupi:
@@ -192,14 +220,101 @@ def get_collection(
             )
         )
 
-    return collection
+    return BuildPlan(collection)
+
+
+class BuildPlan(object):
+    """ immutable plan for a collection: contents are resolved once
+
+        iterates over the collection's tuples (see get_collection)
+
+        - categories: (project_name, contents, run_actions_callback, kwargs)
+        - contents: flat list of contents for the collection
+        - download_size: data usage to download all of the collection
+        - expanded_size: sum of extracted sizes (without margin)
+
+        expanded_size reflects sizes measured since the plan was created.
+        cache status is checked once per cache folder content change """
+
+    def __init__(self, collection):
+        self._collection = tuple(collection)
+        self._categories = tuple(
+            (project_name, tuple(content_dl_cb(**cb_kwargs)), content_run_cb, cb_kwargs)
+            for project_name, content_dl_cb, content_run_cb, cb_kwargs in collection
+        )
+        self._contents = tuple(
+            itertools.chain.from_iterable(
+                [contents for _, contents, _, _ in self._categories]
+            )
+        )
+        self._download_size = sum([item.get("archive_size") for item in self.contents])
+        self._missing = {}  # cache_folder: (folder signature, missing contents)
+        self._lock = threading.Lock()
+
+    def __iter__(self):
+        return iter(self._collection)
+
+    def __len__(self):
+        return len(self._collection)
+
+    @property
+    def categories(self):
+        return self._categories
+
+    @property
+    def contents(self):
+        return self._contents
+
+    @property
+    def download_size(self):
+        return self._download_size
+
+    @property
+    def expanded_size(self):
+        return sum(
+            [
+                get_content_expanded_size(item) * 2
+                if item.get("copied_on_destination", False)
+                else get_content_expanded_size(item)
+                for item in self.contents
+            ]
+        )
+
+    def get_missing_contents(self, cache_folder):
+        """ contents not present in cache_folder
+
+            checked again once files were added to or removed from it """
+        signature = os.stat(cache_folder).st_mtime_ns
+        with self._lock:
+            if self._missing.get(cache_folder, (None,))[0] != signature:
+                self._missing[cache_folder] = (
+                    signature,
+                    tuple(
+                        item
+                        for item in self.contents
+                        if not content_is_cached(item, cache_folder)
+                    ),
+                )
+            return self._missing[cache_folder][1]
+
+    def get_download_size_using_cache(self, cache_folder):
+        """ data usage to download missing elements of the collection """
+        return sum(
+            [
+                item.get("archive_size")
+                for item in self.get_missing_contents(cache_folder)
+            ]
+        )
+
+
+def as_build_plan(collection):
+    """ BuildPlan for collection (itself if already one) """
+    return collection if isinstance(collection, BuildPlan) else BuildPlan(collection)
 
 
 def get_all_contents_for(collection):
     """ flat list of contents for the collection """
-    return itertools.chain.from_iterable(
-        [content_dl_cb(**cb_kwargs) for _, content_dl_cb, _, cb_kwargs in collection]
-    )
+    return iter(as_build_plan(collection).contents)
 
 
 def get_edupi_contents(enable=False, resources_path=None):
@@ -251,23 +366,19 @@ def get_aflatoun_contents(languages=[]):
 
 def get_package_content(package_id):
     """ content-like dict for packages (zim file or static site) """
-    for catalog in get_catalogs(CLILogger()):
-        try:
-            package = catalog["all"][package_id]
-            package.update({"ext": "zip" if package["type"] != "zim" else "zim"})
-            package.update({"langid": package.get("langid") or package_id})
-            return {
-                "url": package["url"],
-                "name": "{langid}.{ext}".format(**package),
-                "checksum": package["sha256sum"],
-                "archive_size": package["size"],
-                # add a 10% margin for non-zim (zip file mostly)
-                "expanded_size": package["size"] * 1.1
-                if package["type"] != "zim"
-                else package["size"],
-            }
-        except KeyError:
-            continue
+    package = get_package(CLILogger(), package_id)
+    if package is None:
+        return None
+    return {
+        "url": package["url"],
+        "name": get_package_fname(package_id, package),
+        "checksum": package["sha256sum"],
+        "archive_size": package["size"],
+        # add a 10% margin for non-zim (zip file mostly)
+        "expanded_size": package["size"] * 1.1
+        if package["type"] != "zim"
+        else package["size"],
+    }
 
 
 def get_packages_contents(packages=[]):
@@ -279,18 +390,55 @@ def get_packages_contents(packages=[]):
     ]
 
 
-def extract_and_move(content, cache_folder, root_path, final_path, logger):
+def extract_and_move(
+    content, cache_folder, root_path, final_path, logger, progress_cb=None
+):
     """ extract compressed archive into mount-point
 
-        moves resulting file or folder to desired location """
+        useful members are extracted straight next to final_path
+        and renamed into place (merged into final_path if it exists)
+        progress_cb: called with (done, total) bytes of extraction """
 
     # retrieve archive path
     archive_fpath = get_content_cache(content, cache_folder, True)
 
     logger.std("Extracting {src} to {dst}".format(src=archive_fpath, dst=final_path))
 
+    if sys.platform != "win32":
+        # extract (stripping folder_name) to a temp folder beside final_path
+        staging_path = get_temp_folder(os.path.dirname(final_path))
+        os.chmod(staging_path, 0o755)  # mkdtemp's is 0700
+        try:
+            expanded_size = unarchive(
+                archive_fpath,
+                staging_path,
+                logger,
+                strip_prefix=content.get("folder_name"),
+                progress_cb=progress_cb,
+            )
+        except CheckCallException:
+            # tar fails without extracting anything when folder_name is missing
+            if not content.get("folder_name") or os.listdir(staging_path):
+                shutil.rmtree(staging_path, ignore_errors=True)
+                raise
+            expanded_size = None
+        except Exception:
+            shutil.rmtree(staging_path, ignore_errors=True)
+            raise
+
+        if content.get("folder_name") and not os.listdir(staging_path):
+            # archive doesn't store folder_name as expected: extract it all
+            logger.err("No member in {}, retrying".format(content["folder_name"]))
+            os.rmdir(staging_path)
+        else:
+            move_into_place(staging_path, final_path)
+            if expanded_size is not None and content.get("checksum"):
+                record_expanded_size(content["checksum"], expanded_size)
+            return
+
     # extract to a temp folder on root_path
     extract_folder = get_temp_folder(root_path)
+    os.chmod(extract_folder, 0o755)
     unarchive(archive_fpath, extract_folder, logger)
 
     # move useful content to final path
@@ -299,32 +447,247 @@ def extract_and_move(content, cache_folder, root_path, final_path, logger):
         if content.get("folder_name")
         else extract_folder
     )
-    shutil.move(useful_path, final_path)
+    move_into_place(useful_path, final_path)
 
     # remove temp dir
     shutil.rmtree(extract_folder, ignore_errors=True)
 
 
-def copy(content, cache_folder, final_path, logger):
-    """ copy a file from the cache into desired location (on mount point) """
+def move_into_place(src, dst):
+    """ rename folder src to dst, merging it into dst should it exist already """
+    try:
+        os.rename(src, dst)
+        return
+    except OSError as exp:
+        if exp.errno not in (errno.EEXIST, errno.ENOTEMPTY, errno.EXDEV):
+            raise
+
+    os.makedirs(dst, exist_ok=True)
+    for fname in os.listdir(src):
+        src_path, dst_path = os.path.join(src, fname), os.path.join(dst, fname)
+        if os.path.isdir(src_path) and os.path.isdir(dst_path):
+            move_into_place(src_path, dst_path)
+        elif os.path.isdir(dst_path):
+            raise IsADirectoryError(errno.EISDIR, "Can't replace folder", dst_path)
+        else:
+            shutil.move(src_path, dst_path)
+    os.rmdir(src)
+
+
+def copy(content, cache_folder, final_path, logger, progress_cb=None, link=False):
+    """ copy a file from the cache into desired location (on mount point)
+
+        progress_cb: called with (copied, total) bytes
+        link: hard-link instead of copying if possible (host staging folder)
+        returns (final_path, checksum) of the written file for verification """
 
     # retrieve archive path
     archive_fpath = get_content_cache(content, cache_folder, True)
 
+    # cache files' checksum is known (verified on download) ; hash others on the fly
+    checksum = content.get("checksum") or read_recorded_checksum(archive_fpath)
+
+    if link:
+        try:
+            os.link(archive_fpath, final_path)
+        except OSError:
+            pass  # different filesystem or no support: copy instead
+        else:
+            logger.std(
+                "Linked {src} to {dst}".format(src=archive_fpath, dst=final_path)
+            )
+            if progress_cb:
+                size = os.path.getsize(final_path)
+                progress_cb(size, size)
+            return final_path, checksum
+
     logger.std("Copying {src} to {dst}".format(src=archive_fpath, dst=final_path))
 
+    hasher = None if checksum else hashlib.sha256()
+
     # move useful content to final path
-    shutil.copy(archive_fpath, final_path)
+    copy_file(archive_fpath, final_path, progress_cb=progress_cb, hasher=hasher)
+
+    return final_path, checksum or hasher.hexdigest()
+
+
+def verify_files(files, logger, jobs=None):
+    """ re-read written files from disk and compare against their checksum
+
+        files: list of (fpath, checksum) as returned by copy()
+        reports each file to the logger. returns list of failed fpaths """
+    if sys.platform in ("linux", "darwin"):
+        os.sync()
+
+    def verify(fpath, checksum):
+        drop_from_page_cache(fpath)
+        try:
+            return get_checksum(fpath) == checksum, None
+        except Exception as exp:
+            return False, exp
+
+    failed = []
+    with ThreadPoolExecutor(max_workers=jobs or max_concurrent_actions) as executor:
+        futures = [
+            executor.submit(verify, fpath, checksum) for fpath, checksum in files
+        ]
+        for (fpath, checksum), future in zip(files, futures):
+            matches, exp = future.result()
+            if matches:
+                logger.succ("VERIFIED {}".format(fpath))
+            else:
+                failed.append(fpath)
+                logger.err(
+                    "CORRUPTED {fpath} ({reason})".format(
+                        fpath=fpath, reason=exp or "checksum mismatch"
+                    )
+                )
+    return failed
+
+
+def run_action(pool, action, content, **kwargs):
+    """ run action (copy, extract_and_move) for content, in pool if supplied """
+    if pool is None:
+        return action(content=content, **kwargs)
+    pool.submit(action, content, **kwargs)
+
+
+class ActionsPool(object):
+    """ run content actions (copy, extract_and_move) concurrently
+
+        at most `concurrency` actions are run at once.
+        aggregate byte progress (over `total_size`) of actions
+        is reported to the logger with throughput and ETA.
+        errors are collected per content and raised together on join()
+        written files (copy results) are collected in `written`
+
+        plan_writes: defer actions to join() then write large files first
+        (largest first, one at a time so they're contiguous on disk)
+        and extracted trees afterwards (concurrently)
+        link_files: hard-link copied files (target is a host staging folder) """
+
+    def __init__(
+        self, logger, total_size, concurrency=None, plan_writes=False, link_files=False
+    ):
+        self.logger = logger
+        self.plan_writes = plan_writes
+        self.link_files = link_files
+        self.planned = []
+        self.progress = BytesProgress(logger, total_size)
+        self.errors = []
+        self.written = []
+        self.futures = []
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(
+            max_workers=concurrency or max_concurrent_actions
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # on error, don't start pending actions but wait for running ones
+        # so the mount point is not in use anymore
+        self.shutdown(cancel=exc_type is not None)
+
+    def submit(self, action, content, **kwargs):
+        # item progress is scaled to its expanded size
+        kwargs["progress_cb"] = self.progress.callback(
+            content["name"], get_content_expanded_size(content)
+        )
+        if self.link_files and action is copy:
+            kwargs["link"] = True
+        if self.plan_writes:
+            self.planned.append((action, content, kwargs))
+            return
+        self._submit(self.executor, action, content, kwargs)
+
+    def _submit(self, executor, action, content, kwargs):
+        future = executor.submit(action, content=content, **kwargs)
+        future.add_done_callback(functools.partial(self._on_done, content))
+        self.futures.append(future)
+        return future
+
+    def run_planned(self):
+        """ run deferred actions: file copies by decreasing size then the rest """
+        copies = sorted(
+            [item for item in self.planned if item[0] is copy],
+            key=lambda item: get_content_expanded_size(item[1]),
+            reverse=True,
+        )
+        others = [item for item in self.planned if item[0] is not copy]
+        self.planned = []
+
+        self.logger.step("Writing {} large file(s), largest first".format(len(copies)))
+        with ThreadPoolExecutor(max_workers=1) as sequential:
+            for action, content, kwargs in copies:
+                self._submit(sequential, action, content, kwargs)
+
+        self.logger.step("Writing {} folder(s)".format(len(others)))
+        for action, content, kwargs in others:
+            self._submit(self.executor, action, content, kwargs)
+
+    def report_fragmentation(self):
+        """ log number of extents of each written file """
+        for fpath, _ in self.written:
+            extents = get_file_extents(fpath)
+            self.logger.std(
+                "{fpath}: {extents} extent(s)".format(
+                    fpath=fpath, extents="?" if extents is None else extents
+                )
+            )
+
+    def _on_done(self, content, future):
+        if future.cancelled():
+            return
+        with self.lock:
+            if future.exception() is not None:
+                self.errors.append((content["name"], future.exception()))
+                self.logger.err(
+                    "Failed to process {name}: {exp}".format(
+                        name=content["name"], exp=future.exception()
+                    )
+                )
+                return
+            if future.result() is not None:
+                self.written.append(future.result())
+        self.progress.update(content["name"], get_content_expanded_size(content))
+
+    def shutdown(self, cancel=False):
+        if cancel:
+            for future in self.futures:
+                future.cancel()
+        self.executor.shutdown(wait=True)
+
+    def join(self):
+        """ wait for all actions to complete. raise if any failed """
+        if self.plan_writes:
+            self.run_planned()
+        self.shutdown()
+        self.progress.report()
+        if not self.link_files:  # staged files are not on the data partition
+            self.report_fragmentation()
+        if self.errors:
+            raise IOError(
+                "Failed to process {nb} content(s):\n{errors}".format(
+                    nb=len(self.errors),
+                    errors="\n".join(
+                        " - {}: {}".format(name, exp) for name, exp in self.errors
+                    ),
+                )
+            )
 
 
 def run_edupi_actions(
-    cache_folder, mount_point, logger, enable=False, resources_path=None
+    cache_folder, mount_point, logger, enable=False, resources_path=None, pool=None
 ):
     """ no action for EduPi ; everything within ansiblecube """
     if not enable or not resources_path:
         return
 
-    extract_and_move(
+    run_action(
+        pool,
+        extract_and_move,
         content=get_alien_content(resources_path),
         cache_folder=cache_folder,
         root_path=mount_point,
@@ -333,14 +696,16 @@ def run_edupi_actions(
     )
 
 
-def run_nomad_actions(cache_folder, mount_point, logger, enable=False):
+def run_nomad_actions(cache_folder, mount_point, logger, enable=False, pool=None):
     """ copy downloaded APK """
     if not enable:
         return
 
     nomad_ark = get_content("nomad_zip")
     nomad_folder = os.path.join(mount_point, "nomad")
-    extract_and_move(
+    run_action(
+        pool,
+        extract_and_move,
         content=nomad_ark,
         cache_folder=cache_folder,
         root_path=mount_point,
@@ -349,7 +714,7 @@ def run_nomad_actions(cache_folder, mount_point, logger, enable=False):
     )
 
 
-def run_mathews_actions(cache_folder, mount_point, logger, enable=False):
+def run_mathews_actions(cache_folder, mount_point, logger, enable=False, pool=None):
     """ copy downloaded APK """
     if not enable:
         return
@@ -357,7 +722,9 @@ def run_mathews_actions(cache_folder, mount_point, logger, enable=False):
     mathews_apk = get_content("mathews_apk")
     mathews_folder = os.path.join(mount_point, "mathews")
     os.makedirs(mathews_folder, exist_ok=True)
-    copy(
+    run_action(
+        pool,
+        copy,
         content=mathews_apk,
         cache_folder=cache_folder,
         final_path=os.path.join(mathews_folder, mathews_apk["name"]),
@@ -365,14 +732,16 @@ def run_mathews_actions(cache_folder, mount_point, logger, enable=False):
     )
 
 
-def run_africatik_actions(cache_folder, mount_point, logger, enable=False):
+def run_africatik_actions(cache_folder, mount_point, logger, enable=False, pool=None):
     """ extract ZIP to folder """
     if not enable:
         return
 
     africatik_ark = get_content("africatik_all")
     africatik_folder = os.path.join(mount_point, "africatik")
-    extract_and_move(
+    run_action(
+        pool,
+        extract_and_move,
         content=africatik_ark,
         cache_folder=cache_folder,
         root_path=mount_point,
@@ -381,14 +750,16 @@ def run_africatik_actions(cache_folder, mount_point, logger, enable=False):
     )
 
 
-def run_africatikmd_actions(cache_folder, mount_point, logger, enable=False):
+def run_africatikmd_actions(cache_folder, mount_point, logger, enable=False, pool=None):
     """ extract ZIP to folder """
     if not enable:
         return
 
     africatik_ark = get_content("africatik_md")
     africatik_folder = os.path.join(mount_point, "africatikmd")
-    extract_and_move(
+    run_action(
+        pool,
+        extract_and_move,
         content=africatik_ark,
         cache_folder=cache_folder,
         root_path=mount_point,
@@ -397,7 +768,7 @@ def run_africatikmd_actions(cache_folder, mount_point, logger, enable=False):
     )
 
 
-def run_kalite_actions(cache_folder, mount_point, logger, languages=[]):
+def run_kalite_actions(cache_folder, mount_point, logger, languages=[], pool=None):
     """ kalite: copy lang packs (ZIP) as-is and extract videos """
     if not len(languages):
         return
@@ -406,7 +777,9 @@ def run_kalite_actions(cache_folder, mount_point, logger, languages=[]):
         # language pack
         lang_key = "kalite_langpack_{lang}".format(lang=lang)
         lang_pack = get_content(lang_key)
-        copy(
+        run_action(
+            pool,
+            copy,
             content=lang_pack,
             cache_folder=cache_folder,
             final_path=os.path.join(mount_point, lang_pack["name"]),
@@ -415,7 +788,9 @@ def run_kalite_actions(cache_folder, mount_point, logger, languages=[]):
 
         # videos
         videos = get_content("kalite_videos_{lang}".format(lang=lang))
-        extract_and_move(
+        run_action(
+            pool,
+            extract_and_move,
             content=videos,
             cache_folder=cache_folder,
             root_path=mount_point,
@@ -424,7 +799,7 @@ def run_kalite_actions(cache_folder, mount_point, logger, languages=[]):
         )
 
 
-def run_wikifundi_actions(cache_folder, mount_point, logger, languages=[]):
+def run_wikifundi_actions(cache_folder, mount_point, logger, languages=[], pool=None):
     """ wikifundi: extract all lang packs """
 
     if not len(languages):
@@ -433,7 +808,9 @@ def run_wikifundi_actions(cache_folder, mount_point, logger, languages=[]):
     for lang in languages:
         lang_key = "wikifundi_langpack_{lang}".format(lang=lang)
         content = get_content(lang_key)
-        extract_and_move(
+        run_action(
+            pool,
+            extract_and_move,
             content=content,
             cache_folder=cache_folder,
             root_path=mount_point,
@@ -442,7 +819,7 @@ def run_wikifundi_actions(cache_folder, mount_point, logger, languages=[]):
         )
 
 
-def run_aflatoun_actions(cache_folder, mount_point, logger, languages=[]):
+def run_aflatoun_actions(cache_folder, mount_point, logger, languages=[], pool=None):
     """ aflatoun: copy lang packs (ZIP) as-is and extract content archive """
 
     if not len(languages):
@@ -452,14 +829,18 @@ def run_aflatoun_actions(cache_folder, mount_point, logger, languages=[]):
         # language pack
         lang_key = "aflatoun_langpack_{lang}".format(lang=lang)
         lang_pack = get_content(lang_key)
-        copy(
+        run_action(
+            pool,
+            copy,
             content=lang_pack,
             cache_folder=cache_folder,
             final_path=os.path.join(mount_point, lang_pack["name"]),
             logger=logger,
         )
 
-    extract_and_move(
+    run_action(
+        pool,
+        extract_and_move,
         content=get_content("aflatoun_content"),
         cache_folder=cache_folder,
         root_path=mount_point,
@@ -468,7 +849,7 @@ def run_aflatoun_actions(cache_folder, mount_point, logger, languages=[]):
     )
 
 
-def run_packages_actions(cache_folder, mount_point, logger, packages=[]):
+def run_packages_actions(cache_folder, mount_point, logger, packages=[], pool=None):
     """ ZIM files are used directly by kiwix-serve """
 
     # ensure packages folder exists: must macth `zim_path` in ansiblecube
@@ -477,13 +858,14 @@ def run_packages_actions(cache_folder, mount_point, logger, packages=[]):
 
     for package in packages:
         content = get_package_content(package)
-        logger.std("Copying {p} to {f}".format(p=content["name"], f=packages_folder))
-
-        # retrieve downloaded path
-        package_fpath = get_content_cache(content, cache_folder, True)
-
-        # copy to the packages folder
-        shutil.copy(package_fpath, os.path.join(packages_folder, content["name"]))
+        run_action(
+            pool,
+            copy,
+            content=content,
+            cache_folder=cache_folder,
+            final_path=os.path.join(packages_folder, content["name"]),
+            logger=logger,
+        )
 
 
 def content_is_cached(content, cache_folder, check_sum=False):
@@ -495,37 +877,33 @@ def content_is_cached(content, cache_folder, check_sum=False):
         return False
 
     if check_sum:
-        return get_checksum(content_fpath) == content.get("checksum")
+        return get_trusted_checksum(content_fpath) == content.get("checksum")
 
     return True
 
 
 def get_collection_download_size(collection):
     """ data usage to download all of the collection """
-    return sum([item.get("archive_size") for item in get_all_contents_for(collection)])
+    return as_build_plan(collection).download_size
 
 
 def get_collection_download_size_using_cache(collection, cache_folder):
     """ data usage to download missing elements of the collection """
-    return sum(
-        [
-            item.get("archive_size")
-            for item in get_all_contents_for(collection)
-            if not content_is_cached(item, cache_folder)
-        ]
-    )
+    return as_build_plan(collection).get_download_size_using_cache(cache_folder)
+
+
+def get_content_expanded_size(content):
+    """ measured expanded size of content if known, its estimate otherwise
+
+        both account for the data partition's cluster size """
+    if content.get("checksum") and content["checksum"] in read_expanded_sizes():
+        return read_expanded_sizes()[content["checksum"]]
+    return get_allocated_size(int(content["expanded_size"]))
 
 
 def get_expanded_size(collection, add_margin=True):
     """ sum of extracted sizes of all collection with 10%|2GB margin """
-    total_size = sum(
-        [
-            item.get("expanded_size") * 2
-            if item.get("copied_on_destination", False)
-            else item.get("expanded_size")
-            for item in get_all_contents_for(collection)
-        ]
-    )
+    total_size = as_build_plan(collection).expanded_size
 
     # add a 2% margin ; make sure it's at least 512MB
     margin = max([512 * ONE_MB, total_size * 0.02]) if add_margin else 0
@@ -537,7 +915,7 @@ def get_required_image_size(collection):
         [
             get_content("hotspot_master_image").get("root_partition_size"),
             get_expanded_size(collection),
-            ONE_MB * 256  # make sure we have some free space
+            ONE_MB * 256,  # make sure we have some free space
         ]
     )
 
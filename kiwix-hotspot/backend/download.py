@@ -6,17 +6,54 @@ import re
 import sys
 import time
 import shutil
+import uuid
+import hashlib
+import tarfile
 import zipfile
+import tempfile
+import threading
 import subprocess
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
 
 from data import data_dir, http_proxy_test_url, https_proxy_test_url
-from util import get_checksum, get_cache, get_prefs
-from backend.util import subprocess_pretty_check_call, startup_info_args
+from util import get_cache, get_prefs, human_readable_size
+from util import get_checksum, get_trusted_checksum, record_checksum
+from util import read_recorded_checksum, get_tmp_fpath
+from util import record_last_used, ONE_MiB
+from util import read_expanded_sizes, record_expanded_size
+from backend.exfat import get_allocated_size
+from backend.util import (
+    subprocess_pretty_check_call,
+    startup_info_args,
+    get_free_port,
+    CheckCallException,
+    COPY_BUFFER_SIZE,
+    write_sparse,
+)
 
 PROXIES = None
+SESSION = None
+# seconds a remote file's probed metadata (size, etag, last-modified) is trusted
+REMOTE_METADATA_TTL = 600
+REMOTE_METADATA = {}
+REMOTE_METADATA_LOCK = threading.Lock()
 FAILURE_RETRIES = 6
+# tar flag for compressed archives read from stdin (no auto-detection there)
+TAR_COMPRESSION_FLAGS = {"gz": ["-z"], "bz2": ["-j"], "xz": ["-J"], "zst": ["--zstd"]}
+# multithreaded decompressors to pass to tar, by archive type and preference
+DECOMPRESSORS = {
+    "gz": [["pigz"]],
+    "bz2": [["lbzip2"], ["pbzip2"]],
+    "xz": [["pixz"], ["xz", "-T0"]],
+    "zst": [["zstd", "-T0"]],
+}
+# number of contents downloaded simultaneously by the DownloadScheduler
+max_concurrent_downloads = int(os.getenv("DOWNLOAD_CONCURRENCY", 4))
+# number of simultaneous downloads from a single host
+max_downloads_per_host = int(os.getenv("DOWNLOAD_PER_HOST", 2))
 szip_exe = os.path.join(data_dir, "7za.exe")
 
 if sys.platform == "win32":
@@ -24,6 +61,33 @@ if sys.platform == "win32":
 else:
     aria2_exe = os.path.join(data_dir, "aria2c")
 
+# aria2c options shared by console and RPC downloads
+aria2_options = {
+    "connect-timeout": "60",
+    "max-file-not-found": "5",
+    "max-tries": "5",
+    "retry-wait": "60",
+    "timeout": "60",
+    "follow-metalink": "true",
+    "allow-overwrite": "true",
+    "always-resume": "false",
+    "max-resume-failure-tries": "1",
+    "auto-file-renaming": "false",
+    "log-level": "error",
+    "console-log-level": "error",
+    "ca-certificate": os.path.join(data_dir, "ca-certificates.crt"),
+}
+
+
+def get_aria2_file_options(fpath):
+    """ per-download aria2c options to save into fpath """
+    output_dir, fname = os.path.split(fpath)
+    options = {"dir": output_dir, "out": fname}
+    # zip* files might send incorrect gzip header and get auto-extracted by aria2
+    if not fname.endswith("zip"):
+        options.update({"http-accept-gzip": "true"})
+    return options
+
 
 def read_proxies(load_env=True):
     """ read proxy configuration from pref file or ENV """
@@ -52,6 +116,59 @@ def get_proxies(load_env=True, force_reload=False):
     return PROXIES
 
 
+def get_session():
+    """ shared HTTP session (pooled connections) for metadata requests """
+    global SESSION
+    if SESSION is None:
+        SESSION = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=max_concurrent_downloads)
+        SESSION.mount("http://", adapter)
+        SESSION.mount("https://", adapter)
+    return SESSION
+
+
+def get_remote_metadata(url):
+    """ {size, etag, last_modified} of a remote file (cached for a while) """
+    with REMOTE_METADATA_LOCK:
+        if url in REMOTE_METADATA:
+            probed_on, metadata = REMOTE_METADATA[url]
+            if time.time() - probed_on < REMOTE_METADATA_TTL:
+                return metadata
+
+    resp = get_session().head(
+        url, proxies=get_proxies(), timeout=20, allow_redirects=True
+    )
+    resp.raise_for_status()
+    metadata = {
+        "size": int(resp.headers["Content-Length"]),
+        "etag": resp.headers.get("ETag"),
+        "last_modified": resp.headers.get("Last-Modified"),
+    }
+    with REMOTE_METADATA_LOCK:
+        REMOTE_METADATA[url] = (time.time(), metadata)
+    return metadata
+
+
+def probe_remote_files(urls, concurrency=None):
+    """ fetch metadata of all urls concurrently so later calls are cached
+
+        returns {url: metadata or exception} """
+    urls = list(set(urls))
+    if not urls:
+        return {}
+
+    def probe(url):
+        try:
+            return get_remote_metadata(url)
+        except Exception as exp:
+            return exp
+
+    with ThreadPoolExecutor(
+        max_workers=min([len(urls), concurrency or max_concurrent_downloads])
+    ) as executor:
+        return dict(zip(urls, executor.map(probe, urls)))
+
+
 class RequestedFile(object):
     """ interface to harmonize result of file request """
 
@@ -113,11 +230,11 @@ class RequestedFile(object):
     @property
     def verified(self):
         return self.present and (
-            get_checksum(self.fpath) == self.checksum or self.checksum is None
+            self.checksum is None or get_trusted_checksum(self.fpath) == self.checksum
         )
 
 
-def download_file(url, fpath, logger, checksum=None, debug=False):
+def download_file(url, fpath, logger, checksum=None, debug=False, progress_cb=None):
 
     """ download an URL into a named path and reports progress to logger
 
@@ -128,31 +245,25 @@ def download_file(url, fpath, logger, checksum=None, debug=False):
 
         supports metalink. if link is metalink, downloads both then replace
         actual target (aria2 doesn't allow setting target for metalink
-        as it can be multiple files) """
+        as it can be multiple files)
+
+        progress_cb: if set, called with (downloaded_size, total_size) instead
+        of displaying progress on the logger (used for concurrent downloads) """
 
     output_dir, fname = os.path.split(fpath)
-    args = [aria2_exe, "--dir={}".format(output_dir), "--out={}".format(fname)]
-    args += [
-        "--connect-timeout=60",
-        "--max-file-not-found=5",
-        "--max-tries=5",
-        "--retry-wait=60",
-        "--timeout=60",
-        "--follow-metalink=true",
-        "--allow-overwrite=true",
-        "--always-resume=false",
-        "--max-resume-failure-tries=1",
-        "--auto-file-renaming=false",
-        "--download-result=full",
-        "--log-level=error",
-        "--console-log-level=error",
-        "--summary-interval=1",  # display a line with progress every X seconds
-        "--human-readable={}".format(str(logger.on_tty).lower()),
-        "--ca-certificate={}".format(os.path.join(data_dir, "ca-certificates.crt")),
+    options = dict(aria2_options)
+    options.update(get_aria2_file_options(fpath))
+    options.update(
+        {
+            "download-result": "full",
+            # display a line with progress every X seconds
+            "summary-interval": "1",
+            "human-readable": str(logger.on_tty and progress_cb is None).lower(),
+        }
+    )
+    args = [aria2_exe] + [
+        "--{key}={value}".format(key=key, value=value) for key, value in options.items()
     ]
-    # zip* files might send incorrect gzip header and get auto-extracted by aria2
-    if not fname.endswith("zip"):
-        args += ["--http-accept-gzip=true"]
     args += [url]
 
     aria2c = subprocess.Popen(
@@ -161,7 +272,7 @@ def download_file(url, fpath, logger, checksum=None, debug=False):
     if debug:
         logger.std(" ".join(args))
 
-    if not logger.on_tty:
+    if not logger.on_tty and progress_cb is None:
         logger.ascii_progressbar(0, 100)
 
     metalink_target = None
@@ -169,7 +280,11 @@ def download_file(url, fpath, logger, checksum=None, debug=False):
         line = line.strip()
         # [#915371 5996544B/90241109B(6%) CN:4 DL:1704260B ETA:49s]
         if line.startswith("[#") and line.endswith("]"):  # quick check, no re
-            if logger.on_tty:
+            if progress_cb is not None:
+                match = re.search(r"\s([0-9]+)B\/([0-9]+)B", line)
+                if match:
+                    progress_cb(*[int(x) for x in match.groups()])
+            elif logger.on_tty:
                 logger.flash(line + "                    ")
             else:
                 try:
@@ -196,7 +311,8 @@ def download_file(url, fpath, logger, checksum=None, debug=False):
         except subprocess.TimeoutError:
             aria2c.terminate()
 
-    logger.std("")  # clear last \r
+    if progress_cb is None:
+        logger.std("")  # clear last \r
 
     if not aria2c.returncode == 0:
         return RequestedFile.from_failure(
@@ -220,20 +336,276 @@ def download_file(url, fpath, logger, checksum=None, debug=False):
     return RequestedFile.from_download(url, fpath, os.path.getsize(fpath))
 
 
-def download_if_missing(url, fpath, logger, checksum=None):
-    """ returns local file if existing and matching sum otherwise download """
+class Aria2RPC(object):
+    """ long-lived aria2c process driven through its JSON-RPC interface
+
+        all downloads of a build are queued into a single aria2c
+        (one process launch, reused connections) and their status
+        is polled via aria2.tellStatus for exact sizes and file paths """
+
+    poll_interval = 1  # seconds between two status requests
+    start_timeout = 30  # seconds to wait for the RPC interface to be ready
+    status_keys = [
+        "gid",
+        "status",
+        "totalLength",
+        "completedLength",
+        "downloadSpeed",
+        "errorCode",
+        "errorMessage",
+        "followedBy",
+        "files",
+    ]
+
+    def __init__(self, logger, max_concurrent=None):
+        self.logger = logger
+        self.max_concurrent = max([max_concurrent or max_concurrent_downloads, 1])
+        self.port = None
+        self.secret = None
+        self.process = None
+        self._local = threading.local()  # downloads are waited from many threads
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{port}/jsonrpc".format(port=self.port)
+
+    @property
+    def session(self):
+        """ this thread's HTTP session to aria2c (requests' are not thread-safe) """
+        if getattr(self._local, "session", None) is None:
+            self._local.session = requests.Session()
+            # never use proxies to reach localhost
+            self._local.session.trust_env = False
+        return self._local.session
+
+    @property
+    def running(self):
+        return self.process is not None and self.process.poll() is None
+
+    def start(self):
+        """ launch aria2c in RPC mode and wait for it to answer """
+        self.port = get_free_port()
+        self.secret = uuid.uuid4().hex
+        options = dict(aria2_options)
+        options.update(
+            {
+                "enable-rpc": "true",
+                "rpc-listen-all": "false",
+                "rpc-listen-port": str(self.port),
+                "rpc-secret": self.secret,
+                "max-concurrent-downloads": str(self.max_concurrent),
+                "stop-with-process": str(os.getpid()),
+            }
+        )
+        args = [aria2_exe] + [
+            "--{key}={value}".format(key=key, value=value)
+            for key, value in options.items()
+        ]
+        self.logger.std(
+            "Starting aria2c RPC on port {port}: {args}".format(
+                port=self.port, args=" ".join(args).replace(self.secret, "****")
+            )
+        )
+        self.process = subprocess.Popen(
+            args,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            **startup_info_args()
+        )
+
+        started_on = time.time()
+        while True:
+            try:
+                version = self.call("aria2.getVersion")
+            except Exception as exp:
+                if not self.running or time.time() - started_on > self.start_timeout:
+                    self.stop()
+                    raise IOError("Unable to start aria2c RPC: {}".format(exp))
+                time.sleep(0.5)
+            else:
+                self.logger.std("aria2c {} RPC ready".format(version["version"]))
+                return self
+
+    def stop(self):
+        """ shutdown aria2c """
+        if self.process is None:
+            return
+        try:
+            self.call("aria2.shutdown")
+            self.process.wait(timeout=10)
+        except Exception:
+            self.process.terminate()
+        self.process = None
+
+    def call(self, method, *params):
+        """ result of a JSON-RPC call to aria2c. raises on RPC errors """
+        resp = self.session.post(
+            self.url,
+            json={
+                "jsonrpc": "2.0",
+                "id": uuid.uuid4().hex,
+                "method": method,
+                "params": ["token:{}".format(self.secret)] + list(params),
+            },
+            timeout=30,
+        )
+        payload = resp.json()
+        if "error" in payload:
+            raise IOError(
+                "aria2c RPC {method} failed: {err}".format(
+                    method=method, err=payload["error"].get("message")
+                )
+            )
+        return payload["result"]
+
+    def add(self, url, fpath):
+        """ queue download of url into fpath. returns its GID """
+        return self.call("aria2.addUri", [url], get_aria2_file_options(fpath))
+
+    def status(self, gid):
+        return self.call("aria2.tellStatus", gid, self.status_keys)
+
+    def wait(self, gid, logger, progress_cb=None):
+        """ final status of a GID (and its metalink followers) once finished
+
+            a metalink GID completes as soon as its followers are queued:
+            all of them are waited for. returns first failed one's status or
+            the last follower's (the actual download) """
+        pending = [gid]
+        statuses = {}  # latest status of GIDs doing actual downloads
+        while pending:
+            for current in list(pending):
+                status = self.status(current)
+                statuses[current] = status
+                if status["status"] in ("active", "waiting", "paused"):
+                    continue
+
+                pending.remove(current)
+                try:
+                    self.call("aria2.removeDownloadResult", current)
+                except Exception:
+                    pass
+
+                # metalink: actual download is made by the followers
+                if status["status"] == "complete" and status.get("followedBy"):
+                    del statuses[current]
+                    pending += status["followedBy"]
+
+            self.report(gid, list(statuses.values()), logger, progress_cb)
+            if pending:
+                time.sleep(self.poll_interval)
+
+        finished = list(statuses.values())
+        failed = [status for status in finished if status["status"] != "complete"]
+        return failed[0] if failed else finished[-1]
+
+    @staticmethod
+    def report(gid, statuses, logger, progress_cb=None):
+        """ aggregate progress of a download's statuses """
+        completed = sum([int(status["completedLength"]) for status in statuses])
+        total = sum([int(status["totalLength"]) for status in statuses])
+        if progress_cb is not None:
+            progress_cb(completed, total)
+        elif logger.on_tty:
+            logger.flash(
+                "[#{gid} {completed}/{total} DL:{speed}]".format(
+                    gid=gid[:6],
+                    completed=human_readable_size(completed),
+                    total=human_readable_size(total),
+                    speed=human_readable_size(
+                        sum([int(status["downloadSpeed"]) for status in statuses])
+                    ),
+                )
+                + "                    "
+            )
+        else:
+            logger.ascii_progressbar(completed, total or -1)
+
+    def download(self, url, fpath, logger, checksum=None, progress_cb=None):
+        """ download an URL into a named path via aria2c RPC """
+        try:
+            status = self.wait(self.add(url, fpath), logger, progress_cb)
+        except Exception as exp:
+            return RequestedFile.from_failure(url, fpath, exp, checksum)
+
+        if progress_cb is None:
+            logger.std("")  # clear last \r
+
+        if status["status"] != "complete":
+            return RequestedFile.from_failure(
+                url,
+                fpath,
+                ValueError(
+                    "aria2c download {status}: {code} {msg}".format(
+                        status=status["status"],
+                        code=status.get("errorCode"),
+                        msg=status.get("errorMessage"),
+                    )
+                ),
+                checksum,
+            )
+
+        # metalink targets are named after the metalink content
+        target = os.path.abspath(status["files"][0]["path"])
+        if target != os.path.abspath(fpath):
+            logger.std(".. mv {src} {dst}".format(src=target, dst=fpath))
+            os.replace(target, fpath)
+
+        return RequestedFile.from_download(url, fpath, os.path.getsize(fpath))
+
+
+def download_if_missing(
+    url, fpath, logger, checksum=None, progress_cb=None, aria2=None
+):
+    """ returns local file if existing and matching sum otherwise download
+
+        aria2: an Aria2RPC to queue the download into (separate aria2c if None) """
 
     # file already downloaded
     if checksum and os.path.exists(fpath):
         logger.std("calculating sum for {}...".format(fpath), "")
-        if get_checksum(fpath) == checksum:
+        if get_trusted_checksum(fpath) == checksum:
             logger.std("MATCH.")
             return RequestedFile.from_disk(url, fpath, checksum)
         logger.std("MISMATCH.")
     elif os.path.exists(fpath):
         return RequestedFile.from_disk(url, fpath)
 
-    return download_file(url, fpath, logger, checksum, debug=True)
+    if aria2 is not None:
+        rf = aria2.download(url, fpath, logger, checksum, progress_cb=progress_cb)
+    else:
+        rf = download_file(
+            url, fpath, logger, checksum, debug=True, progress_cb=progress_cb
+        )
+    if not rf.downloaded:
+        return rf
+
+    # single pass on the freshly written file (still in page cache)
+    # recorded so the file is never hashed again while unchanged
+    rf.checksum = get_checksum(fpath)
+    try:
+        record_checksum(fpath, rf.checksum)
+    except OSError as exp:
+        # only spares a later hashing: never fails the download
+        logger.err("Unable to record checksum of {}: {}".format(fpath, exp))
+    if checksum and rf.checksum != checksum:
+        return RequestedFile.from_failure(
+            url,
+            fpath,
+            ValueError(
+                "checksum mismatch for {}: {} (expected {})".format(
+                    fpath, rf.checksum, checksum
+                )
+            ),
+            checksum,
+        )
+    return rf
 
 
 def test_connection(proxies=None):
@@ -253,14 +625,259 @@ def get_content_cache(content, folder, is_cache_folder=False):
     return os.path.join(cache_folder, content.get("name"))
 
 
-def download_content(content, logger, build_folder):
+def download_content(content, logger, build_folder, progress_cb=None, aria2=None):
     """ download or retrieve an item from contents """
-    return download_if_missing(
+    rf = download_if_missing(
         url=content.get("url"),
         fpath=get_content_cache(content, build_folder),
         logger=logger,
         checksum=content.get("checksum"),
+        progress_cb=progress_cb,
+        aria2=aria2,
     )
+    if rf.successful:
+        # keep track of usage for the cache eviction policy
+        try:
+            record_last_used(rf.fpath)
+        except OSError as exp:
+            logger.err("Unable to record usage of {}: {}".format(rf.fpath, exp))
+        # measure archive while it's in page cache (when it doesn't cost much)
+        checksum = content.get("checksum")
+        if checksum and checksum not in read_expanded_sizes():
+            try:
+                expanded_size = get_archive_expanded_size(rf.fpath)
+                if expanded_size is not None:
+                    record_expanded_size(checksum, expanded_size)
+            except Exception as exp:
+                logger.err("Unable to measure {}: {}".format(rf.fpath, exp))
+    return rf
+
+
+class DownloadScheduler(object):
+    """ download or retrieve a list of contents concurrently
+
+        at most `concurrency` contents are retrieved at once and at most
+        `per_host` of those from the same host.
+        aggregate (bytes) progress is reported to the logger
+
+        results are RequestedFile, in the order of the supplied contents.
+        once a content failed, pending ones are not started but failed too
+
+        aria2: an Aria2RPC to queue downloads into (one aria2c per file if None)
+
+        report_progress: whether to set the logger's stage progress.
+        should be False when running in background of another stage
+
+        cancel_event: a CancelEvent stopping further downloads once set """
+
+    report_interval = 5  # seconds between two progress reports
+    wait_interval = 1  # seconds between two checks of cancellation and workers
+    background_report_interval = 60  # same, when not reporting stage progress
+
+    def __init__(
+        self,
+        contents,
+        logger,
+        build_folder,
+        concurrency=None,
+        per_host=None,
+        aria2=None,
+        report_progress=True,
+        cancel_event=None,
+    ):
+        self.contents = list(contents)
+        self.logger = logger
+        self.build_folder = build_folder
+        self.aria2 = aria2
+        self.cancel_event = cancel_event
+        self.report_progress = report_progress
+        if not report_progress:
+            self.report_interval = self.background_report_interval
+        self.concurrency = max([concurrency or max_concurrent_downloads, 1])
+        self.per_host = max([per_host or max_downloads_per_host, 1])
+
+        self.total_size = sum([c["archive_size"] for c in self.contents])
+        self.results = [None] * len(self.contents)
+        self.progresses = [0] * len(self.contents)
+
+        self._pending = list(range(len(self.contents)))
+        self._hosts = {}  # number of running downloads per host
+        self._lock = threading.Condition()
+        self._workers = []
+        self._last_report = None
+
+    @staticmethod
+    def get_host(content):
+        return urlparse(content.get("url") or "").netloc
+
+    @property
+    def downloaded_size(self):
+        return sum(self.progresses)
+
+    @property
+    def cancelled(self):
+        return self.cancel_event is not None and self.cancel_event.is_set()
+
+    def start(self):
+        """ launch the download workers (non-blocking) """
+        self._last_report = time.time()
+        for _ in range(min([self.concurrency, len(self.contents)])):
+            worker = threading.Thread(target=self._work, daemon=True)
+            worker.start()
+            self._workers.append(worker)
+        return self
+
+    def join(self):
+        """ wait for all downloads to complete. returns list of RequestedFile """
+        for worker in self._workers:
+            worker.join()
+        self.report(force=True)
+        return self.results
+
+    def run(self):
+        """ start and wait for all downloads """
+        return self.start().join()
+
+    def wait_for(self, contents):
+        """ wait for specific contents to be retrieved. returns their results
+
+            results are None for contents workers didn't retrieve (died) """
+        names = [content["name"] for content in contents]
+        indexes = [
+            index
+            for index, content in enumerate(self.contents)
+            if content["name"] in names
+        ]
+        with self._lock:
+            while [index for index in indexes if self.results[index] is None]:
+                if self.cancelled:
+                    raise IOError("Downloads cancelled")
+                if not [worker for worker in self._workers if worker.is_alive()]:
+                    break
+                self._lock.wait(timeout=self.wait_interval)
+        return [self.results[index] for index in indexes]
+
+    def get_failures(self):
+        """ results of contents that failed so far (downloads may still run) """
+        with self._lock:
+            return [rf for rf in self.results if rf is not None and not rf.successful]
+
+    def _next_index(self):
+        """ index of first pending content whose host is not saturated """
+        for index in self._pending:
+            if self._hosts.get(self.get_host(self.contents[index]), 0) < self.per_host:
+                return index
+
+    def _work(self):
+        while True:
+            with self._lock:
+                index = self._next_index()
+                while index is None and self._pending and not self.cancelled:
+                    self._lock.wait(timeout=self.wait_interval)
+                    index = self._next_index()
+                if self.cancelled:
+                    self._abort("cancelled")
+                    return
+                if index is None:
+                    return
+                self._pending.remove(index)
+                host = self.get_host(self.contents[index])
+                self._hosts[host] = self._hosts.get(host, 0) + 1
+
+            try:
+                self.results[index] = self._retrieve(index)
+            except Exception as exp:
+                self.results[index] = self.get_failure(index, exp)
+            finally:
+                with self._lock:
+                    self._hosts[host] -= 1
+                    rf = self.results[index]
+                    if rf is None or not rf.successful:
+                        self._abort(
+                            "download of {} failed".format(self.contents[index]["name"])
+                        )
+                    self._lock.notify_all()
+
+    def get_failure(self, index, exception):
+        """ failed RequestedFile for a content """
+        content = self.contents[index]
+        return RequestedFile.from_failure(
+            content.get("url"),
+            get_content_cache(content, self.build_folder),
+            exception,
+            content.get("checksum"),
+        )
+
+    def _abort(self, reason):
+        """ fail all pending contents: build can't complete anyway (under lock) """
+        for index in self._pending:
+            self.results[index] = self.get_failure(
+                index, IOError("not retrieved: {}".format(reason))
+            )
+        self._pending = []
+        self._lock.notify_all()
+
+    def _retrieve(self, index):
+        content = self.contents[index]
+
+        def on_progress(downloaded_size, total_size):
+            self.progresses[index] = downloaded_size
+            self.report()
+
+        self.logger.std(
+            "Retrieving {name} ({size})".format(
+                name=content["name"], size=human_readable_size(content["archive_size"])
+            )
+        )
+        try:
+            rf = download_content(
+                content,
+                self.logger,
+                self.build_folder,
+                progress_cb=on_progress,
+                aria2=self.aria2,
+            )
+        except Exception as exp:
+            rf = self.get_failure(index, exp)
+
+        if not rf.successful:
+            self.logger.err(
+                "Error downloading {u} to {p}\n{e}".format(
+                    u=content["url"], p=rf.fpath, e=rf.exception
+                )
+            )
+        elif rf.found:
+            self.logger.std("Reusing already downloaded {p}".format(p=rf.fpath))
+        else:
+            self.logger.std(
+                "Saved `{p}` successfuly: {s}".format(
+                    p=content["name"], s=human_readable_size(rf.downloaded_size)
+                )
+            )
+        self.progresses[index] = content["archive_size"]
+        self.report()
+        return rf
+
+    def report(self, force=False):
+        """ send aggregate progress to logger (at most every report_interval) """
+        now = time.time()
+        if not force and now - self._last_report < self.report_interval:
+            return
+        self._last_report = now
+
+        done = len([rf for rf in self.results if rf is not None])
+        self.logger.std(
+            "Downloads: {done}/{total} contents, {dl} of {size}".format(
+                done=done,
+                total=len(self.contents),
+                dl=human_readable_size(min([self.downloaded_size, self.total_size])),
+                size=human_readable_size(self.total_size),
+            )
+        )
+        if self.report_progress:
+            self.logger.progress(
+                min([self.downloaded_size, self.total_size]), self.total_size
+            )
 
 
 def unzip_file(archive_fpath, src_fname, build_folder, dest_fpath=None):
@@ -271,26 +888,227 @@ def unzip_file(archive_fpath, src_fname, build_folder, dest_fpath=None):
             shutil.move(extraction, dest_fpath)
 
 
-def unzip_archive(archive_fpath, dest_folder):
-    """ extracts a ZIP archive (all files) """
+def get_extracted_master_fname(base_image):
+    """ filename of the master image once extracted from its ZIP """
+    return base_image["name"].replace(".zip", "")
+
+
+def extract_master_image(archive_fpath, base_image, cache_folder, logger):
+    """ path of the master image extracted (once) into the cache
+
+        extraction is CRC-checked and sparse (zero blocks not written).
+        its checksum is recorded so it's reused only if unchanged since """
+    fname = get_extracted_master_fname(base_image)
+    fpath = os.path.join(cache_folder, fname)
+    if os.path.exists(fpath) and read_recorded_checksum(fpath):
+        logger.std("Reusing extracted base image from cache")
+        return fpath
+
+    logger.std("Extracting base image into cache")
+    tmp_fpath = get_tmp_fpath(fpath)
+    hasher = hashlib.sha256()
+    try:
+        with zipfile.ZipFile(archive_fpath, "r") as zip_archive:
+            with zip_archive.open(fname) as src, open(tmp_fpath, "wb") as dst:
+                offset = 0
+                for chunk in iter(lambda: src.read(COPY_BUFFER_SIZE), b""):
+                    hasher.update(chunk)
+                    write_sparse(dst, offset, chunk)
+                    offset += len(chunk)
+                dst.truncate(offset)
+        os.replace(tmp_fpath, fpath)
+    except Exception:
+        if os.path.exists(tmp_fpath):
+            os.unlink(tmp_fpath)
+        raise
+    try:
+        record_checksum(fpath, hasher.hexdigest())
+    except OSError as exp:
+        # extracted again on next use
+        logger.err("Unable to record checksum of {}: {}".format(fpath, exp))
+    return fpath
+
+
+def unzip_archive(archive_fpath, dest_folder, strip_prefix=None, progress_cb=None):
+    """ extracts a ZIP archive (all files or those within strip_prefix)
+
+        progress_cb: called with (extracted, total) uncompressed bytes
+        returns space used by extracted members on the data partition """
     with zipfile.ZipFile(archive_fpath) as zip_archive:
-        zip_archive.extractall(dest_folder)
-
+        members = zip_archive.infolist()
+        if strip_prefix:
+            prefix = strip_prefix.strip("/") + "/"
+            members = [
+                member
+                for member in members
+                if member.filename.startswith(prefix) and member.filename != prefix
+            ]
+            for member in members:
+                # extracted to the stripped path (read using original name)
+                member.filename = member.filename[len(prefix) :]
+
+        total = sum([member.file_size for member in members])
+        extracted = 0
+        for member in members:
+            zip_archive.extract(member, dest_folder)
+            extracted += member.file_size
+            if progress_cb is not None:
+                progress_cb(extracted, total)
+        return get_zip_allocated_size(members)
+
+
+def get_zip_allocated_size(members):
+    """ space used on the data partition by extracted ZIP members """
+    return sum(
+        [
+            get_allocated_size(1 if member.is_dir() else member.file_size)
+            for member in members
+        ]
+    )
 
-def unarchive(archive_fpath, dest_folder, logger):
-    """ extracts a supported archive to a specified folder """
 
-    supported_extensions = (".zip", ".tar", ".tar.bz2", ".tar.gz", ".tar.xz")
+def get_archive_expanded_size(fpath):
+    """ space archive's members would use on the data partition. or None
+
+        read from its index, for formats that don't require decompression:
+        ZIP (central directory) and uncompressed tar (headers) """
+    if fpath.endswith(".zip"):
+        with zipfile.ZipFile(fpath) as zip_archive:
+            return get_zip_allocated_size(zip_archive.infolist())
+    if fpath.endswith(".tar"):
+        # uncompressed tar: data blocks are seeked over, only headers are read
+        with tarfile.open(fpath, "r:") as tar_archive:
+            return sum(
+                [
+                    get_allocated_size(1 if member.isdir() else member.size)
+                    for member in tar_archive
+                ]
+            )
+    return None
+
+
+def get_tar_listing_allocated_size(lines, strip_prefix=None):
+    """ space used on the data partition by members of a tar verbose listing
+
+        lines are tar -vv's: <mode> <owner/group> <size> <date> <time> <name>.
+        links and special files (not extracted on exfat) are not counted,
+        nor the stripped strip_prefix folder itself """
+    total = 0
+    for line in lines:
+        fields = line.split(None, 5)
+        if len(fields) < 6 or not fields[2].isdigit():
+            continue
+        if strip_prefix and fields[5].rstrip("\n").rstrip("/") == strip_prefix:
+            continue
+        if fields[0].startswith("d"):
+            total += get_allocated_size(1)
+        elif fields[0].startswith("-"):
+            total += get_allocated_size(int(fields[2]))
+    return total
+
+
+def pipe_into_command(command, fpath, logger, progress_cb=None):
+    """ run command with fpath's content as stdin. output lines
+
+        raise on non-zero return code
+        progress_cb: called with (fed, total) bytes of fpath fed to command """
+    process = subprocess.Popen(
+        command,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        **startup_info_args()
+    )
+    logger.std("Call: " + str(process.args))
+
+    # drain output while feeding input so the command never blocks on it
+    lines = []
+    reader = threading.Thread(target=lambda: lines.extend(process.stdout.readlines()))
+    reader.start()
+
+    total = os.path.getsize(fpath)
+    fed = 0
+    try:
+        with open(fpath, "rb") as fd:
+            for chunk in iter(lambda: fd.read(ONE_MiB * 4), b""):
+                process.stdin.write(chunk)
+                fed += len(chunk)
+                if progress_cb is not None:
+                    progress_cb(fed, total)
+        process.stdin.close()
+    except BrokenPipeError:
+        pass  # command exited early: return code tells why
+
+    process.wait()
+    reader.join()
+    lines = [line.decode("utf-8", "ignore") for line in lines]
+    for line in lines:
+        logger.raw_std(line)
+
+    if process.returncode != 0:
+        raise CheckCallException("Process %s failed" % process.args)
+    return lines
+
+
+def get_decompressor(compression):
+    """ command of the preferred available decompressor for compression or None
+
+        disabled by setting NO_DECOMPRESSORS """
+    if os.getenv("NO_DECOMPRESSORS", "").lower() in ("1", "yes", "true"):
+        return None
+    for command in DECOMPRESSORS.get(compression, []):
+        if shutil.which(command[0]):
+            return command
+    return None
+
+
+def get_tar_compression_args(archive_fpath, logger):
+    """ tar arguments to decompress archive_fpath (logged) """
+    compression = archive_fpath.rsplit(".", 1)[-1]
+    if compression not in TAR_COMPRESSION_FLAGS:
+        return []
+
+    decompressor = get_decompressor(compression)
+    if decompressor is None:
+        logger.std("Decompressing {} using tar".format(compression))
+        return TAR_COMPRESSION_FLAGS[compression]
+
+    logger.std("Decompressing {} using {}".format(compression, " ".join(decompressor)))
+    return ["--use-compress-program={}".format(" ".join(decompressor))]
+
+
+def unarchive(archive_fpath, dest_folder, logger, strip_prefix=None, progress_cb=None):
+    """ extracts a supported archive to a specified folder
+
+        strip_prefix: only extract members of this archive folder,
+        removing it from their path (not supported on windows)
+        progress_cb: called with (done, total) bytes (not on windows)
+
+        returns space used by extracted files on the data partition (bytes)
+        if known (not on windows nor macOS for tar archives) """
+
+    supported_extensions = (
+        ".zip",
+        ".tar",
+        ".tar.bz2",
+        ".tar.gz",
+        ".tar.xz",
+        ".tar.zst",
+    )
     if sum([1 for ext in supported_extensions if archive_fpath.endswith(ext)]) == 0:
         raise NotImplementedError(
             "Archive format extraction not supported: {}".format(archive_fpath)
         )
 
     if archive_fpath.endswith(".zip"):
-        unzip_archive(archive_fpath, dest_folder)
-        return
+        return unzip_archive(archive_fpath, dest_folder, strip_prefix, progress_cb)
 
     if sys.platform == "win32":
+        if strip_prefix:
+            raise NotImplementedError("Can't strip path prefix from tar using 7z")
+        if archive_fpath.endswith(".zst"):
+            raise NotImplementedError("Can't decompress zstd archives using 7z")
+
         # 7z does not natively support uncompressing tar.xx in one step
         if re.match(r".*\.tar\.(bz2|gz|xz)$", archive_fpath):
             win_unarchive_compressed_tar_pipe(archive_fpath, dest_folder, logger)
@@ -300,7 +1118,36 @@ def unarchive(archive_fpath, dest_folder, logger):
     else:
         tar_exe = "/usr/bin/tar" if sys.platform == "darwin" else "/bin/tar"
         # using -o and -m as exfat dont support mod times and ownership is different
-        command = [tar_exe, "-C", dest_folder, "-x", "-m", "-o", "-f", archive_fpath]
+        command = [tar_exe, "-C", dest_folder, "-x", "-m", "-o"]
+        command += get_tar_compression_args(archive_fpath, logger)
+        # archive fed through stdin to count bytes read by tar
+        command += ["-f", "-" if progress_cb is not None else archive_fpath]
+        # GNU tar lists extracted members (with sizes) into a file as it goes:
+        # measured without walking the extracted tree (mount-point)
+        index_fpath = None
+        if sys.platform != "darwin":
+            index_fd, index_fpath = tempfile.mkstemp(suffix=".tar-index")
+            os.close(index_fd)
+            command += ["-v", "-v", "--index-file={}".format(index_fpath)]
+        if strip_prefix:
+            strip_prefix = strip_prefix.strip("/")
+            command += [
+                "--strip-components={}".format(len(strip_prefix.split("/"))),
+                strip_prefix,
+            ]
+
+        try:
+            if progress_cb is not None:
+                pipe_into_command(command, archive_fpath, logger, progress_cb)
+            else:
+                subprocess_pretty_check_call(command, logger)
+            if index_fpath is None:
+                return None
+            with open(index_fpath, "r", encoding="utf-8", errors="ignore") as fd:
+                return get_tar_listing_allocated_size(fd, strip_prefix)
+        finally:
+            if index_fpath is not None:
+                os.unlink(index_fpath)
 
     subprocess_pretty_check_call(command, logger)
 
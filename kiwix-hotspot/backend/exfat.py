@@ -0,0 +1,495 @@
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+""" userspace exFAT filesystem builder
+
+    lays out a complete exFAT filesystem inside an image file (at the offset
+    of the data partition) from a manifest of (source, destination) pairs.
+    requires neither loop devices, FUSE nor elevated rights.
+
+    every file and folder is allocated contiguously (no FAT chain needed)
+    and file data is written sequentially, largest files first. """
+
+import os
+import array
+import errno
+import struct
+import datetime
+
+from util import ONE_MiB, ONE_GiB, EXFAT_FORBIDDEN_CHARS
+from backend.util import COPY_BUFFER_SIZE
+
+SECTOR_SIZE = 512
+SECTOR_SHIFT = 9
+ENTRY_SIZE = 32
+NAME_CHARS_PER_ENTRY = 15
+MAX_NAME_LENGTH = 255
+MAX_LABEL_LENGTH = 11
+BOOT_REGION_SECTORS = 12
+FIRST_CLUSTER = 2
+FAT_ALIGNMENT = ONE_MiB  # FAT and cluster heap aligned, like mkfs.exfat
+
+ATTR_DIRECTORY = 0x10
+ATTR_ARCHIVE = 0x20
+
+ENTRY_BITMAP = 0x81
+ENTRY_UPCASE = 0x82
+ENTRY_LABEL = 0x83
+ENTRY_FILE = 0x85
+ENTRY_STREAM = 0xC0
+ENTRY_NAME = 0xC1
+
+FLAG_ALLOCATION_POSSIBLE = 0x01
+FLAG_NO_FAT_CHAIN = 0x02
+
+MAX_CLUSTER_SIZE = 131072
+
+FAT_MEDIA = 0xFFFFFFF8
+FAT_END_OF_CHAIN = 0xFFFFFFFF
+
+
+def get_cluster_size(volume_size):
+    """ cluster size (bytes) for a volume, following mkfs.exfat defaults """
+    if volume_size <= 256 * ONE_MiB:
+        return 4096
+    if volume_size <= 32 * ONE_GiB:
+        return 32768
+    return MAX_CLUSTER_SIZE
+
+
+def get_allocated_size(size, cluster_size=MAX_CLUSTER_SIZE):
+    """ bytes of the whole clusters holding size bytes of data
+
+        default (largest) cluster size never underestimates it """
+    return -(-size // cluster_size) * cluster_size
+
+
+def get_allocated_folder_size(path, cluster_size=MAX_CLUSTER_SIZE):
+    """ bytes of the clusters a folder's tree would use (folders use one) """
+    total = cluster_size
+    for entry in os.scandir(path):
+        if entry.is_dir(follow_symlinks=False):
+            total += get_allocated_folder_size(entry.path, cluster_size)
+        else:
+            total += get_allocated_size(entry.stat().st_size, cluster_size)
+    return total
+
+
+def get_upcase_table():
+    """ uncompressed up-case table (one UTF-16 unit per char) of 0x10000 entries """
+    table = array.array("H", range(0x10000))
+    for code in range(0x10000):
+        if 0xD800 <= code <= 0xDFFF:  # surrogates are not chars
+            continue
+        upper = chr(code).upper()
+        # only keep simple (one char to one char in the BMP) mappings
+        if len(upper) == 1 and ord(upper) <= 0xFFFF:
+            table[code] = ord(upper)
+    return table
+
+
+def checksum32(data, skip=()):
+    """ exFAT 32b rotating checksum (boot region, up-case table) """
+    checksum = 0
+    for index, byte in enumerate(data):
+        if index in skip:
+            continue
+        checksum = (((checksum >> 1) | (checksum << 31)) + byte) & 0xFFFFFFFF
+    return checksum
+
+
+def checksum16(data, skip=()):
+    """ exFAT 16b rotating checksum (directory entry sets, name hash) """
+    checksum = 0
+    for index, byte in enumerate(data):
+        if index in skip:
+            continue
+        checksum = (((checksum >> 1) | (checksum << 15)) + byte) & 0xFFFF
+    return checksum
+
+
+def get_timestamp(mtime=None):
+    """ exFAT (DOS-like) packed local timestamp and 10ms increment """
+    moment = (
+        datetime.datetime.now()
+        if mtime is None
+        else datetime.datetime.fromtimestamp(mtime)
+    )
+    year = min(max(moment.year, 1980), 2107)
+    timestamp = (
+        ((year - 1980) << 25)
+        | (moment.month << 21)
+        | (moment.day << 16)
+        | (moment.hour << 11)
+        | (moment.minute << 5)
+        | (moment.second // 2)
+    )
+    increment = (moment.second % 2) * 100 + moment.microsecond // 10000
+    return timestamp, increment
+
+
+def check_name(name):
+    """ raise ValueError if name can't be stored on exFAT """
+    if not name or name in (".", ".."):
+        raise ValueError("invalid exFAT name: {}".format(repr(name)))
+    if len(name.encode("utf-16-le")) // 2 > MAX_NAME_LENGTH:
+        raise ValueError("name too long for exFAT: {}".format(name))
+    if [char for char in name if char in EXFAT_FORBIDDEN_CHARS or ord(char) < 0x20]:
+        raise ValueError("forbidden char(s) in exFAT name: {}".format(repr(name)))
+
+
+class Node(object):
+    """ a file or folder of the filesystem tree """
+
+    def __init__(self, name, cluster_size, source=None, is_dir=False):
+        self.name = name
+        self.cluster_size = cluster_size
+        self.source = source
+        self.is_dir = is_dir
+        self.children = {}  # up-cased name: Node
+        self.first_cluster = 0
+        self.nb_clusters = 0
+        self.size = 0 if is_dir else os.path.getsize(source)
+        self.mtime = None if source is None else os.path.getmtime(source)
+
+    @property
+    def utf16_name(self):
+        return self.name.encode("utf-16-le")
+
+    @property
+    def nb_entries(self):
+        """ number of directory entries of this node's entry set """
+        name_length = len(self.utf16_name) // 2
+        return 2 + -(-name_length // NAME_CHARS_PER_ENTRY)
+
+    @property
+    def data_length(self):
+        return self.nb_clusters * self.cluster_size if self.is_dir else self.size
+
+    def walk(self):
+        """ all nodes below this one (depth-first, sorted by name) """
+        for child in sorted(self.children.values(), key=lambda node: node.name):
+            yield child
+            yield from child.walk()
+
+
+class ExfatBuilder(object):
+    """ lays out and writes an exFAT filesystem of `size` bytes at `offset`
+
+        manifest: list of (source, destination) pairs. source is a path on host
+        (folders are added recursively) and destination a /-separated path
+        relative to the root of the filesystem. """
+
+    def __init__(self, image_fpath, offset, size, label, logger):
+        self.image_fpath = image_fpath
+        self.offset = offset
+        self.size = size
+        self.label = label
+        self.logger = logger
+
+        if len(label) > MAX_LABEL_LENGTH:
+            raise ValueError("exFAT label too long: {}".format(label))
+
+        self.cluster_size = get_cluster_size(size)
+        self.root = Node("", self.cluster_size, is_dir=True)
+        self.upcase = get_upcase_table()
+        self.compute_geometry()
+
+    def compute_geometry(self):
+        """ FAT and cluster heap offsets/lengths (in sectors) and cluster count """
+        sectors_per_cluster = self.cluster_size // SECTOR_SIZE
+        volume_sectors = self.size // SECTOR_SIZE
+        alignment = max(FAT_ALIGNMENT, self.cluster_size) // SECTOR_SIZE
+
+        def align(sector):
+            return -(-sector // alignment) * alignment
+
+        self.volume_sectors = volume_sectors
+        self.fat_offset = align(BOOT_REGION_SECTORS * 2)
+        # FAT covers every cluster that could fit after it (upper bound)
+        max_clusters = (volume_sectors - self.fat_offset) // sectors_per_cluster
+        self.fat_length = -(-(max_clusters + FIRST_CLUSTER) * 4 // SECTOR_SIZE)
+        self.heap_offset = align(self.fat_offset + self.fat_length)
+        if self.heap_offset >= volume_sectors:
+            raise ValueError("volume too small for exFAT: {}".format(self.size))
+        self.cluster_count = (volume_sectors - self.heap_offset) // sectors_per_cluster
+
+    def add(self, source, destination):
+        """ add source file or folder as destination in the filesystem """
+        parts = [part for part in destination.replace(os.sep, "/").split("/") if part]
+        if not parts:  # folder contents directly in root
+            if not os.path.isdir(source):
+                raise ValueError("only folders can be added as root")
+            for name in os.listdir(source):
+                self.add(os.path.join(source, name), name)
+            return
+
+        parent = self.root
+        for part in parts[:-1]:
+            parent = self.get_or_create_folder(parent, part)
+
+        if os.path.isdir(source):
+            self.get_or_create_folder(parent, parts[-1], source)
+            for name in os.listdir(source):
+                self.add(os.path.join(source, name), "/".join(parts + [name]))
+            return
+
+        check_name(parts[-1])
+        key = self.upcased(parts[-1])
+        if key in parent.children:
+            raise ValueError("duplicate exFAT name: {}".format(destination))
+        parent.children[key] = Node(parts[-1], self.cluster_size, source)
+
+    def add_manifest(self, manifest):
+        for source, destination in manifest:
+            self.add(source, destination)
+
+    def get_or_create_folder(self, parent, name, source=None):
+        check_name(name)
+        key = self.upcased(name)
+        node = parent.children.get(key)
+        if node is None:
+            node = parent.children[key] = Node(
+                name, self.cluster_size, source, is_dir=True
+            )
+        elif not node.is_dir:
+            raise ValueError("{} is both a file and a folder".format(name))
+        return node
+
+    @property
+    def data_size(self):
+        """ bytes of file data to write """
+        return sum([node.size for node in self.root.walk()])
+
+    def upcased(self, name):
+        units = array.array("H", name.encode("utf-16-le"))
+        return array.array("H", [self.upcase[unit] for unit in units]).tobytes()
+
+    def nb_clusters_for(self, nb_bytes):
+        return -(-nb_bytes // self.cluster_size)
+
+    def allocate(self):
+        """ assign contiguous cluster runs to every structure, files last
+
+            returns list of (first_cluster, nb_clusters) runs in disk order """
+        self.bitmap_length = -(-self.cluster_count // 8)
+        self.upcase_bytes = self.upcase.tobytes()
+        nodes = list(self.root.walk())
+        folders = [self.root] + [node for node in nodes if node.is_dir]
+        files = sorted(
+            [node for node in nodes if not node.is_dir and node.size],
+            key=lambda node: node.size,
+            reverse=True,
+        )
+
+        runs = []
+        next_cluster = FIRST_CLUSTER
+
+        def reserve(nb_bytes):
+            nonlocal next_cluster
+            nb_clusters = max(1, self.nb_clusters_for(nb_bytes))
+            first = next_cluster
+            next_cluster += nb_clusters
+            runs.append((first, nb_clusters))
+            return first, nb_clusters
+
+        self.bitmap_cluster, _ = reserve(self.bitmap_length)
+        self.upcase_cluster, _ = reserve(len(self.upcase_bytes))
+        for folder in folders:
+            nb_entries = sum([child.nb_entries for child in folder.children.values()])
+            if folder is self.root:
+                nb_entries += 3  # label, bitmap and up-case table entries
+            folder.first_cluster, folder.nb_clusters = reserve(nb_entries * ENTRY_SIZE)
+        for node in files:
+            node.first_cluster, node.nb_clusters = reserve(node.size)
+
+        self.used_clusters = next_cluster - FIRST_CLUSTER
+        if self.used_clusters > self.cluster_count:
+            raise IOError(
+                errno.ENOSPC,
+                "Not enough space on data partition: {used} clusters "
+                "needed for {count}".format(
+                    used=self.used_clusters, count=self.cluster_count
+                ),
+            )
+        self.folders = folders
+        self.files = files
+        return runs
+
+    def get_fat(self, runs):
+        fat = array.array("I", bytes(self.fat_length * SECTOR_SIZE))
+        fat[0] = FAT_MEDIA
+        fat[1] = FAT_END_OF_CHAIN
+        for first, nb_clusters in runs:
+            last = first + nb_clusters - 1
+            fat[first:last] = array.array("I", range(first + 1, last + 1))
+            fat[last] = FAT_END_OF_CHAIN
+        return fat.tobytes()
+
+    def get_bitmap(self):
+        bitmap = bytearray(self.nb_clusters_for(self.bitmap_length) * self.cluster_size)
+        full_bytes, remaining_bits = divmod(self.used_clusters, 8)
+        bitmap[:full_bytes] = b"\xff" * full_bytes
+        if remaining_bits:
+            bitmap[full_bytes] = (1 << remaining_bits) - 1
+        return bytes(bitmap)
+
+    def get_boot_region(self):
+        """ 12 sectors: boot, 8 extended boot, OEM, reserved and checksum """
+        boot = bytearray(SECTOR_SIZE)
+        boot[0:3] = b"\xeb\x76\x90"
+        boot[3:11] = b"EXFAT   "
+        struct.pack_into(
+            "<QQIIIIIIHHBBBB",
+            boot,
+            64,
+            self.offset // SECTOR_SIZE,  # PartitionOffset
+            self.volume_sectors,  # VolumeLength
+            self.fat_offset,
+            self.fat_length,
+            self.heap_offset,
+            self.cluster_count,
+            self.folders[0].first_cluster,  # FirstClusterOfRootDirectory
+            struct.unpack("<I", os.urandom(4))[0],  # VolumeSerialNumber
+            0x0100,  # FileSystemRevision 1.00
+            0,  # VolumeFlags
+            SECTOR_SHIFT,  # BytesPerSectorShift
+            (self.cluster_size // SECTOR_SIZE).bit_length() - 1,
+            1,  # NumberOfFats
+            0x80,  # DriveSelect
+        )
+        boot[112] = min(100, self.used_clusters * 100 // self.cluster_count)
+        boot[510:512] = b"\x55\xaa"
+
+        extended = bytearray(SECTOR_SIZE)
+        extended[508:512] = b"\x00\x00\x55\xaa"
+        region = bytes(boot) + bytes(extended) * 8 + bytes(SECTOR_SIZE) * 2
+
+        # VolumeFlags and PercentInUse are excluded from checksum
+        checksum = checksum32(region, skip=(106, 107, 112))
+        return region + struct.pack("<I", checksum) * (SECTOR_SIZE // 4)
+
+    def get_entry_set(self, node):
+        """ file, stream extension and file name entries of a node """
+        timestamp, increment = get_timestamp(node.mtime)
+        name = node.utf16_name
+        nb_names = node.nb_entries - 2
+        file_entry = struct.pack(
+            "<BBHHHIIIBBBBB7x",
+            ENTRY_FILE,
+            node.nb_entries - 1,  # SecondaryCount
+            0,  # SetChecksum, computed below
+            ATTR_DIRECTORY if node.is_dir else ATTR_ARCHIVE,
+            0,
+            timestamp,  # Create
+            timestamp,  # LastModified
+            timestamp,  # LastAccessed
+            increment,
+            increment,
+            0,  # UTC offsets not recorded
+            0,
+            0,
+        )
+        flags = FLAG_ALLOCATION_POSSIBLE
+        if node.nb_clusters:
+            flags |= FLAG_NO_FAT_CHAIN
+        stream_entry = struct.pack(
+            "<BBBBHHQ4xIQ",
+            ENTRY_STREAM,
+            flags,
+            0,
+            len(name) // 2,  # NameLength
+            checksum16(self.upcased(node.name)),  # NameHash
+            0,
+            node.data_length,  # ValidDataLength
+            node.first_cluster,
+            node.data_length,
+        )
+        name_entries = b""
+        for index in range(nb_names):
+            chunk = name[index * 30 : (index + 1) * 30]
+            name_entries += struct.pack("<BB", ENTRY_NAME, 0) + chunk.ljust(30, b"\0")
+
+        entry_set = bytearray(file_entry + stream_entry + name_entries)
+        struct.pack_into("<H", entry_set, 2, checksum16(entry_set, skip=(2, 3)))
+        return bytes(entry_set)
+
+    def get_folder_data(self, folder):
+        entries = b""
+        if folder is self.root:
+            label = self.label.encode("utf-16-le")
+            entries += struct.pack(
+                "<BB22s8x", ENTRY_LABEL, len(label) // 2, label.ljust(22, b"\0")
+            )
+            entries += struct.pack(
+                "<BB18xIQ",
+                ENTRY_BITMAP,
+                0,  # BitmapFlags: first (and only) FAT
+                self.bitmap_cluster,
+                self.bitmap_length,
+            )
+            entries += struct.pack(
+                "<BBBBI12xIQ",
+                ENTRY_UPCASE,
+                0,
+                0,
+                0,
+                checksum32(self.upcase_bytes),
+                self.upcase_cluster,
+                len(self.upcase_bytes),
+            )
+        for child in sorted(folder.children.values(), key=lambda node: node.name):
+            entries += self.get_entry_set(child)
+        return entries.ljust(folder.nb_clusters * self.cluster_size, b"\0")
+
+    def cluster_offset(self, cluster):
+        """ absolute offset in image of a cluster """
+        return (
+            self.offset
+            + self.heap_offset * SECTOR_SIZE
+            + (cluster - FIRST_CLUSTER) * self.cluster_size
+        )
+
+    def build(self, progress_cb=None):
+        """ write the filesystem into the image
+
+            progress_cb: called with (written, total) bytes of file data """
+        runs = self.allocate()
+        self.logger.std(
+            "Building exFAT volume: {nb} files, {used}/{count} clusters of {size}b".format(
+                nb=len(self.files),
+                used=self.used_clusters,
+                count=self.cluster_count,
+                size=self.cluster_size,
+            )
+        )
+
+        with open(self.image_fpath, "r+b") as fd:
+            boot_region = self.get_boot_region()
+            fd.seek(self.offset)
+            fd.write(boot_region)
+            fd.write(boot_region)  # backup boot region
+
+            fd.seek(self.offset + self.fat_offset * SECTOR_SIZE)
+            fd.write(self.get_fat(runs))
+
+            fd.seek(self.cluster_offset(self.bitmap_cluster))
+            fd.write(self.get_bitmap())
+            fd.seek(self.cluster_offset(self.upcase_cluster))
+            fd.write(self.upcase_bytes)
+            for folder in self.folders:
+                fd.seek(self.cluster_offset(folder.first_cluster))
+                fd.write(self.get_folder_data(folder))
+
+            written, total_size = 0, self.data_size
+            for node in self.files:
+                fd.seek(self.cluster_offset(node.first_cluster))
+                with open(node.source, "rb") as src:
+                    for chunk in iter(lambda: src.read(COPY_BUFFER_SIZE), b""):
+                        fd.write(chunk)
+                        written += len(chunk)
+                        if progress_cb:
+                            progress_cb(written, total_size)
+            fd.flush()
+            os.fsync(fd.fileno())
+        return written
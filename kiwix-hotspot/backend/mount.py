@@ -3,8 +3,10 @@
 
 import os
 import re
+import errno
 import sys
 import time
+import shutil
 import string
 import random
 import tempfile
@@ -13,11 +15,14 @@ import traceback
 from data import data_dir, data_partition_label
 from backend.content import get_content
 from backend.qemu import get_qemu_image_size
+from backend.exfat import ExfatBuilder
 from backend.util import (
     subprocess_pretty_check_call,
     subprocess_pretty_call,
     subprocess_external,
+    copy_file,
 )
+from util import BytesProgress
 
 
 def system_has_exfat():
@@ -74,6 +79,13 @@ def get_start_offset(root_size, disk_size):
     return data_start * sector_size, data_bytes
 
 
+def get_data_partition_bounds(image_fpath, logger):
+    """ bytes start offset and bytes size of the data partition of an image """
+    base_image = get_content("hotspot_master_image")
+    disk_size = get_qemu_image_size(image_fpath, logger)
+    return get_start_offset(base_image.get("root_partition_size"), disk_size)
+
+
 def get_partition_size(image_fpath, start_bytes, logger):
     """ bytes size of the data partition """
     full_size = get_qemu_image_size(image_fpath, logger)
@@ -293,11 +305,7 @@ def get_virtual_device(image_fpath, logger):
 
     if sys.platform == "linux":
         # find out offset for third partition from the root part size
-        base_image = get_content("hotspot_master_image")
-        disk_size = get_qemu_image_size(image_fpath, logger)
-        offset, size = get_start_offset(
-            base_image.get("root_partition_size"), disk_size
-        )
+        offset, size = get_data_partition_bounds(image_fpath, logger)
 
         # prepare loop device
         if bool(os.getenv("NO_UDISKS", False)):
@@ -439,6 +447,46 @@ def format_data_partition(image_fpath, logger):
             unmount_data_partition(None, target_dev, logger)
 
 
+def build_data_partition(image_fpath, staging_folder, logger):
+    """ write staging folder's content as the exfat data partition (no mount)
+
+        filesystem is laid out directly inside the image file.
+        falls back to format, mount and copy should the builder fail to lay
+        it out. errors while writing it (image partially written) are raised """
+
+    offset, size = get_data_partition_bounds(image_fpath, logger)
+    try:
+        builder = ExfatBuilder(image_fpath, offset, size, data_partition_label, logger)
+        builder.add(staging_folder, "")
+        builder.allocate()  # nothing is written to the image until build()
+    except Exception as exp:
+        if isinstance(exp, OSError) and exp.errno == errno.ENOSPC:
+            raise  # contents wouldn't fit a mounted partition either
+        logger.err("Failed to lay out data partition in userspace: {}".format(exp))
+        logger.std(traceback.format_exc())
+    else:
+        progress = BytesProgress(logger, builder.data_size)
+        builder.build(progress_cb=progress.callback(staging_folder, builder.data_size))
+        progress.report()
+        return
+
+    logger.step("Formating and mounting data partition instead")
+    format_data_partition(image_fpath, logger)
+    mount_point, device = mount_data_partition(image_fpath, logger)
+    try:
+        for name in os.listdir(staging_folder):
+            src = os.path.join(staging_folder, name)
+            dst = os.path.join(mount_point, name)
+            if os.path.isdir(src):
+                shutil.copytree(src, dst, copy_function=copy_file)
+            else:
+                copy_file(src, dst)
+        if sys.platform in ("linux", "darwin"):
+            os.sync()
+    finally:
+        unmount_data_partition(mount_point, device, logger)
+
+
 def mount_data_partition(image_fpath, logger):
     """ mount the QEMU image's 3rd part and return its mount point/drive """
 
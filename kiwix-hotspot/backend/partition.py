@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+""" host-side partition table (MBR) rewrite of an image file
+
+    replicates ansiblecube's `resize` role without booting the VM:
+    root partition is expanded (if needed) and the data partition recreated
+    to span the rest of the disk, using ansiblecube's own boundaries math.
+    data partition is then formatted (exfat) from host. """
+
+import os
+import sys
+import shutil
+import struct
+import hashlib
+import importlib.util
+
+import data
+from data import data_partition_label
+from backend.exfat import ExfatBuilder
+from backend.util import subprocess_pretty_check_call
+
+SECTOR_SIZE = 512
+PARTITION_TABLE_OFFSET = 446
+PARTITION_ENTRY = struct.Struct("<B3sB3sII")
+MBR_SIGNATURE = b"\x55\xaa"
+CHS_UNUSED = b"\xfe\xff\xff"  # addressing is LBA-only
+
+ROOT_PARTITION = 1  # index of root partition (second one)
+DATA_PARTITION = 2  # index of data partition (third one)
+LINUX_PARTITION_TYPE = 0x83
+EXFAT_PARTITION_TYPE = 0x07
+
+if sys.platform == "linux":
+    resize2fs_exe = "/sbin/resize2fs"
+else:
+    resize2fs_exe = shutil.which("resize2fs")
+
+
+def get_partition_boundaries_module():
+    """ ansiblecube's partition_boundaries module (shared with guest) """
+    spec = importlib.util.spec_from_file_location(
+        "partition_boundaries",
+        os.path.join(data.ansiblecube_path, "partition_boundaries.py"),
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def read_partition_table(image_fpath):
+    """ list of 4 [status, chs_first, type, chs_last, start, nb_sectors] """
+    with open(image_fpath, "rb") as fd:
+        mbr = fd.read(SECTOR_SIZE)
+    if len(mbr) != SECTOR_SIZE or mbr[510:512] != MBR_SIGNATURE:
+        raise ValueError("no MBR partition table in {}".format(image_fpath))
+    return [
+        list(
+            PARTITION_ENTRY.unpack_from(
+                mbr, PARTITION_TABLE_OFFSET + index * PARTITION_ENTRY.size
+            )
+        )
+        for index in range(4)
+    ]
+
+
+def get_partition_table_signature(image_fpath):
+    """ short hash of the image's partition entries (changes on any re-layout) """
+    with open(image_fpath, "rb") as fd:
+        fd.seek(PARTITION_TABLE_OFFSET)
+        entries = fd.read(PARTITION_ENTRY.size * 4)
+    return hashlib.sha256(entries).hexdigest()[:8]
+
+
+def write_partition_table(image_fpath, partitions):
+    """ write the 4 partition entries into the image's MBR """
+    with open(image_fpath, "r+b") as fd:
+        fd.seek(PARTITION_TABLE_OFFSET)
+        for partition in partitions:
+            fd.write(PARTITION_ENTRY.pack(*partition))
+        fd.flush()
+        os.fsync(fd.fileno())
+
+
+def resize_partitions(image_fpath, root_size, disk_size, logger):
+    """ expand root partition and recreate data partition on host
+
+        image file must already be of disk_size bytes.
+        root filesystem is grown offline (resize2fs) if its partition grows """
+
+    partitions = read_partition_table(image_fpath)
+    root = partitions[ROOT_PARTITION]
+    if root[2] != LINUX_PARTITION_TYPE or not root[4]:
+        raise ValueError("second partition is not a Linux (root) one")
+
+    boundaries = get_partition_boundaries_module().compute_boundaries(
+        root[4], root_size, disk_size
+    )
+    root_start, root_end, data_start, data_end = boundaries
+    if data_end >= os.path.getsize(image_fpath) // SECTOR_SIZE:
+        raise ValueError("data partition would end past image's end")
+
+    # root partition is only ever expanded
+    root_sectors = max(root_end - root_start + 1, root[5])
+    if root_start + root_sectors > data_start:
+        raise ValueError("root partition overlaps data partition")
+    grow_root = root_sectors > root[5]
+    if grow_root and (not resize2fs_exe or not os.path.exists(resize2fs_exe)):
+        raise OSError("resize2fs is required to grow root partition")
+
+    logger.std(
+        "root partition: {rs}-{re} ; data partition: {ds}-{de}".format(
+            rs=root_start, re=root_start + root_sectors - 1, ds=data_start, de=data_end,
+        )
+    )
+    partitions[ROOT_PARTITION] = [
+        root[0],
+        root[1],
+        LINUX_PARTITION_TYPE,
+        CHS_UNUSED,
+        root_start,
+        root_sectors,
+    ]
+    partitions[DATA_PARTITION] = [
+        0,
+        CHS_UNUSED,
+        EXFAT_PARTITION_TYPE,
+        CHS_UNUSED,
+        data_start,
+        data_end - data_start + 1,
+    ]
+    write_partition_table(image_fpath, partitions)
+
+    if grow_root:
+        logger.std("Growing root filesystem to {} sectors".format(root_sectors))
+        subprocess_pretty_check_call(
+            [
+                resize2fs_exe,
+                "-f",
+                "{path}?offset={offset}".format(
+                    path=image_fpath, offset=root_start * SECTOR_SIZE
+                ),
+                "{}s".format(root_sectors),
+            ],
+            logger,
+        )
+
+    # guest mounts data partition on boot (fstab) ; it must be formatted
+    logger.std("Formatting data partition")
+    data_size = (data_end - data_start + 1) * SECTOR_SIZE
+    ExfatBuilder(
+        image_fpath, data_start * SECTOR_SIZE, data_size, data_partition_label, logger
+    ).build()
@@ -6,6 +6,7 @@ import re
 import sys
 import time
 import socket
+import struct
 import psutil
 import random
 import posixpath
@@ -16,11 +17,16 @@ import multiprocessing
 
 import paramiko
 
-from .util import startup_info_args
+from .util import startup_info_args, get_free_port
 from .util import subprocess_pretty_check_call
 from util import ONE_GiB, ONE_MiB, human_readable_size
 
 timeout = 10 * 60
+# name of the VM snapshot taken right after first boot of a master image
+BOOT_SNAPSHOT = "boot"
+# qcow2 header start: magic, version, backing file offset and size
+QCOW2_HEADER = struct.Struct(">4sIQI")
+QCOW2_MAGIC = b"QFI\xfb"
 
 if os.name == "nt":
     qemu_system_arm_exe = "qemu\qemu-system-arm.exe"
@@ -56,17 +62,9 @@ def generate_random_name():
     return r
 
 
-def get_free_port():
-    with socket.socket() as s:
-        s.bind(("", 0))
-        port = s.getsockname()[1]
-
-    return port
-
-
-def get_qemu_image_size(image_fpath, logger):
+def get_qemu_image_size(image_fpath, logger, image_format="raw"):
     output = subprocess_pretty_check_call(
-        [qemu_img_exe_path, "info", "-f", "raw", image_fpath], logger
+        [qemu_img_exe_path, "info", "-f", image_format, image_fpath], logger
     )
     matches = []
     for line_number, line in enumerate(output):
@@ -78,21 +76,113 @@ def get_qemu_image_size(image_fpath, logger):
     return int(matches[0])
 
 
+def is_boot_snapshot_of(fname, master_fname, partitions):
+    """ whether fname is a cached boot snapshot overlay of master (see Emulator)
+
+        partitions: signature of master's partition table """
+    return fname.startswith(master_fname + ".") and fname.endswith(
+        ".{}.{}.qcow2".format(partitions, BOOT_SNAPSHOT)
+    )
+
+
+def get_backing_path(backing_fpath, overlay_fpath):
+    """ backing path to record in overlay: relative to it when possible
+
+        so the overlay remains usable when its folder is moved as a whole """
+    try:
+        return os.path.relpath(
+            os.path.abspath(backing_fpath),
+            os.path.dirname(os.path.abspath(overlay_fpath)),
+        )
+    except ValueError:  # different drives (windows)
+        return os.path.abspath(backing_fpath)
+
+
+def create_overlay_image(backing_fpath, overlay_fpath, logger):
+    """ qcow2 image recording only changes made over a (raw) backing image """
+    subprocess_pretty_check_call(
+        [
+            qemu_img_exe_path,
+            "create",
+            "-f",
+            "qcow2",
+            "-F",
+            "raw",
+            "-b",
+            get_backing_path(backing_fpath, overlay_fpath),
+            overlay_fpath,
+        ],
+        logger,
+    )
+
+
+def rebase_overlay_image(overlay_fpath, backing_fpath, logger):
+    """ point a (copied) overlay to backing_fpath, of same content. data untouched """
+    subprocess_pretty_check_call(
+        [
+            qemu_img_exe_path,
+            "rebase",
+            "-u",
+            "-f",
+            "qcow2",
+            "-F",
+            "raw",
+            "-b",
+            get_backing_path(backing_fpath, overlay_fpath),
+            overlay_fpath,
+        ],
+        logger,
+    )
+
+
+def get_overlay_backing(overlay_fpath):
+    """ absolute path of the backing file recorded in a qcow2 overlay. or None """
+    with open(overlay_fpath, "rb") as fd:
+        header = fd.read(QCOW2_HEADER.size)
+        if len(header) != QCOW2_HEADER.size:
+            return None
+        magic, _, backing_offset, backing_size = QCOW2_HEADER.unpack(header)
+        if magic != QCOW2_MAGIC or not backing_offset:
+            return None
+        fd.seek(backing_offset)
+        backing = fd.read(backing_size).decode("utf-8")
+    return os.path.join(os.path.dirname(os.path.abspath(overlay_fpath)), backing)
+
+
+def is_overlay_of(overlay_fpath, backing_fpath):
+    """ whether overlay is backed by backing_fpath, unchanged since overlay's creation
+
+        backing file replaced (re-extracted) afterwards is newer than overlay """
+    try:
+        backing = get_overlay_backing(overlay_fpath)
+        return (
+            backing is not None
+            and os.path.samefile(backing, backing_fpath)
+            and os.path.getmtime(backing_fpath) <= os.path.getmtime(overlay_fpath)
+        )
+    except (OSError, UnicodeDecodeError):
+        return False
+
+
 class Emulator:
     _image = None
     _kernel = None
     _dtb = None
     _logger = None
     _is_master = False
+    _format = "raw"
 
     # login=pi
     # password=raspberry
     # prompt end by ":~$ "
     # sudo doesn't require password
-    def __init__(self, kernel, dtb, image, logger, ram, is_master=False):
+    def __init__(
+        self, kernel, dtb, image, logger, ram, is_master=False, image_format="raw"
+    ):
         self._kernel = kernel
         self._dtb = dtb
         self._image = image
+        self._format = image_format
         self._logger = logger
         self._binary = qemu_system_arm_exe_path
         self._is_master = is_master
@@ -128,19 +218,58 @@ class Emulator:
         self._ram = "{ram}M".format(ram=int(ram / ONE_MiB))
         self._logger.std(" using {ram} RAM".format(ram=human_readable_size(ram)))
 
-    def run(self, cancel_event):
-        return _RunningInstance(self, self._logger, cancel_event)
+    def run(self, cancel_event, snapshot=None, on_resume_failure=None):
+        """ running VM context. cold-booted or resumed from snapshot (qcow2 only)
+
+            resuming reverts the disk to its state at snapshot time:
+            image must not have been modified since.
+            on_resume_failure: called (with the exception) if resuming fails,
+            before cold-booting instead. resume failure is raised if None """
+        return _RunningInstance(
+            self, self._logger, cancel_event, snapshot, on_resume_failure
+        )
+
+    def get_boot_snapshot_fname(self, master_fname, partitions):
+        """ filename of a cached overlay holding master's boot snapshot
+
+            snapshot can only be restored on the same machine (RAM, CPUs),
+            disk size and partition table (partitions: its signature) """
+        return "{master}.{size}-{ram}-{cpu}cpu.{parts}.{name}.qcow2".format(
+            master=master_fname,
+            size=self.get_image_size(),
+            ram=self._ram,
+            cpu=qemu_cpu,
+            parts=partitions,
+            name=BOOT_SNAPSHOT,
+        )
 
     def get_image_size(self):
-        return get_qemu_image_size(self._image, self._logger)
+        return get_qemu_image_size(self._image, self._logger, self._format)
 
     def resize_image(self, size, shrink=False):
         subprocess_pretty_check_call(
             [qemu_img_exe_path, "resize"]
             + (["--shrink"] if shrink else [])
-            + ["-f", "raw", self._image, "{}".format(size)],
+            + ["-f", self._format, self._image, "{}".format(size)],
+            self._logger,
+        )
+
+    def convert_image(self, dest_fpath, image_format="raw"):
+        """ convert image (sparse) to dest_fpath and use it from now on """
+        subprocess_pretty_check_call(
+            [
+                qemu_img_exe_path,
+                "convert",
+                "-f",
+                self._format,
+                "-O",
+                image_format,
+                self._image,
+                dest_fpath,
+            ],
             self._logger,
         )
+        self._image, self._format = dest_fpath, image_format
 
 
 class _RunningInstance:
@@ -149,19 +278,35 @@ class _RunningInstance:
     _client = None
     _logger = None
     _cancel_event = None
+    _snapshot = None
+    _on_resume_failure = None
+    _monitor_port = None
 
-    def __init__(self, emulation, logger, cancel_event):
+    def __init__(
+        self, emulation, logger, cancel_event, snapshot=None, on_resume_failure=None
+    ):
         self._emulation = emulation
         self._logger = logger
         self._cancel_event = cancel_event
+        self._snapshot = snapshot
+        self._on_resume_failure = on_resume_failure
 
     def __enter__(self):
         try:
             self._boot()
-        except Exception:
+        except Exception as exp:
             if self._qemu:
                 self._qemu.kill()
-            raise
+            if (
+                not self._snapshot
+                or self._on_resume_failure is None
+                or self._cancel_event.is_set()
+            ):
+                raise
+            self._logger.err("Unable to resume VM from snapshot: {}".format(exp))
+            self._on_resume_failure(exp)
+            self._snapshot, self._qemu, self._client = None, None, None
+            return self.__enter__()
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
@@ -240,7 +385,9 @@ class _RunningInstance:
                 "-serial",
                 "stdio",
                 "-drive",
-                "format=raw,if=sd,file={}".format(self._emulation._image),
+                "format={fmt},if=sd,file={image}".format(
+                    fmt=self._emulation._format, image=self._emulation._image
+                ),
                 "-display",
                 "none",
                 "-no-reboot",
@@ -249,6 +396,15 @@ class _RunningInstance:
                 "-device",
                 "virtio-net-device,netdev=eth1",
             ]
+            # monitor (to save snapshots) and snapshot restore need qcow2
+            if self._emulation._format == "qcow2":
+                self._monitor_port = get_free_port()
+                command += [
+                    "-monitor",
+                    "tcp:127.0.0.1:{},server,nowait".format(self._monitor_port),
+                ]
+                if self._snapshot:
+                    command += ["-loadvm", self._snapshot]
             if qemu_cpu > 1:
                 command += ["-smp", str(qemu_cpu), "--accel", "tcg,thread=multi"]
             self._logger.std("--\n{}\n--".format(" ".join(command)))
@@ -261,41 +417,47 @@ class _RunningInstance:
             )
             cancel_register.register(self._qemu.pid)
 
-        self._wait_signal(stdout_reader, stdout_writer, b"login: ", timeout)
-
-        # start SSH daemon
-        if self._emulation._is_master:
-            self._logger.std("Starting SSH daemon manually")
-            os.write(stdin_writer, b"pi\n")
-
-            tries = 0
-            while True:
-                signal = b"Password: "
-                buf_states = self._wait_signal(
-                    stdout_reader, stdout_writer, signal, timeout, True
-                )
-
-                if not buf_states:
-                    break
+        if self._snapshot:
+            # VM resumes where it was saved: already booted with SSH running
+            self._logger.std("Resuming VM from snapshot `{}`".format(self._snapshot))
+        else:
+            self._wait_signal(stdout_reader, stdout_writer, b"login: ", timeout)
 
-                self._logger.err(str(buf_states))
-                self._logger.err("internal error: please report this log")
-                if tries > 3:
-                    raise QemuException("wait signal timeout: %s" % signal)
+            # start SSH daemon
+            if self._emulation._is_master:
+                self._logger.std("Starting SSH daemon manually")
                 os.write(stdin_writer, b"pi\n")
-                tries += 1
 
-            os.write(stdin_writer, b"raspberry\n")
-            self._wait_signal(stdout_reader, stdout_writer, b":~$ ", timeout)
-            # TODO: This is a ugly hack. But writing all at once doesn't work
-            os.write(stdin_writer, b"sudo systemctl")
-            self._wait_signal(stdout_reader, stdout_writer, b"sudo systemctl", timeout)
-            os.write(stdin_writer, b" start ssh;")
-            self._wait_signal(stdout_reader, stdout_writer, b" start ssh;", timeout)
-            os.write(stdin_writer, b" exit\n")
-            self._wait_signal(stdout_reader, stdout_writer, b"login: ", timeout)
+                tries = 0
+                while True:
+                    signal = b"Password: "
+                    buf_states = self._wait_signal(
+                        stdout_reader, stdout_writer, signal, timeout, True
+                    )
 
-        time.sleep(20)
+                    if not buf_states:
+                        break
+
+                    self._logger.err(str(buf_states))
+                    self._logger.err("internal error: please report this log")
+                    if tries > 3:
+                        raise QemuException("wait signal timeout: %s" % signal)
+                    os.write(stdin_writer, b"pi\n")
+                    tries += 1
+
+                os.write(stdin_writer, b"raspberry\n")
+                self._wait_signal(stdout_reader, stdout_writer, b":~$ ", timeout)
+                # TODO: This is a ugly hack. But writing all at once doesn't work
+                os.write(stdin_writer, b"sudo systemctl")
+                self._wait_signal(
+                    stdout_reader, stdout_writer, b"sudo systemctl", timeout
+                )
+                os.write(stdin_writer, b" start ssh;")
+                self._wait_signal(stdout_reader, stdout_writer, b" start ssh;", timeout)
+                os.write(stdin_writer, b" exit\n")
+                self._wait_signal(stdout_reader, stdout_writer, b"login: ", timeout)
+
+            time.sleep(20)
 
         # connect to SSH
         tries = 0
@@ -322,10 +484,56 @@ class _RunningInstance:
                 self._logger.std("Successfuly connected to Qemu over SSH")
                 break
 
+        if self._snapshot:
+            # guest clock stopped at snapshot time
+            self.exec_cmd("sudo date -s @{}".format(int(time.time())))
+
+    def _monitor_cmd(self, command):
+        """ run a command on QEMU monitor and return its output """
+        if not self._monitor_port:
+            raise QemuException("QEMU monitor requires a qcow2 image")
+
+        def read_until_prompt(sock):
+            output = b""
+            while not output.endswith(b"(qemu) "):
+                buf = sock.recv(1024)
+                if not buf:  # monitor closed (quit)
+                    break
+                output += buf
+            return output.decode("utf-8", "ignore")
+
+        with socket.create_connection(
+            ("127.0.0.1", self._monitor_port), timeout=timeout
+        ) as sock:
+            read_until_prompt(sock)  # banner
+            sock.sendall("{}\n".format(command).encode("utf-8"))
+            output = read_until_prompt(sock)
+        self._logger.std(output)
+        return output
+
+    def suspend(self, snapshot):
+        """ save VM state into the qcow2 image as snapshot then stop the VM
+
+            run(snapshot=snapshot) resumes from there instead of booting """
+        self._logger.step("Saving VM state to snapshot `{}`".format(snapshot))
+        self.exec_cmd("sudo sync")
+        output = self._monitor_cmd("savevm {}".format(snapshot))
+        if "Error" in output:
+            raise QemuException("failed to save snapshot: {}".format(output))
+        self._client.close()
+        self._monitor_cmd("quit")
+        self._stop()
+
     def _shutdown(self):
+        if self._qemu is None:  # already stopped (suspended)
+            return
         self.exec_cmd("sudo sync")
         self.exec_cmd("sudo shutdown -P 0", check=False)
         self._client.close()
+        self._stop()
+
+    def _stop(self):
+        """ wait for QEMU to exit (terminate it on timeout) """
         try:
             self._qemu.wait(timeout)
         except subprocess.TimeoutExpired:
@@ -3,17 +3,31 @@
 
 import os
 import re
+import errno
 import sys
 import time
 import shlex
 import signal
+import socket
+import struct
 import ctypes
+import shutil
 import tempfile
 import threading
 import subprocess
 
 import data
-from util import CLILogger
+from util import CLILogger, ONE_MiB
+
+# buffer/chunk size of file copies (large ones reduce syscalls on FUSE mounts)
+COPY_BUFFER_SIZE = ONE_MiB * 16
+# linux ioctl to retrieve a file's extents map (and flag to sync it first)
+FS_IOC_FIEMAP = 0xC020660B
+FIEMAP_FLAG_SYNC = 0x00000001
+# linux ioctl to share a file's data with another (copy-on-write reflink)
+FICLONE = 0x40049409
+# zero-filled blocks of this size are left as holes by sparse writes
+SPARSE_BLOCK_SIZE = ONE_MiB
 
 
 # windows-only flags to prevent sleep on executing thread
@@ -52,6 +66,14 @@ def startup_info_args():
     return {"startupinfo": si, "creationflags": cf}
 
 
+def get_free_port():
+    with socket.socket() as s:
+        s.bind(("", 0))
+        port = s.getsockname()[1]
+
+    return port
+
+
 def subprocess_pretty_call(cmd, logger, check=False, as_admin=False):
     """ flexible subprocess helper running separately and using the logger
 
@@ -450,3 +472,190 @@ def sd_has_single_partition(sd_card, logger):
     except Exception as exp:
         logger.err(str(exp))
         return False
+
+
+def preallocate(fd, size):
+    """ reserve size bytes for the file (contiguous if possible). whether it did
+
+        uses fallocate(2) on linux, which fails on filesystems not supporting it
+        whereas posix_fallocate would emulate it by writing every block """
+    if sys.platform != "linux" or not size:
+        return False
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        fallocate = getattr(libc, "fallocate64", None) or libc.fallocate
+        fallocate.argtypes = [
+            ctypes.c_int,
+            ctypes.c_int,
+            ctypes.c_longlong,
+            ctypes.c_longlong,
+        ]
+        return fallocate(fd, 0, 0, size) == 0
+    except Exception:
+        return False
+
+
+def copy_file(src, dst, progress_cb=None, buffer_size=COPY_BUFFER_SIZE, hasher=None):
+    """ copy src file to dst (file path) using the fastest available method
+
+        destination is preallocated then filled using copy_file_range,
+        sendfile or large buffers (first one supported by both files).
+        progress_cb: called with (copied, total) bytes after each chunk
+        hasher: hashlib object fed with copied data (forces large buffers) """
+
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        total = os.fstat(fsrc.fileno()).st_size
+        preallocate(fdst.fileno(), total)
+
+        copied = 0
+        methods = (
+            (None,) if hasher is not None else ("copy_file_range", "sendfile", None)
+        )
+        for method in methods:
+            if method is not None and not hasattr(os, method):
+                continue
+            try:
+                for nb_bytes in _copy_chunks(fsrc, fdst, method, buffer_size, hasher):
+                    copied += nb_bytes
+                    if progress_cb is not None:
+                        progress_cb(copied, total)
+                break
+            except OSError:
+                # method not supported for those files: resume with next one
+                if method is None:
+                    raise
+                fsrc.seek(copied)
+                fdst.seek(copied)
+
+        # preallocated space beyond actual data (file shrank meanwhile)
+        fdst.truncate(copied)
+
+    try:
+        shutil.copymode(src, dst)
+    except OSError:
+        pass  # exfat doesn't support modes
+
+
+def clone_file(src, dst, buffer_size=COPY_BUFFER_SIZE):
+    """ create dst as a copy of src, sharing its data if possible. method used
+
+        "reflink": copy-on-write clone (FICLONE: btrfs, xfs…), instant
+        "sparse": only data areas of src are written, holes and zeros skipped """
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        if sys.platform == "linux":
+            import fcntl
+
+            try:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+                return "reflink"
+            except OSError:
+                pass  # not supported by filesystem or across filesystems
+
+        total = os.fstat(fsrc.fileno()).st_size
+        for start, end in _get_data_ranges(fsrc.fileno(), total):
+            fsrc.seek(start)
+            while start < end:
+                chunk = fsrc.read(min(buffer_size, end - start))
+                if not chunk:
+                    break
+                write_sparse(fdst, start, chunk)
+                start += len(chunk)
+        fdst.truncate(total)
+    return "sparse"
+
+
+def write_sparse(fdst, offset, chunk):
+    """ write chunk at offset in fdst, skipping (not writing) zero-filled blocks
+
+        file must be truncated to its final size once all written """
+    for start in range(0, len(chunk), SPARSE_BLOCK_SIZE):
+        block = chunk[start : start + SPARSE_BLOCK_SIZE]
+        if block.count(0) != len(block):
+            fdst.seek(offset + start)
+            fdst.write(block)
+
+
+def get_file_extents(fpath):
+    """ number of extents (contiguous areas on disk) of a file. None if unknown
+
+        uses FIEMAP ioctl (linux only ; not supported by all filesystems) """
+    if sys.platform != "linux":
+        return None
+    import fcntl
+
+    # struct fiemap: start, length, flags, mapped_extents, extent_count, reserved
+    request = struct.pack("=QQIIII", 0, 2 ** 64 - 1, FIEMAP_FLAG_SYNC, 0, 0, 0)
+    try:
+        with open(fpath, "rb") as fd:
+            response = fcntl.ioctl(fd.fileno(), FS_IOC_FIEMAP, request)
+    except OSError:
+        return None
+    return struct.unpack("=QQIIII", response)[3]
+
+
+def drop_from_page_cache(fpath):
+    """ ask kernel to evict fpath's (synced) pages so next read hits the disk """
+    if not hasattr(os, "posix_fadvise"):
+        return
+    try:
+        fd = os.open(fpath, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+    except OSError:
+        pass
+
+
+def _get_data_ranges(fd, size):
+    """ (start, end) offsets of areas holding data (not holes) in fd's file
+
+        whole file if filesystem doesn't support SEEK_DATA/SEEK_HOLE """
+    if not hasattr(os, "SEEK_DATA"):
+        return [(0, size)]
+    ranges = []
+    offset = 0
+    try:
+        while offset < size:
+            try:
+                start = os.lseek(fd, offset, os.SEEK_DATA)
+            except OSError as exp:
+                if exp.errno == errno.ENXIO:  # no data after offset
+                    break
+                raise
+            offset = os.lseek(fd, start, os.SEEK_HOLE)
+            ranges.append((start, offset))
+    except OSError:
+        return [(0, size)]
+    return ranges
+
+
+def _copy_chunks(fsrc, fdst, method, buffer_size, hasher=None):
+    """ generator copying fsrc to fdst from their position, yielding chunk sizes """
+    in_fd, out_fd = fsrc.fileno(), fdst.fileno()
+    if method == "copy_file_range":
+        while True:
+            nb_bytes = os.copy_file_range(in_fd, out_fd, buffer_size)
+            if not nb_bytes:
+                return
+            yield nb_bytes
+    elif method == "sendfile":
+        offset = fsrc.tell()
+        while True:
+            nb_bytes = os.sendfile(out_fd, in_fd, offset, buffer_size)
+            if not nb_bytes:
+                return
+            offset += nb_bytes
+            # sendfile doesn't move in_fd's position
+            fsrc.seek(offset)
+            yield nb_bytes
+    else:
+        buffer = memoryview(bytearray(buffer_size))
+        while True:
+            nb_bytes = fsrc.readinto(buffer)
+            if not nb_bytes:
+                return
+            fdst.write(buffer[:nb_bytes])
+            if hasher is not None:
+                hasher.update(buffer[:nb_bytes])
+            yield nb_bytes
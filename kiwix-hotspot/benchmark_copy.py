@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+""" compare file copy speed of shutil.copy and our copy engine onto a target
+
+    target should be an exFAT partition, as contents are copied onto. ex:
+        truncate -s 8G /tmp/bench.img && mkfs.exfat /tmp/bench.img
+        sudo mount -o loop,uid=$(id -u) /tmp/bench.img /mnt/bench
+        python benchmark_copy.py --target /mnt/bench --size 2GiB
+"""
+
+import os
+import sys
+import time
+import shutil
+import argparse
+
+import humanfriendly
+
+from util import CLILogger, human_readable_size, ONE_MiB
+from backend.util import copy_file
+
+
+def create_source(fpath, size):
+    """ random-filled file of size bytes (not compressible, not sparse) """
+    with open(fpath, "wb") as fd:
+        remaining = size
+        while remaining:
+            chunk = min(remaining, ONE_MiB * 16)
+            fd.write(os.urandom(chunk))
+            remaining -= chunk
+
+
+def flush_caches():
+    """ sync and drop page cache (if permitted) so each copy reads from disk """
+    os.sync()
+    try:
+        with open("/proc/sys/vm/drop_caches", "w") as fd:
+            fd.write("3")
+    except OSError:
+        pass
+
+
+def timed_copy(func, src, dst):
+    """ duration (seconds) of func(src, dst) including sync to disk """
+    flush_caches()
+    started_on = time.time()
+    func(src, dst)
+    os.sync()
+    duration = time.time() - started_on
+    os.unlink(dst)
+    return duration
+
+
+def benchmark(logger, target, size, source=None, rounds=3):
+    created = source is None
+    if created:
+        source = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".bench.src")
+        logger.step("Creating {} source file".format(human_readable_size(size)))
+        create_source(source, size)
+    size = os.path.getsize(source)
+
+    methods = [("shutil.copy", shutil.copy), ("copy_file", copy_file)]
+    dst = os.path.join(target, "bench.dst")
+    try:
+        for name, func in methods:
+            logger.step("Copying with {} ({} rounds)".format(name, rounds))
+            durations = [timed_copy(func, source, dst) for _ in range(rounds)]
+            for duration in durations:
+                logger.std(
+                    "  {d:.2f}s ({r}/s)".format(
+                        d=duration, r=human_readable_size(size / duration)
+                    )
+                )
+            best = min(durations)
+            logger.succ(
+                "{name}: best {d:.2f}s ({r}/s)".format(
+                    name=name, d=best, r=human_readable_size(size / best)
+                )
+            )
+    finally:
+        if created:
+            os.unlink(source)
+    return 0
+
+
+def main():
+    logger = CLILogger()
+
+    parser = argparse.ArgumentParser(description="File copy benchmark")
+    parser.add_argument("--target", help="Folder to copy into", required=True)
+    parser.add_argument("--size", help="Size of generated source", default="1GiB")
+    parser.add_argument("--source", help="Use this file instead of generating one")
+    parser.add_argument("--rounds", help="Copies per method", type=int, default=3)
+    # defaults to help
+    args = parser.parse_args(["--help"] if len(sys.argv) < 2 else None)
+
+    if not os.path.isdir(args.target):
+        logger.err("Target is not a directory.")
+        sys.exit(1)
+
+    sys.exit(
+        benchmark(
+            logger,
+            target=args.target,
+            size=humanfriendly.parse_size(args.size),
+            source=args.source,
+            rounds=args.rounds,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -6,6 +6,7 @@
     - show contents and their status (usable or not)
     - clean all not usable contents
     - reset the cache folder completely
+    - recompute recorded checksums of cache files
 """
 
 import os
@@ -15,7 +16,8 @@ import argparse
 from backend.content import CONTENTS
 from util import CLILogger, get_cache
 from backend.catalog import get_catalogs
-from backend.cache import list_cache_files, clean_cache, reset_cache
+from backend.cache import list_cache_files, clean_cache, reset_cache, rehash_cache
+from backend.cache import max_hash_jobs
 
 
 def init(logger):
@@ -49,6 +51,19 @@ def main():
     )
     parser_clean.set_defaults(func=clean_cache)
 
+    for subparser in (parser_show, parser_clean):
+        subparser.add_argument(
+            "--jobs",
+            help="Number of files to analyze simultaneously",
+            type=int,
+            default=max_hash_jobs,
+        )
+        subparser.add_argument(
+            "--quick",
+            help="Trust recorded checksums of files which size didn't change",
+            action="store_true",
+        )
+
     parser_reset = subparsers.add_parser("reset", help="Reset cache folder completely")
     parser_reset.set_defaults(func=reset_cache)
     parser_reset.add_argument(
@@ -57,6 +72,11 @@ def main():
         action="store_true",
     )
 
+    parser_rehash = subparsers.add_parser(
+        "rehash", help="Recompute checksums of all files in cache"
+    )
+    parser_rehash.set_defaults(func=rehash_cache)
+
     # defaults to help
     args = parser.parse_args(["--help"] if len(sys.argv) < 2 else None)
 
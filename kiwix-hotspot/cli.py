@@ -35,6 +35,8 @@ from backend.catalog import get_catalogs
 from run_installation import run_installation
 from util import human_readable_size, get_cache, ONE_GB
 from backend.util import sd_has_single_partition, is_admin
+from backend.download import max_concurrent_downloads
+from backend.content import max_concurrent_actions
 
 import tzlocal
 import humanfriendly
@@ -156,8 +158,7 @@ if get_catalogs(logger) is None:
 
 zim_choices = []
 for catalog in get_catalogs(logger):
-    for (key, _) in catalog["all"].items():
-        zim_choices.append(key)
+    zim_choices += list(catalog["all"].keys())
 
 languages = [code for code, language in data.hotspot_languages]
 
@@ -225,6 +226,70 @@ parser.add_argument(
 parser.add_argument("--filename", help="Output file name (without suffix)")
 parser.add_argument("--shrink", help="Shrink image file", choices=["yes", "no"])
 parser.add_argument("--ram", help="Max RAM for QEMU", default="2G")
+parser.add_argument(
+    "--downloads",
+    help="Number of concurrent downloads",
+    type=int,
+    default=max_concurrent_downloads,
+)
+parser.add_argument(
+    "--pipelined",
+    action="store_true",
+    help="Download contents in background while configuring image",
+)
+parser.add_argument(
+    "--copies",
+    help="Number of contents copied or extracted concurrently onto the image",
+    type=int,
+    default=max_concurrent_actions,
+)
+parser.add_argument(
+    "--plan-writes",
+    action="store_true",
+    help="Write large files first (one at a time) then extracted folders "
+    "to limit fragmentation on the data partition",
+)
+parser.add_argument(
+    "--verify",
+    action="store_true",
+    help="Re-read copied files from the data partition and check their checksum",
+)
+parser.add_argument(
+    "--no-mount",
+    action="store_true",
+    help="Write the data partition's exFAT filesystem from host, "
+    "without formating nor mounting it (no FUSE, no elevation). "
+    "Requires extra space in build-dir for the extracted archives",
+)
+parser.add_argument(
+    "--host-resize",
+    action="store_true",
+    help="Resize partitions from host instead of booting the VM for it",
+)
+parser.add_argument(
+    "--cached-master",
+    action="store_true",
+    help="Keep the extracted master image in cache "
+    "and clone build images from it (reflink or sparse copy)",
+)
+parser.add_argument(
+    "--overlay",
+    action="store_true",
+    help="Run setup on a qcow2 overlay of the cached master image "
+    "(converted to a sparse raw image for the copy stage)",
+)
+parser.add_argument(
+    "--snapshots",
+    action="store_true",
+    help="Resume first VM boot from a saved state (boot snapshot kept in cache) "
+    "instead of booting it. Requires --overlay",
+)
+parser.add_argument(
+    "--cache-quota",
+    help="Maximum size of the cache folder. "
+    "Least recently used files are removed before downloads. "
+    "Defaults to CACHE_QUOTA (prefs or environ) if set",
+)
 parser.add_argument("--sdcard", help="Device to copy image to")
 parser.add_argument(
     "--root",
@@ -289,6 +354,13 @@ except Exception:
     print("Unable to understand required size ({})".format(args.size))
     sys.exit(1)
 
+if args.cache_quota:
+    try:
+        args.cache_quota = humanfriendly.parse_size(args.cache_quota)
+    except Exception:
+        print("Unable to understand cache quota ({})".format(args.cache_quota))
+        sys.exit(1)
+
 # check arguments
 (
     valid_project_name,
@@ -444,6 +516,18 @@ try:
         filename=args.filename,
         shrink_to=args.physical_size,
         qemu_ram=args.ram,
+        concurrent_downloads=args.downloads,
+        pipelined=args.pipelined,
+        cache_quota=args.cache_quota,
+        concurrent_copies=args.copies,
+        verify=args.verify,
+        plan_writes=args.plan_writes,
+        userspace_exfat=args.no_mount,
+        host_resize=args.host_resize,
+        cached_master=args.cached_master,
+        overlay=args.overlay,
+        snapshots=args.snapshots,
+        collection=collection,
     )
 except Exception:
     cancel_event.cancel()
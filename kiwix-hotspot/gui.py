@@ -269,6 +269,7 @@ def validate_label(label, condition):
 class Application:
     def __init__(self):
         self.catalogs = None
+        self.build_plan = None  # (selection, BuildPlan) of last selected contents
 
         builder = Gtk.Builder()
         builder.add_from_file(data.ui_glade)
@@ -473,7 +474,8 @@ class Application:
         def get_project_size(name, lang):
             langs = ["fr", "en"] if name == "aflatoun" else [lang]
             return get_expanded_size(
-                get_collection(**{"{}_languages".format(name): langs}), add_margin=False
+                self.get_build_plan(**{"{}_languages".format(name): langs}),
+                add_margin=False,
             )
 
         # kalite
@@ -532,7 +534,7 @@ class Application:
             "{} ({})".format(
                 self.component.nomad_label.get_label(),
                 human_readable_size(
-                    get_expanded_size(get_collection(nomad=True), add_margin=False)
+                    get_expanded_size(self.get_build_plan(nomad=True), add_margin=False)
                 ),
             )
         )
@@ -545,7 +547,9 @@ class Application:
             "{} ({})".format(
                 self.component.mathews_label.get_label(),
                 human_readable_size(
-                    get_expanded_size(get_collection(mathews=True), add_margin=False)
+                    get_expanded_size(
+                        self.get_build_plan(mathews=True), add_margin=False
+                    )
                 ),
             )
         )
@@ -558,7 +562,9 @@ class Application:
             "{} ({})".format(
                 self.component.africatik_label.get_label(),
                 human_readable_size(
-                    get_expanded_size(get_collection(africatik=True), add_margin=False)
+                    get_expanded_size(
+                        self.get_build_plan(africatik=True), add_margin=False
+                    )
                 ),
             )
         )
@@ -572,7 +578,7 @@ class Application:
                 self.component.africatikmd_label.get_label(),
                 human_readable_size(
                     get_expanded_size(
-                        get_collection(africatikmd=True), add_margin=False
+                        self.get_build_plan(africatikmd=True), add_margin=False
                     )
                 ),
             )
@@ -587,6 +593,12 @@ class Application:
         self.catalogs_thread = threading.Thread(target=self.download_catalogs)
         self.catalogs_thread.start()
 
+    def get_build_plan(self, **selection):
+        """ BuildPlan of selected contents, reused while selection is unchanged """
+        if self.build_plan is None or self.build_plan[0] != selection:
+            self.build_plan = (selection, get_collection(**selection))
+        return self.build_plan[1]
+
     def ensure_connection(self):
         """test and return Connection Status. Display Error of failure"""
         conn_working, failed_protocol = test_connection()
@@ -1910,19 +1922,19 @@ class Application:
 
         africatikmd = self.component.africatikmd_switch.get_active()
 
-        collection = get_collection(
-            edupi=edupi,
-            edupi_resources=edupi_resources,
-            nomad=nomad,
-            mathews=mathews,
-            africatik=africatik,
-            africatikmd=africatikmd,
-            packages=zim_install,
-            kalite_languages=kalite or [],
-            wikifundi_languages=wikifundi or [],
-            aflatoun_languages=["fr", "en"] if aflatoun else [],
-        )
         try:
+            collection = self.get_build_plan(
+                edupi=edupi,
+                edupi_resources=edupi_resources,
+                nomad=nomad,
+                mathews=mathews,
+                africatik=africatik,
+                africatikmd=africatikmd,
+                packages=zim_install,
+                kalite_languages=kalite or [],
+                wikifundi_languages=wikifundi or [],
+                aflatoun_languages=["fr", "en"] if aflatoun else [],
+            )
             required_image_size = get_required_image_size(collection)
         except FileNotFoundError:
             self.display_error_message(
@@ -2003,6 +2015,7 @@ class Application:
                         self.installation_done, error
                     ),
                     shrink_to=physical_size,
+                    collection=collection,
                 )
 
             self.component.window.hide()
@@ -2075,19 +2088,19 @@ class Application:
         africatik = self.component.africatik_switch.get_active()
         africatikmd = self.component.africatikmd_switch.get_active()
 
-        collection = get_collection(
-            edupi=edupi,
-            edupi_resources=edupi_resources,
-            nomad=nomad,
-            mathews=mathews,
-            africatik=africatik,
-            africatikmd=africatikmd,
-            packages=zim_list,
-            kalite_languages=kalite,
-            wikifundi_languages=wikifundi,
-            aflatoun_languages=["fr", "en"] if aflatoun else [],
-        )
         try:
+            collection = self.get_build_plan(
+                edupi=edupi,
+                edupi_resources=edupi_resources,
+                nomad=nomad,
+                mathews=mathews,
+                africatik=africatik,
+                africatikmd=africatikmd,
+                packages=zim_list,
+                kalite_languages=kalite,
+                wikifundi_languages=wikifundi,
+                aflatoun_languages=["fr", "en"] if aflatoun else [],
+            )
             required_image_size = get_required_image_size(collection)
         except FileNotFoundError:
             self.display_error_message(
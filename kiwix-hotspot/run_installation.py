@@ -6,6 +6,7 @@ import sys
 import time
 import json
 import shutil
+import functools
 import traceback
 from datetime import datetime
 
@@ -14,7 +15,12 @@ from backend import qemu
 from util import (
     human_readable_size,
     get_cache,
+    get_temp_folder,
+    record_last_used,
+    get_trusted_checksum,
+    get_tmp_fpath,
     ensure_zip_exfat_compatible,
+    get_free_space_in_dir,
     EXFAT_FORBIDDEN_CHARS,
 )
 
@@ -22,26 +28,176 @@ from backend import ansiblecube
 from backend.content import (
     get_collection,
     get_content,
-    get_all_contents_for,
     isremote,
+    isarchive,
     get_content_cache,
     get_alien_content,
+    ActionsPool,
+    get_content_expanded_size,
+    verify_files,
+)
+from backend.cache import evict_cache, get_boot_snapshot_fnames
+from backend.download import (
+    download_content,
+    unzip_file,
+    extract_master_image,
+    get_extracted_master_fname,
+    DownloadScheduler,
+    Aria2RPC,
 )
-from backend.download import download_content, unzip_file
 from backend.mount import (
     mount_data_partition,
     unmount_data_partition,
     test_mount_procedure,
     format_data_partition,
+    build_data_partition,
     guess_next_loop_device,
 )
-from backend.util import EtcherWriterThread
+from backend.partition import resize_partitions, get_partition_table_signature
+from backend.util import EtcherWriterThread, clone_file
 from backend.util import prevent_sleep, restore_sleep_policy
 from backend.mount import can_write_on, allow_write_on, restore_mode
 from backend.sysreq import host_matches_requirements, requirements_url
 from backend.homepage import generate_homepage, save_homepage
 
 
+def ensure_retrieved(requested_files):
+    """ raise the download error of the first failed RequestedFile if any """
+    for rf in requested_files:
+        if rf is None:
+            raise IOError("content was not retrieved")
+        if not rf.successful:
+            raise rf.exception if rf.exception else IOError
+
+
+def ensure_downloads_not_failed(scheduler, logger):
+    """ abort with the download error if a (background) download already failed
+
+        pipelined build would only fail on copy stage, after minutes of setup """
+    try:
+        ensure_retrieved(scheduler.get_failures())
+    except Exception:
+        logger.err("Background download failed: aborting")
+        raise
+
+
+def check_edupi_resources(edupi_resources, cache_folder, logger):
+    """ ensure downloaded EduPi resources archive has exfat-compatible names """
+    if not edupi_resources:
+        return
+
+    logger.step("Verifying EduPi resources file names")
+    exfat_compat, exfat_errors = ensure_zip_exfat_compatible(
+        get_content_cache(get_alien_content(edupi_resources), cache_folder, True)
+    )
+    if not exfat_compat:
+        raise ValueError(
+            "Your EduPi resources archive is incorrect.\n"
+            "It should be a ZIP file of a root folder "
+            "in which all files have exfat-compatible "
+            "names (no {chars})\n... {fnames}".format(
+                chars=" ".join(EXFAT_FORBIDDEN_CHARS),
+                fnames="\n... ".join(exfat_errors),
+            )
+        )
+    else:
+        logger.std("EduPi resources archive OK")
+
+
+def copy_ansiblecube(emulation, logger):
+    """ copy ansiblecube again into the VM should the master-version been updated """
+    logger.step("Copy ansiblecube")
+    emulation.exec_cmd("sudo /bin/rm -rf {}".format(ansiblecube.ansiblecube_path))
+    emulation.put_dir(data.ansiblecube_path, ansiblecube.ansiblecube_path)
+
+
+def reset_overlay_image(emulator, overlay_fpath, master_fpath, size, logger):
+    """ replace the overlay by a fresh one of master, of size (cold boot) """
+    if os.path.exists(overlay_fpath):
+        os.unlink(overlay_fpath)
+    qemu.create_overlay_image(master_fpath, overlay_fpath, logger)
+    emulator.resize_image(size)
+
+
+def remove_boot_snapshot(snapshot_fpath, logger):
+    """ remove a cached snapshot that can't be used """
+    try:
+        os.unlink(snapshot_fpath)
+    except FileNotFoundError:
+        pass
+    except OSError as exp:
+        logger.err("Unable to remove {}: {}".format(snapshot_fpath, exp))
+
+
+def discard_boot_snapshot(
+    emulator, overlay_fpath, master_fpath, snapshot_fpath, size, logger, exp=None
+):
+    """ remove cached snapshot which failed to resume, reset overlay to cold-boot """
+    remove_boot_snapshot(snapshot_fpath, logger)
+    reset_overlay_image(emulator, overlay_fpath, master_fpath, size, logger)
+
+
+def restore_boot_snapshot(
+    emulator, overlay_fpath, master_fpath, snapshot_fpath, cancel_event, logger
+):
+    """ overlay holding a snapshot of the booted master. its name
+
+        cached overlay is cloned over the build's one. if not in cache
+        (or not backed by current master), VM is booted once then saved
+        and the overlay kept in cache, backed by the master next to it.
+        None if it can't be restored nor saved: overlay is reset to cold-boot.
+
+        evicting (from another process) a cached snapshot being cloned is safe:
+        its data remains readable until closed (POSIX) or it can't be removed
+        while open (windows). if removed before, cloning fails (cold boot) """
+    size = emulator.get_image_size()
+    if os.path.exists(snapshot_fpath) and not qemu.is_overlay_of(
+        snapshot_fpath, master_fpath
+    ):
+        logger.std("Cached VM boot snapshot is not based on current master")
+        remove_boot_snapshot(snapshot_fpath, logger)
+
+    if os.path.exists(snapshot_fpath):
+        logger.step("Restoring VM boot snapshot from cache")
+        try:
+            clone_file(snapshot_fpath, overlay_fpath)
+            qemu.rebase_overlay_image(overlay_fpath, master_fpath, logger)
+        except Exception as exp:
+            logger.err("Unable to restore VM boot snapshot: {}".format(exp))
+            reset_overlay_image(emulator, overlay_fpath, master_fpath, size, logger)
+            return None
+        try:
+            record_last_used(snapshot_fpath)
+        except OSError:
+            pass
+        return qemu.BOOT_SNAPSHOT
+
+    logger.step("Starting-up VM to create its boot snapshot")
+    tmp_fpath = get_tmp_fpath(snapshot_fpath)
+    try:
+        with emulator.run(cancel_event) as emulation:
+            emulation.suspend(qemu.BOOT_SNAPSHOT)
+        clone_file(overlay_fpath, tmp_fpath)
+        qemu.rebase_overlay_image(tmp_fpath, master_fpath, logger)
+        os.replace(tmp_fpath, snapshot_fpath)
+    except Exception as exp:
+        if cancel_event.is_set():
+            raise
+        logger.err("Unable to save VM boot snapshot: {}".format(exp))
+        reset_overlay_image(emulator, overlay_fpath, master_fpath, size, logger)
+        return None
+    finally:
+        if os.path.exists(tmp_fpath):
+            os.unlink(tmp_fpath)
+    # registered in cache as long as unchanged (see backend.cache)
+    get_trusted_checksum(snapshot_fpath)
+    try:
+        record_last_used(snapshot_fpath)
+    except OSError:
+        pass
+    return qemu.BOOT_SNAPSHOT
+
+
 def run_installation(
     name,
     timezone,
@@ -70,12 +226,29 @@ def run_installation(
     filename=None,
     qemu_ram="2G",
     shrink_to=None,
+    concurrent_downloads=None,
+    pipelined=False,
+    cache_quota=None,
+    concurrent_copies=None,
+    verify=False,
+    plan_writes=False,
+    userspace_exfat=False,
+    host_resize=False,
+    cached_master=False,
+    overlay=False,
+    snapshots=False,
+    collection=None,
 ):
+    """ build (and write) a hotspot image
+
+        collection: BuildPlan of the requested contents, if already resolved
+        by caller (built from the content arguments otherwise) """
 
     logger.start(bool(sd_card))
 
     logger.stage("init")
     cache_folder = get_cache(build_dir)
+    aria2 = None
 
     try:
         logger.std("Preventing system from sleeping")
@@ -113,6 +286,7 @@ def run_installation(
         image_final_path = os.path.join(build_dir, filename + ".img")
         image_building_path = os.path.join(build_dir, filename + ".BUILDING.img")
         image_error_path = os.path.join(build_dir, filename + ".ERROR.img")
+        image_overlay_path = os.path.join(build_dir, filename + ".BUILDING.qcow2")
 
         # loop device mode on linux (for mkfs in userspace)
         if sys.platform == "linux":
@@ -172,9 +346,15 @@ def run_installation(
 
         # Download Base image
         logger.stage("master")
-        logger.step("Retrieving base image file")
+        logger.step("Starting download manager")
+        try:
+            aria2 = Aria2RPC(logger, max_concurrent=concurrent_downloads).start()
+        except Exception as exp:
+            logger.err("Unable to use aria2c RPC, using one aria2c per file")
+            logger.err(str(exp))
 
-        rf = download_content(base_image, logger, build_dir)
+        logger.step("Retrieving base image file")
+        rf = download_content(base_image, logger, build_dir, aria2=aria2)
         if not rf.successful:
             logger.err("Failed to download base image.\n{e}".format(e=rf.exception))
             sys.exit(1)
@@ -182,93 +362,131 @@ def run_installation(
             logger.std("Reusing already downloaded base image ZIP file")
         logger.progress(0.5)
 
-        # extract base image and rename
-        logger.step("Extracting base image from ZIP file")
-        unzip_file(
-            archive_fpath=rf.fpath,
-            src_fname=base_image["name"].replace(".zip", ""),
-            build_folder=build_dir,
-            dest_fpath=image_building_path,
-        )
-        logger.std("Extraction complete: {p}".format(p=image_building_path))
+        # build on a qcow2 overlay of the extracted master (raw once on copy)
+        use_overlay = False
+        if overlay:
+            logger.step("Creating overlay image over cached base image")
+            try:
+                master_fpath = extract_master_image(
+                    rf.fpath, base_image, cache_folder, logger
+                )
+                record_last_used(master_fpath)
+                qemu.create_overlay_image(master_fpath, image_overlay_path, logger)
+                use_overlay = True
+            except Exception as exp:
+                logger.err("Unable to create overlay image: {}".format(exp))
+
+        # clone build image from an extracted master kept in cache
+        cloned = False
+        if cached_master and not use_overlay:
+            logger.step("Cloning base image from cache")
+            try:
+                master_fpath = extract_master_image(
+                    rf.fpath, base_image, cache_folder, logger
+                )
+                record_last_used(master_fpath)
+                method = clone_file(master_fpath, image_building_path)
+                logger.std(
+                    "Cloning complete ({m}): {p}".format(
+                        m=method, p=image_building_path
+                    )
+                )
+                cloned = True
+            except Exception as exp:
+                logger.err("Unable to clone base image from cache: {}".format(exp))
+
+        if not cloned and not use_overlay:
+            # extract base image and rename
+            logger.step("Extracting base image from ZIP file")
+            unzip_file(
+                archive_fpath=rf.fpath,
+                src_fname=get_extracted_master_fname(base_image),
+                build_folder=build_dir,
+                dest_fpath=image_building_path,
+            )
+            logger.std("Extraction complete: {p}".format(p=image_building_path))
         logger.progress(0.9)
 
-        if not os.path.exists(image_building_path):
+        if not use_overlay and not os.path.exists(image_building_path):
             raise IOError("image path does not exists: {}".format(image_building_path))
 
-        logger.step("Testing mount procedure")
-        if not test_mount_procedure(image_building_path, logger, True):
-            raise ValueError("thorough mount procedure failed")
+        # mount test requires the raw image (only built on copy stage in overlay)
+        if not userspace_exfat and not use_overlay:
+            logger.step("Testing mount procedure")
+            if not test_mount_procedure(image_building_path, logger, True):
+                raise ValueError("thorough mount procedure failed")
 
         # collection contains both downloads and processing callbacks
         # for all requested contents
-        collection = get_collection(
-            edupi=edupi,
-            edupi_resources=edupi_resources,
-            nomad=nomad,
-            mathews=mathews,
-            africatik=africatik,
-            africatikmd=africatikmd,
-            packages=packages,
-            kalite_languages=kalite_languages,
-            wikifundi_languages=wikifundi_languages,
-            aflatoun_languages=aflatoun_languages,
-        )
+        if collection is None:
+            collection = get_collection(
+                edupi=edupi,
+                edupi_resources=edupi_resources,
+                nomad=nomad,
+                mathews=mathews,
+                africatik=africatik,
+                africatikmd=africatikmd,
+                packages=packages,
+                kalite_languages=kalite_languages,
+                wikifundi_languages=wikifundi_languages,
+                aflatoun_languages=aflatoun_languages,
+            )
 
         # download contents into cache
         logger.stage("download")
         logger.step("Starting all content downloads")
-        downloads = list(get_all_contents_for(collection))
-        archives_total_size = sum([c["archive_size"] for c in downloads])
-        retrieved = 0
-
-        for dl_content in downloads:
-            logger.step(
-                "Retrieving {name} ({size})".format(
-                    name=dl_content["name"],
-                    size=human_readable_size(dl_content["archive_size"]),
-                )
-            )
-
-            rf = download_content(dl_content, logger, build_dir)
-            if not rf.successful:
-                logger.err(
-                    "Error downloading {u} to {p}\n{e}".format(
-                        u=dl_content["url"], p=rf.fpath, e=rf.exception
-                    )
-                )
-                raise rf.exception if rf.exception else IOError
-            elif rf.found:
-                logger.std("Reusing already downloaded {p}".format(p=rf.fpath))
-            else:
-                logger.std(
-                    "Saved `{p}` successfuly: {s}".format(
-                        p=dl_content["name"], s=human_readable_size(rf.downloaded_size)
-                    )
-                )
-            retrieved += dl_content["archive_size"]
-            logger.progress(retrieved, archives_total_size)
-
-        # check edupi resources compliance
-        if edupi_resources:
-            logger.step("Verifying EduPi resources file names")
-            exfat_compat, exfat_errors = ensure_zip_exfat_compatible(
-                get_content_cache(
-                    get_alien_content(edupi_resources), cache_folder, True
-                )
+        downloads = list(collection.contents)
+        missing_size = collection.get_download_size_using_cache(cache_folder)
+        # never evict contents of this build (nor its base image and snapshots)
+        if not evict_cache(
+            logger,
+            cache_folder,
+            missing_size,
+            [content["name"] for content in downloads]
+            + [base_image["name"], get_extracted_master_fname(base_image)]
+            + get_boot_snapshot_fnames(
+                cache_folder, get_extracted_master_fname(base_image)
+            ),
+            quota=cache_quota,
+        ):
+            raise ValueError("cache quota is too small for this build's contents")
+
+        if userspace_exfat:
+            # archives are extracted on host before being written into image
+            # (other contents are hard-linked from cache)
+            staged_size = sum(
+                [
+                    get_content_expanded_size(content)
+                    for content in downloads
+                    if isarchive(content["name"])
+                ]
             )
-            if not exfat_compat:
-                raise ValueError(
-                    "Your EduPi resources archive is incorrect.\n"
-                    "It should be a ZIP file of a root folder "
-                    "in which all files have exfat-compatible "
-                    "names (no {chars})\n... {fnames}".format(
-                        chars=" ".join(EXFAT_FORBIDDEN_CHARS),
-                        fnames="\n... ".join(exfat_errors),
+            free_space = get_free_space_in_dir(build_dir)
+            if free_space < missing_size + staged_size:
+                raise IOError(
+                    "Not enough space in {path} to download and stage contents "
+                    "on host: {req} required, {free} available".format(
+                        path=build_dir,
+                        req=human_readable_size(missing_size + staged_size),
+                        free=human_readable_size(free_space),
                     )
                 )
-            else:
-                logger.std("EduPi resources archive OK")
+        scheduler = DownloadScheduler(
+            downloads,
+            logger,
+            build_dir,
+            concurrency=concurrent_downloads,
+            aria2=aria2,
+            report_progress=not pipelined,
+            cancel_event=cancel_event,
+        )
+        if pipelined:
+            # contents are only needed on copy stage: download during setup
+            logger.std("Downloads will continue in background of setup")
+            scheduler.start()
+        else:
+            ensure_retrieved(scheduler.run())
+            check_edupi_resources(edupi_resources, cache_folder, logger)
 
         # instanciate emulator
         logger.stage("setup")
@@ -276,9 +494,10 @@ def run_installation(
         emulator = qemu.Emulator(
             data.vexpress_boot_kernel,
             data.vexpress_boot_dtb,
-            image_building_path,
+            image_overlay_path if use_overlay else image_building_path,
             logger,
             ram=qemu_ram,
+            image_format="qcow2" if use_overlay else "raw",
         )
 
         # Resize image
@@ -294,22 +513,77 @@ def run_installation(
 
         emulator.resize_image(size)
 
-        # Run emulation
-        logger.step("Starting-up VM (first-time)")
-        with emulator.run(cancel_event) as emulation:
-            # copying ansiblecube again into the VM
-            # should the master-version been updated
-            logger.step("Copy ansiblecube")
-            emulation.exec_cmd(
-                "sudo /bin/rm -rf {}".format(ansiblecube.ansiblecube_path)
+        # resize partitions on host to spare a VM boot
+        resized_on_host = False
+        if host_resize and use_overlay:
+            logger.std("Partitions of overlay image can't be resized on host")
+        elif host_resize:
+            logger.step("Resizing partitions on host")
+            try:
+                resize_partitions(
+                    image_building_path,
+                    base_image.get("root_partition_size"),
+                    size,
+                    logger,
+                )
+                resized_on_host = True
+            except Exception as exp:
+                logger.err("Failed to resize partitions on host: {}".format(exp))
+                logger.std("Resizing from VM instead")
+
+        # resume VM from its boot snapshot instead of booting it (qcow2 only).
+        # never resumed once partitions changed: guest would keep a stale table
+        boot_snapshot, on_resume_failure = None, None
+        if snapshots and not use_overlay:
+            logger.std("VM snapshots require an overlay image: booting VM")
+        elif snapshots and not resized_on_host:
+            ensure_downloads_not_failed(scheduler, logger)
+            snapshot_fpath = os.path.join(
+                cache_folder,
+                emulator.get_boot_snapshot_fname(
+                    get_extracted_master_fname(base_image),
+                    get_partition_table_signature(master_fpath),
+                ),
+            )
+            boot_snapshot = restore_boot_snapshot(
+                emulator,
+                image_overlay_path,
+                master_fpath,
+                snapshot_fpath,
+                cancel_event,
+                logger,
+            )
+            # unusable snapshot (corrupt, unsupported by QEMU): cold boot
+            on_resume_failure = functools.partial(
+                discard_boot_snapshot,
+                emulator,
+                image_overlay_path,
+                master_fpath,
+                snapshot_fpath,
+                size,
+                logger,
             )
-            emulation.put_dir(data.ansiblecube_path, ansiblecube.ansiblecube_path)
-
-            logger.step("Run ansiblecube for `resize`")
-            ansiblecube.run(emulation, ["resize"], extra_vars, secret_keys)
 
+        if not resized_on_host:
+            # Run emulation
+            ensure_downloads_not_failed(scheduler, logger)
+            logger.step("Starting-up VM (first-time)")
+            with emulator.run(
+                cancel_event,
+                snapshot=boot_snapshot,
+                on_resume_failure=on_resume_failure,
+            ) as emulation:
+                copy_ansiblecube(emulation, logger)
+
+                logger.step("Run ansiblecube for `resize`")
+                ansiblecube.run(emulation, ["resize"], extra_vars, secret_keys)
+
+        # cold boot: new partition table is only read on boot
+        ensure_downloads_not_failed(scheduler, logger)
         logger.step("Starting-up VM (second-time)")
         with emulator.run(cancel_event) as emulation:
+            if resized_on_host:
+                copy_ansiblecube(emulation, logger)
 
             logger.step("Run ansiblecube phase I")
             ansiblecube.run_phase_one(
@@ -320,56 +594,107 @@ def run_installation(
                 logo=logo,
                 favicon=favicon,
                 css=css,
+                mount_data=resized_on_host,
             )
 
         # wait for QEMU to release file (windows mostly)
         time.sleep(10)
+        ensure_downloads_not_failed(scheduler, logger)
 
         # mount image's 3rd partition on host
         logger.stage("copy")
 
-        logger.step("Formating data partition on host")
-        format_data_partition(image_building_path, logger)
+        if use_overlay:
+            # data partition is formatted/written on host: raw image required
+            logger.step("Converting overlay image to raw image")
+            emulator.convert_image(image_building_path)
+            os.unlink(image_overlay_path)
+
+        if pipelined and edupi_resources:
+            logger.step("Waiting for EduPi resources download")
+            ensure_retrieved(scheduler.wait_for([get_alien_content(edupi_resources)]))
+            check_edupi_resources(edupi_resources, cache_folder, logger)
+
+        if userspace_exfat:
+            # contents are processed into a host folder then written
+            # as an exfat filesystem directly inside the image
+            logger.step("Preparing data partition contents on host")
+            mount_point, device = get_temp_folder(build_dir), None
+        else:
+            logger.step("Formating data partition on host")
+            format_data_partition(image_building_path, logger)
 
-        logger.step("Mounting data partition on host")
+            logger.step("Mounting data partition on host")
         # copy contents from cache to mount point
         try:
-            mount_point, device = mount_data_partition(image_building_path, logger)
+            if not userspace_exfat:
+                mount_point, device = mount_data_partition(image_building_path, logger)
             logger.step("Processing downloaded content onto data partition")
-            expanded_total_size = sum([c["expanded_size"] for c in downloads])
-            processed = 0
-
-            for category, content_dl_cb, content_run_cb, cb_kwargs in collection:
+            expanded_total_size = sum([get_content_expanded_size(c) for c in downloads])
+
+            # actions are submitted per category and run concurrently
+            with ActionsPool(
+                logger,
+                expanded_total_size,
+                concurrency=concurrent_copies,
+                plan_writes=plan_writes,
+                link_files=userspace_exfat,
+            ) as pool:
+                for category, contents, run_cb, cb_kwargs in collection.categories:
+
+                    if pipelined:
+                        logger.step("Waiting for {cat} downloads".format(cat=category))
+                        ensure_retrieved(scheduler.wait_for(contents))
+
+                    logger.step("Processing {cat}".format(cat=category))
+                    run_cb(
+                        cache_folder=cache_folder,
+                        mount_point=mount_point,
+                        logger=logger,
+                        pool=pool,
+                        **cb_kwargs
+                    )
+                logger.step("Waiting for all contents to be processed")
+                pool.join()
+
+            if verify and userspace_exfat:
+                logger.std("Not verifying files: data partition is written from host")
+            elif verify:
+                logger.step("Verifying copied files")
+                failed = verify_files(pool.written, logger, jobs=concurrent_copies)
+                if failed:
+                    raise IOError(
+                        "{nb} file(s) corrupted on data partition:\n{fpaths}".format(
+                            nb=len(failed), fpaths="\n".join(failed)
+                        )
+                    )
 
-                logger.step("Processing {cat}".format(cat=category))
-                content_run_cb(
-                    cache_folder=cache_folder,
-                    mount_point=mount_point,
-                    logger=logger,
-                    **cb_kwargs
-                )
-                # size of expanded files for this category (for progress)
-                processed += sum(
-                    [c["expanded_size"] for c in content_dl_cb(**cb_kwargs)]
-                )
-                logger.progress(processed, expanded_total_size)
+            if userspace_exfat:
+                logger.step("Writing data partition into image")
+                build_data_partition(image_building_path, mount_point, logger)
         except Exception as exp:
-            try:
-                unmount_data_partition(mount_point, device, logger)
-            except NameError:
-                pass  # if mount_point or device are not defined
+            if not userspace_exfat:
+                try:
+                    unmount_data_partition(mount_point, device, logger)
+                except NameError:
+                    pass  # if mount_point or device are not defined
             raise exp
+        finally:
+            if userspace_exfat:
+                # staged contents are not needed anymore, whatever happened
+                shutil.rmtree(mount_point, ignore_errors=True)
 
-        # make sure to sync before unmounting
-        if sys.platform in ("linux", "darwin"):
-            os.sync()
-        time.sleep(10)
+        if not userspace_exfat:
+            # make sure to sync before unmounting
+            if sys.platform in ("linux", "darwin"):
+                os.sync()
+            time.sleep(10)
 
-        # unmount partition
-        logger.step("Unmounting data partition")
-        unmount_data_partition(mount_point, device, logger)
+            # unmount partition
+            logger.step("Unmounting data partition")
+            unmount_data_partition(mount_point, device, logger)
 
-        time.sleep(10)
+            time.sleep(10)
 
         # rerun emulation for discovery
         logger.stage("move")
@@ -397,6 +722,8 @@ def run_installation(
         # Set final image filename
         if os.path.isfile(image_building_path):
             os.rename(image_building_path, image_error_path)
+        if os.path.isfile(image_overlay_path):
+            os.rename(image_overlay_path, image_error_path.replace(".img", ".qcow2"))
 
         error = e
     else:
@@ -463,6 +790,10 @@ def run_installation(
             logger.complete()
             error = None
     finally:
+        if aria2 is not None:
+            logger.std("Stopping download manager")
+            aria2.stop()
+
         logger.std("Restoring system sleep policy")
         restore_sleep_policy(sleep_ref, logger)
 
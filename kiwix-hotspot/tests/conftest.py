@@ -0,0 +1,5 @@
+import os
+import sys
+
+# modules are imported relative to kiwix-hotspot/ (as when launched)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,150 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+
+from backend.download import Aria2RPC
+
+SECRET = "s3cr3t"
+
+
+class Logger(object):
+    on_tty = False
+
+    def std(self, *args, **kwargs):
+        pass
+
+    def ascii_progressbar(self, current, total):
+        pass
+
+
+def status(gid, state, size=100, followers=None, path=None):
+    return {
+        "gid": gid,
+        "status": state,
+        "totalLength": str(size),
+        "completedLength": str(size if state == "complete" else 0),
+        "downloadSpeed": "0",
+        "errorCode": "0" if state != "error" else "3",
+        "errorMessage": "" if state != "error" else "Resource not found",
+        "followedBy": followers or [],
+        "files": [{"path": path or "/tmp/{}".format(gid)}],
+    }
+
+
+class StubAria2(BaseHTTPRequestHandler):
+    """ aria2c JSON-RPC: tellStatus answers are consumed from `statuses` """
+
+    statuses = {}  # gid: list of successive statuses (last one sticks)
+    calls = []
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        token, params = request["params"][0], request["params"][1:]
+        self.calls.append((request["method"], params))
+        if token != "token:{}".format(SECRET):
+            payload = {"error": {"code": 1, "message": "Unauthorized"}}
+        elif request["method"] == "aria2.tellStatus":
+            answers = self.statuses[params[0]]
+            payload = {"result": answers.pop(0) if len(answers) > 1 else answers[0]}
+        elif request["method"] == "aria2.addUri":
+            payload = {"result": "0000000000000001"}
+        else:
+            payload = {"result": "OK"}
+
+        body = json.dumps(dict(jsonrpc="2.0", id=request["id"], **payload)).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def rpc():
+    server = HTTPServer(("127.0.0.1", 0), StubAria2)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    StubAria2.statuses = {}
+    StubAria2.calls = []
+
+    rpc = Aria2RPC(Logger())
+    rpc.port, rpc.secret = server.server_address[1], SECRET
+    rpc.poll_interval = 0
+    yield rpc
+    server.shutdown()
+    server.server_close()
+
+
+def test_call_error(rpc):
+    rpc.secret = "wrong"
+    with pytest.raises(IOError, match="Unauthorized"):
+        rpc.call("aria2.getVersion")
+
+
+def test_wait_polls_until_finished(rpc):
+    StubAria2.statuses = {
+        "a": [status("a", "waiting"), status("a", "active"), status("a", "complete")]
+    }
+    progresses = []
+    final = rpc.wait("a", Logger(), lambda done, total: progresses.append(done))
+    assert final["status"] == "complete"
+    assert progresses == [0, 0, 100]
+    assert ("aria2.removeDownloadResult", ["a"]) in StubAria2.calls
+
+
+def test_wait_follows_all_metalink_followers(rpc):
+    StubAria2.statuses = {
+        "meta": [status("meta", "complete", 1, followers=["f1", "f2"])],
+        "f1": [status("f1", "active"), status("f1", "complete")],
+        "f2": [status("f2", "active"), status("f2", "active"), status("f2", "error")],
+    }
+    progresses = []
+    final = rpc.wait("meta", Logger(), lambda done, total: progresses.append(total))
+    assert final["gid"] == "f2"
+    assert final["status"] == "error"
+    assert progresses[-1] == 200  # metalink file itself is not accounted
+    removed = [params[0] for method, params in StubAria2.calls if "remove" in method]
+    assert sorted(removed) == ["f1", "f2", "meta"]
+
+
+def test_wait_returns_last_follower(rpc):
+    StubAria2.statuses = {
+        "meta": [status("meta", "complete", 1, followers=["f1", "f2"])],
+        "f1": [status("f1", "complete")],
+        "f2": [status("f2", "active"), status("f2", "complete")],
+    }
+    assert rpc.wait("meta", Logger())["gid"] == "f2"
+
+
+def test_download(rpc, tmp_path):
+    target = tmp_path / "named-after-metalink.zip"
+    target.write_bytes(b"x" * 100)
+    StubAria2.statuses = {
+        "0000000000000001": [status("0000000000000001", "complete", path=str(target))]
+    }
+    fpath = tmp_path / "content.zip"
+    rf = rpc.download("http://localhost/content.zip", str(fpath), Logger(), None, None)
+    assert rf.downloaded
+    assert rf.downloaded_size == 100
+    assert fpath.exists() and not target.exists()
+
+
+def test_download_failure(rpc, tmp_path):
+    StubAria2.statuses = {"0000000000000001": [status("0000000000000001", "error")]}
+    rf = rpc.download("http://localhost/a.zip", str(tmp_path / "a.zip"), Logger())
+    assert not rf.successful
+    assert "Resource not found" in str(rf.exception)
+
+
+def test_sessions_per_thread(rpc):
+    sessions = []
+    thread = threading.Thread(target=lambda: sessions.append(rpc.session))
+    thread.start()
+    thread.join()
+    assert sessions[0] is not rpc.session
+    assert rpc.session is rpc.session
@@ -0,0 +1,77 @@
+import os
+import sys
+import tarfile
+
+import pytest
+
+from backend.download import unarchive, get_tar_listing_allocated_size
+from backend.exfat import MAX_CLUSTER_SIZE, get_allocated_folder_size
+
+
+class Logger(object):
+    def std(self, *args, **kwargs):
+        pass
+
+    def raw_std(self, *args, **kwargs):
+        pass
+
+
+@pytest.fixture
+def archive_fpath(tmp_path):
+    """ tar.gz holding a `content/` folder (the useful one) and another """
+    source = tmp_path / "source"
+    for path, size in (
+        ("content/index.html", 12),
+        ("content/data/large.bin", MAX_CLUSTER_SIZE * 2 + 1),
+        ("content/data/empty.bin", 0),
+        ("content/with space.txt", 5),
+        ("other/ignored.bin", MAX_CLUSTER_SIZE),
+    ):
+        fpath = source.joinpath(*path.split("/"))
+        fpath.parent.mkdir(parents=True, exist_ok=True)
+        fpath.write_bytes(b"x" * size)
+    (source / "content" / "empty-folder").mkdir()
+    os.symlink("index.html", str(source / "content" / "link.html"))
+
+    fpath = tmp_path / "archive.tar.gz"
+    with tarfile.open(str(fpath), "w:gz") as tar:
+        tar.add(str(source / "content"), arcname="content")
+        tar.add(str(source / "other"), arcname="other")
+    return str(fpath)
+
+
+def test_tar_listing_allocated_size():
+    lines = [
+        "drwxr-xr-x user/group         0 2019-03-04 10:00 content/\n",
+        "-rw-r--r-- user/group        12 2019-03-04 10:00 content/index.html\n",
+        "-rw-r--r-- 1000/1000          0 2019-03-04 10:00 content/a b.txt\n",
+        "lrwxrwxrwx user/group         0 2019-03-04 10:00 content/l -> index.html\n",
+        "tar: some warning\n",
+    ]
+    assert get_tar_listing_allocated_size(lines) == MAX_CLUSTER_SIZE * 2
+    assert get_tar_listing_allocated_size(lines, "content") == MAX_CLUSTER_SIZE
+
+
+@pytest.mark.skipif(sys.platform != "linux", reason="GNU tar required")
+@pytest.mark.parametrize("with_progress", [False, True])
+def test_unarchive_measures_from_listing(tmp_path, archive_fpath, with_progress):
+    dest = tmp_path / "dest"
+    dest.mkdir()
+    progresses = []
+    size = unarchive(
+        archive_fpath,
+        str(dest),
+        Logger(),
+        strip_prefix="content",
+        progress_cb=(lambda *args: progresses.append(args)) if with_progress else None,
+    )
+    os.unlink(str(dest / "link.html"))  # not extracted on exfat
+    assert sorted(os.listdir(str(dest))) == [
+        "data",
+        "empty-folder",
+        "index.html",
+        "with space.txt",
+    ]
+    # same as walking the extracted tree, but its root folder
+    assert size == get_allocated_folder_size(str(dest)) - MAX_CLUSTER_SIZE
+    assert bool(progresses) == with_progress
@@ -0,0 +1,200 @@
+import os
+import shutil
+import struct
+import subprocess
+
+import pytest
+
+from backend.exfat import ExfatBuilder, get_cluster_size
+from util import ONE_MiB
+
+VOLUME_SIZE = 64 * ONE_MiB
+LONG_NAME = "{}.txt".format("long-name-" * 24)
+UNICODE_NAME = "café-été-Ωμέγα-中文.txt"
+
+
+class Logger(object):
+    def std(self, *args, **kwargs):
+        pass
+
+
+def entry_set_checksum(data):
+    checksum = 0
+    for index, byte in enumerate(data):
+        if index in (2, 3):
+            continue
+        checksum = (((checksum >> 1) | (checksum << 15)) + byte) & 0xFFFF
+    return checksum
+
+
+class ExfatReader(object):
+    """ minimal exFAT reader: walks folders and reads files back """
+
+    def __init__(self, fpath, offset=0):
+        self.fd = open(fpath, "rb")
+        self.offset = offset
+        boot = self.read(0, 512)
+        assert boot[3:11] == b"EXFAT   "
+        assert boot[510:512] == b"\x55\xaa"
+        (
+            fat_offset,
+            _,
+            heap_offset,
+            self.cluster_count,
+            self.root_cluster,
+        ) = struct.unpack_from("<IIIII", boot, 80)
+        self.sector_size = 1 << boot[108]
+        self.cluster_size = self.sector_size << boot[109]
+        self.fat_offset = fat_offset * self.sector_size
+        self.heap_offset = heap_offset * self.sector_size
+
+    def close(self):
+        self.fd.close()
+
+    def read(self, offset, length):
+        self.fd.seek(self.offset + offset)
+        return self.fd.read(length)
+
+    def get_chain(self, first_cluster, length, contiguous):
+        if contiguous:
+            return list(
+                range(first_cluster, first_cluster + -(-length // self.cluster_size))
+            )
+        chain = [first_cluster]
+        while True:
+            (next_cluster,) = struct.unpack(
+                "<I", self.read(self.fat_offset + chain[-1] * 4, 4)
+            )
+            if next_cluster == 0xFFFFFFFF:
+                return chain
+            assert 2 <= next_cluster < self.cluster_count + 2
+            chain.append(next_cluster)
+
+    def read_data(self, first_cluster, length, contiguous=True):
+        if not first_cluster:
+            return b""
+        data = b"".join(
+            self.read(
+                self.heap_offset + (cluster - 2) * self.cluster_size, self.cluster_size
+            )
+            for cluster in self.get_chain(first_cluster, length, contiguous)
+        )
+        return data[:length] if length is not None else data
+
+    def listdir(self, data):
+        """ {name: (is_dir, first_cluster, length, contiguous)} of a folder """
+        entries = {}
+        index = 0
+        while index < len(data) // 32 and data[index * 32] != 0:
+            entry = data[index * 32 : index * 32 + 32]
+            if entry[0] != 0x85:
+                index += 1
+                continue
+            nb_secondary = entry[1]
+            entry_set = data[index * 32 : (index + 1 + nb_secondary) * 32]
+            assert struct.unpack_from("<H", entry, 2)[0] == entry_set_checksum(
+                entry_set
+            )
+            is_dir = bool(struct.unpack_from("<H", entry, 4)[0] & 0x10)
+            stream = entry_set[32:64]
+            assert stream[0] == 0xC0
+            flags, name_length = stream[1], stream[3]
+            first_cluster, length = struct.unpack_from("<IQ", stream, 20)
+            name = b"".join(
+                entry_set[offset + 2 : offset + 32]
+                for offset in range(64, len(entry_set), 32)
+            )
+            name = name[: name_length * 2].decode("utf-16-le")
+            entries[name] = (is_dir, first_cluster, length, bool(flags & 0x02))
+            index += 1 + nb_secondary
+        return entries
+
+    def walk(self, data=None, path=""):
+        """ {path: bytes or None (folder)} of the whole tree """
+        if data is None:
+            data = self.read_data(self.root_cluster, None, contiguous=False)
+        tree = {}
+        for name, (is_dir, first_cluster, length, contiguous) in self.listdir(
+            data
+        ).items():
+            entry_path = "{}/{}".format(path, name) if path else name
+            content = self.read_data(first_cluster, length, contiguous)
+            if is_dir:
+                tree[entry_path] = None
+                tree.update(self.walk(content, entry_path))
+            else:
+                tree[entry_path] = content
+        return tree
+
+
+@pytest.fixture
+def source_tree(tmp_path):
+    """ {path: bytes or None (folder)} created in tmp_path/source """
+    cluster_size = get_cluster_size(VOLUME_SIZE)
+    tree = {
+        "nested": None,
+        "nested/deeper": None,
+        "nested/deeper/file.txt": b"hello exfat\n",
+        "nested/empty-folder": None,
+        "empty.bin": b"",
+        LONG_NAME: b"long\n",
+        UNICODE_NAME: "non-ascii content: é\n".encode("utf-8"),
+        "large.bin": os.urandom(cluster_size * 3 + 123),
+    }
+    source = tmp_path / "source"
+    for path, content in sorted(tree.items()):
+        fpath = source.joinpath(*path.split("/"))
+        if content is None:
+            fpath.mkdir(parents=True)
+        else:
+            fpath.parent.mkdir(parents=True, exist_ok=True)
+            fpath.write_bytes(content)
+    return source, tree
+
+
+def build_volume(tmp_path, source, offset):
+    image_fpath = tmp_path / "image.img"
+    with open(str(image_fpath), "wb") as fd:
+        fd.truncate(offset + VOLUME_SIZE)  # sparse
+    builder = ExfatBuilder(str(image_fpath), offset, VOLUME_SIZE, "TEST", Logger())
+    builder.add(str(source), "")
+    assert builder.build() == builder.data_size
+    return image_fpath
+
+
+def test_build_and_read_back(tmp_path, source_tree):
+    source, tree = source_tree
+    offset = ONE_MiB
+    image_fpath = build_volume(tmp_path, source, offset)
+
+    with open(str(image_fpath), "rb") as fd:
+        assert fd.read(offset) == b"\0" * offset  # nothing written before volume
+
+    reader = ExfatReader(str(image_fpath), offset)
+    try:
+        assert reader.cluster_size == get_cluster_size(VOLUME_SIZE)
+        assert reader.walk() == tree
+    finally:
+        reader.close()
+
+
+def test_duplicate_names_rejected(tmp_path, source_tree):
+    source, _ = source_tree
+    image_fpath = tmp_path / "image.img"
+    builder = ExfatBuilder(str(image_fpath), 0, VOLUME_SIZE, "TEST", Logger())
+    builder.add(str(source / "empty.bin"), "EMPTY.BIN")
+    with pytest.raises(ValueError):
+        builder.add(str(source / "empty.bin"), "empty.bin")
+
+
+@pytest.mark.skipif(not shutil.which("fsck.exfat"), reason="fsck.exfat not found")
+def test_fsck(tmp_path, source_tree):
+    source, _ = source_tree
+    image_fpath = build_volume(tmp_path, source, 0)
+    fsck = subprocess.run(
+        ["fsck.exfat", "-n", str(image_fpath)],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        universal_newlines=True,
+    )
+    assert fsck.returncode == 0, fsck.stdout
@@ -0,0 +1,38 @@
+from backend.partition import (
+    PARTITION_ENTRY,
+    PARTITION_TABLE_OFFSET,
+    MBR_SIGNATURE,
+    CHS_UNUSED,
+    read_partition_table,
+    write_partition_table,
+    get_partition_table_signature,
+)
+
+
+def test_signature_follows_partition_table(tmp_path):
+    image_fpath = str(tmp_path / "image.img")
+    with open(image_fpath, "wb") as fd:
+        fd.write(b"\0" * 510 + MBR_SIGNATURE)
+        fd.truncate(8 * 2 ** 20)
+    partitions = [
+        [0, CHS_UNUSED, 0x0C, CHS_UNUSED, 8192, 8192],
+        [0, CHS_UNUSED, 0x83, CHS_UNUSED, 16384, 8192],
+        [0, b"\0\0\0", 0, b"\0\0\0", 0, 0],
+        [0, b"\0\0\0", 0, b"\0\0\0", 0, 0],
+    ]
+    write_partition_table(image_fpath, partitions)
+    assert read_partition_table(image_fpath) == partitions
+    signature = get_partition_table_signature(image_fpath)
+
+    # data partition (re)created
+    partitions[2] = [0, CHS_UNUSED, 0x07, CHS_UNUSED, 24576, 8192]
+    write_partition_table(image_fpath, partitions)
+    assert get_partition_table_signature(image_fpath) != signature
+
+    # bytes outside of the partition entries don't matter
+    with open(image_fpath, "r+b") as fd:
+        fd.seek(PARTITION_TABLE_OFFSET + PARTITION_ENTRY.size * 4 + 2 ** 20)
+        fd.write(b"data")
+    partitions[2] = [0, b"\0\0\0", 0, b"\0\0\0", 0, 0]
+    write_partition_table(image_fpath, partitions)
+    assert get_partition_table_signature(image_fpath) == signature
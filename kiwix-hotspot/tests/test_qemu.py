@@ -0,0 +1,73 @@
+import os
+import time
+
+from backend.qemu import QCOW2_HEADER, QCOW2_MAGIC, get_backing_path
+from backend.qemu import get_overlay_backing, is_overlay_of, is_boot_snapshot_of
+
+
+def write_overlay(overlay_fpath, backing):
+    """ minimal qcow2 header referencing backing, as qemu-img writes it """
+    backing = backing.encode("utf-8")
+    header = QCOW2_HEADER.pack(QCOW2_MAGIC, 3, 512, len(backing))
+    with open(str(overlay_fpath), "wb") as fd:
+        fd.write(header.ljust(512, b"\0") + backing)
+
+
+def test_backing_path_is_relative(tmp_path):
+    cache = tmp_path / "cache"
+    assert get_backing_path(str(cache / "master.img"), str(cache / "o.qcow2")) == (
+        "master.img"
+    )
+    assert get_backing_path(
+        str(cache / "master.img"), str(tmp_path / "build" / "o.qcow2")
+    ) == os.path.join("..", "cache", "master.img")
+
+
+def test_overlay_follows_moved_folder(tmp_path):
+    cache = tmp_path / "cache"
+    cache.mkdir()
+    (cache / "master.img").write_bytes(b"\0" * 512)
+    write_overlay(cache / "master.img.boot.qcow2", "master.img")
+    assert is_overlay_of(
+        str(cache / "master.img.boot.qcow2"), str(cache / "master.img")
+    )
+
+    moved = tmp_path / "moved"
+    cache.rename(moved)
+    assert get_overlay_backing(str(moved / "master.img.boot.qcow2")) == str(
+        moved / "master.img"
+    )
+    assert is_overlay_of(
+        str(moved / "master.img.boot.qcow2"), str(moved / "master.img")
+    )
+
+
+def test_overlay_of_replaced_backing(tmp_path):
+    (tmp_path / "master.img").write_bytes(b"\0" * 512)
+    write_overlay(tmp_path / "overlay.qcow2", "master.img")
+    assert is_overlay_of(str(tmp_path / "overlay.qcow2"), str(tmp_path / "master.img"))
+
+    # re-extracted after overlay's creation
+    future = time.time() + 60
+    os.utime(str(tmp_path / "master.img"), (future, future))
+    assert not is_overlay_of(
+        str(tmp_path / "overlay.qcow2"), str(tmp_path / "master.img")
+    )
+    # backed by another file or not a qcow2 at all
+    (tmp_path / "other.img").write_bytes(b"\0" * 512)
+    assert not is_overlay_of(
+        str(tmp_path / "overlay.qcow2"), str(tmp_path / "other.img")
+    )
+    assert not is_overlay_of(str(tmp_path / "other.img"), str(tmp_path / "master.img"))
+
+
+def test_boot_snapshot_fname():
+    master = "hotspot_master_2019-01-01.img"
+    fname = master + ".8000000000-2048M-3cpu.0123abcd.boot.qcow2"
+    assert is_boot_snapshot_of(fname, master, "0123abcd")
+    # master's partition table changed
+    assert not is_boot_snapshot_of(fname, master, "4567ef01")
+    assert not is_boot_snapshot_of(master, master, "0123abcd")
+    assert not is_boot_snapshot_of(
+        "other.img.8000000000-2048M-3cpu.0123abcd.boot.qcow2", master, "0123abcd"
+    )
@@ -8,6 +8,7 @@ import json
 import data
 import math
 import signal
+import time
 import base64
 import string
 import ctypes
@@ -16,6 +17,7 @@ import zipfile
 import platform
 import tempfile
 import datetime
+import uuid
 import threading
 import collections
 from urllib.parse import urlparse
@@ -38,6 +40,10 @@ ONE_MiB = 2 ** 20
 ONE_GiB = 2 ** 30
 ONE_GB = int(1e9)
 EXFAT_FORBIDDEN_CHARS = ["/", "\\", ":", "*", "?", '"', "<", ">", "|"]
+# per-folder index of already computed checksums
+CHECKSUMS_FNAME = ".checksums.json"
+# per-folder index of last time files were used by a build
+LAST_USED_FNAME = ".last_used.json"
 
 
 STAGES = collections.OrderedDict(
@@ -54,6 +60,10 @@ STAGES = collections.OrderedDict(
 
 class Global:
     PREFERENCES = None
+    CHECKSUMS_LOCK = threading.Lock()
+    LAST_USED_LOCK = threading.Lock()
+    EXPANDED_SIZES = None
+    EXPANDED_SIZES_LOCK = threading.Lock()
 
 
 class ProgressHelper(object):
@@ -259,6 +269,74 @@ class ProgressHelper(object):
         )
 
 
+class BytesProgress(object):
+    """ thread-safe byte progress of items processed concurrently
+
+        each item (key) records its bytes done. aggregate is sent to
+        logger.progress along with throughput and ETA (logged)
+        at most every `report_interval` seconds.
+        throughput is smoothed: exponential moving average of reports """
+
+    report_interval = 5  # seconds between two reports
+    smoothing = 0.3  # weight of latest throughput in the average
+
+    def __init__(self, logger, total):
+        self.logger = logger
+        self.total = total
+        self.items = {}
+        self.rate = None
+        self.lock = threading.Lock()
+        self.last_report = time.time()
+        self.last_done = 0
+
+    @property
+    def done(self):
+        return min(sum(self.items.values()), self.total)
+
+    def update(self, key, done, force=False):
+        """ record bytes done for item key """
+        with self.lock:
+            self.items[key] = done
+            now = time.time()
+            if force or now - self.last_report >= self.report_interval:
+                self.report(now)
+
+    def callback(self, key, size):
+        """ (done, total) progress callback for item key scaled to size bytes """
+
+        def progress_cb(done, total):
+            self.update(key, int(size * min(done / total, 1)) if total else 0)
+
+        return progress_cb
+
+    def report(self, now=None):
+        now = now or time.time()
+        done = self.done
+        if now > self.last_report:
+            rate = (done - self.last_done) / (now - self.last_report)
+            self.rate = (
+                rate
+                if self.rate is None
+                else self.smoothing * rate + (1 - self.smoothing) * self.rate
+            )
+        self.last_report, self.last_done = now, done
+
+        self.logger.progress(done, self.total)
+        eta = (
+            datetime.timedelta(seconds=int((self.total - done) / self.rate))
+            if self.rate
+            else "?"
+        )
+        self.logger.std(
+            "{done}/{total} ({rate}/s, ETA {eta})".format(
+                done=human_readable_size(done),
+                total=human_readable_size(self.total),
+                rate=human_readable_size(self.rate or 0),
+                eta=eta,
+            )
+        )
+
+
 def get_free_space_in_dir(dirname):
     """Return folder/drive free space."""
     if platform.system() == "Windows":
@@ -276,6 +354,7 @@ class CancelEvent:
     def __init__(self):
         self._lock = threading.Lock()
         self._pids = []
+        self._cancelled = threading.Event()
         self.thread = None
         self.callback = None
         self.callback_args = None
@@ -291,7 +370,12 @@ class CancelEvent:
         self.callback = None
         self.callback_args = None
 
+    def is_set(self):
+        """ whether cancel() was called """
+        return self._cancelled.is_set()
+
     def cancel(self):
+        self._cancelled.set()
         if self.thread is not None:
             try:
                 self.thread.stop()
@@ -405,6 +489,165 @@ def get_checksum(fpath, func=hashlib.sha256):
     return h.hexdigest()
 
 
+def get_file_signature(fpath):
+    """ (size, mtime_ns, inode) identifying a file's content version
+
+        any change to the file (rewrite, replace, truncate) changes it """
+    stat = os.stat(fpath)
+    return [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+
+
+def get_tmp_fpath(fpath):
+    """ unique temporary path next to fpath, to be moved over it once written
+
+        unique so concurrent writers (other builds, cache.py) never share one """
+    return "{}.{}.tmp".format(fpath, uuid.uuid4().hex)
+
+
+def write_json_file(fpath, content):
+    """ save content as JSON into fpath, replacing it at once (via a .tmp file)
+
+        readers never see a partially written file """
+    tmp_fpath = get_tmp_fpath(fpath)
+    try:
+        with open(tmp_fpath, "w") as fd:
+            json.dump(content, fd, indent=4)
+        os.replace(tmp_fpath, fpath)
+    finally:
+        if os.path.exists(tmp_fpath):
+            os.unlink(tmp_fpath)
+
+
+def read_checksums_index(folder):
+    """ {fname: {signature, checksum}} of recorded checksums in folder """
+    try:
+        with open(os.path.join(folder, CHECKSUMS_FNAME), "r") as fd:
+            return json.load(fd)
+    except Exception:
+        return {}
+
+
+def read_recorded_checksum(fpath, quick=False, index=None):
+    """ recorded checksum for fpath if the file didn't change since. or None
+
+        quick: only compare file size (ignore mtime and inode)
+        index: already loaded index of fpath's folder (read from disk if None) """
+    folder, fname = os.path.split(os.path.abspath(fpath))
+    if index is None:
+        index = read_checksums_index(folder)
+    entry = index.get(fname)
+    try:
+        signature = get_file_signature(fpath)
+        if quick and entry and entry["signature"][0] == signature[0]:
+            return entry["checksum"]
+        if entry and entry["signature"] == signature:
+            return entry["checksum"]
+    except OSError:
+        pass
+    return None
+
+
+def record_checksum(fpath, checksum):
+    """ save checksum of fpath into its folder's index """
+    folder, fname = os.path.split(os.path.abspath(fpath))
+    with Global.CHECKSUMS_LOCK:
+        index = read_checksums_index(folder)
+        index[fname] = {"signature": get_file_signature(fpath), "checksum": checksum}
+        write_checksums_index(folder, index)
+
+
+def write_checksums_index(folder, index):
+    """ save index, dropping entries for files that are gone """
+    index = {
+        fname: entry
+        for fname, entry in index.items()
+        if os.path.isfile(os.path.join(folder, fname))
+    }
+    write_json_file(os.path.join(folder, CHECKSUMS_FNAME), index)
+
+
+def get_trusted_checksum(fpath, force=False, quick=False, index=None):
+    """ checksum of fpath, read from index or computed (and recorded) once
+
+        force: ignore recorded checksum and compute it again
+        quick: trust recorded checksum if file size didn't change
+        index: loaded index of fpath's folder to read from and record into.
+            caller is responsible for writing it (write_checksums_index) """
+    checksum = (
+        None if force else read_recorded_checksum(fpath, quick=quick, index=index)
+    )
+    if checksum is None:
+        checksum = get_checksum(fpath)
+        if index is not None:
+            with Global.CHECKSUMS_LOCK:
+                index[os.path.basename(fpath)] = {
+                    "signature": get_file_signature(fpath),
+                    "checksum": checksum,
+                }
+            return checksum
+        try:
+            record_checksum(fpath, checksum)
+        except OSError:
+            pass  # read-only folder: checksum will be computed again
+    return checksum
+
+
+def read_last_used_index(folder):
+    """ {fname: timestamp} of last recorded use of files in folder """
+    try:
+        with open(os.path.join(folder, LAST_USED_FNAME), "r") as fd:
+            return json.load(fd)
+    except Exception:
+        return {}
+
+
+def record_last_used(fpath):
+    """ mark fpath as used now in its folder's index """
+    folder, fname = os.path.split(os.path.abspath(fpath))
+    with Global.LAST_USED_LOCK:
+        index = read_last_used_index(folder)
+        index[fname] = time.time()
+        index = {
+            fname: used_on
+            for fname, used_on in index.items()
+            if os.path.exists(os.path.join(folder, fname))
+        }
+        write_json_file(os.path.join(folder, LAST_USED_FNAME), index)
+
+
+def get_last_used(fpath, index=None):
+    """ timestamp of last recorded use of fpath (its mtime if not recorded) """
+    folder, fname = os.path.split(os.path.abspath(fpath))
+    if index is None:
+        index = read_last_used_index(folder)
+    return index.get(fname) or os.path.getmtime(fpath)
+
+
+def get_expanded_sizes_path():
+    """ full path to our index of measured archive expanded sizes (by checksum) """
+    return os.path.join(os.path.dirname(get_prefs_path()), "kiwix-hotspot.sizes.json")
+
+
+def read_expanded_sizes(force_reload=False):
+    """ cached {checksum: expanded size} of measured archives """
+    if Global.EXPANDED_SIZES is None or force_reload:
+        try:
+            with open(get_expanded_sizes_path(), "r") as fd:
+                Global.EXPANDED_SIZES = json.load(fd)
+        except Exception:
+            Global.EXPANDED_SIZES = {}
+    return Global.EXPANDED_SIZES
+
+
+def record_expanded_size(checksum, size):
+    """ save measured expanded size of archive identified by its checksum """
+    with Global.EXPANDED_SIZES_LOCK:
+        sizes = dict(read_expanded_sizes(force_reload=True))
+        sizes[checksum] = size
+        write_json_file(get_expanded_sizes_path(), sizes)
+        Global.EXPANDED_SIZES = sizes
+
+
 def get_cache(build_folder):
     fpath = os.path.join(build_folder, cache_folder_name)
     os.makedirs(fpath, exist_ok=True)